@@ -1,29 +1,349 @@
-import subprocess
+import argparse
+import fnmatch
 import os
+import shutil
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Path to your batch file
 batch_file_path = r"C:\Users\mo-lipidomique.i2mc\Desktop\MSDIAL ver.4.9.221218 Windowsx64\MsdialConsoleApp.exe"
 
-##POS
-# Arguments for your batch file
-argumentsPOS = [
-    "lcmsdda",
-    "-i", r".\01-mzmlNEG-thermo\",
-    "-o", r".\1.2-NICOresultsNEG-thermo\",
-    "-m", r".\01-mzmlNEG-thermo\parametre.txt"
-]
-
-# Execute the batch file with arguments
-subprocess.call([batch_file_path] + argumentsPOS)
-
-##NEG
-# Arguments for your batch file
-argumentsNEG = [
-    "lcmsdda",
-    "-i", r".\01-mzmlNEG-thermo\",
-    "-o", r".\1.2-NICOresultsNEG-thermo\",
-    "-m", r".\01-mzmlNEG-thermo\parametre.txt"
-]
-
-# Execute the batch file with arguments
-subprocess.call([batch_file_path] + argumentsNEG)
\ No newline at end of file
+# Input mzML folder, output folder and parameter file of each polarity
+polarities = {
+    'POS': {
+        'input_dir': r".\01-mzmlPOS-thermo",
+        'output_dir': r".\1.2-NICOresultsPOS-thermo",
+        'method_file': r".\01-mzmlPOS-thermo\parametre.txt",
+    },
+    'NEG': {
+        'input_dir': r".\01-mzmlNEG-thermo",
+        'output_dir': r".\1.2-NICOresultsNEG-thermo",
+        'method_file': r".\01-mzmlNEG-thermo\parametre.txt",
+    },
+}
+
+
+def list_input_files(input_dir, pattern='*.mzML'):
+    """
+    List the acquisition files of a folder.
+
+    Parameters:
+        input_dir (str): Folder of the mzML files.
+        pattern (str, optional): File name pattern (case insensitive). Defaults to '*.mzML'.
+
+    Returns:
+        list: Sorted paths of the matching files.
+    """
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"Folder not found at the specified path: {input_dir}")
+    names = [name for name in os.listdir(input_dir) if fnmatch.fnmatch(name.lower(), pattern.lower())]
+    return [os.path.join(input_dir, name) for name in sorted(names)]
+
+
+def shard_files(files, n_shards):
+    """
+    Split the files into contiguous shards of (almost) equal size, keeping the acquisition order.
+
+    Parameters:
+        files (list): File paths.
+        n_shards (int): Number of shards.
+
+    Returns:
+        list: Non-empty lists of file paths.
+    """
+    n_shards = max(1, min(n_shards, len(files)))
+    size, remainder = divmod(len(files), n_shards)
+    shards = []
+    start = 0
+    for index in range(n_shards):
+        stop = start + size + (1 if index < remainder else 0)
+        shards.append(files[start:stop])
+        start = stop
+    return [shard for shard in shards if shard]
+
+
+def prepare_shard_input(files, shard_dir):
+    """
+    Create the input folder of a shard, with hard links to the files (copies where links are not possible).
+
+    Parameters:
+        files (list): File paths of the shard.
+        shard_dir (str): Shard input folder (recreated).
+
+    Returns:
+        str: shard_dir
+    """
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    for file_path in files:
+        target = os.path.join(shard_dir, os.path.basename(file_path))
+        try:
+            os.link(file_path, target)
+        except OSError:
+            shutil.copy2(file_path, target)
+    return shard_dir
+
+
+def console_command(executable, mode, input_dir, output_dir, method_file):
+    """
+    Build the MsdialConsoleApp command line.
+
+    Parameters:
+        executable (str): Path to MsdialConsoleApp, or 'fake' for the fake console of this module
+            (local testing without MS-DIAL).
+        mode (str): MS-DIAL mode (e.g. 'lcmsdda').
+        input_dir (str): Input folder.
+        output_dir (str): Output folder.
+        method_file (str): Parameter file.
+
+    Returns:
+        list: Command line arguments.
+    """
+    if executable == 'fake':
+        command = [sys.executable, os.path.abspath(__file__), '--fake-console']
+    elif executable.endswith('.py'):
+        command = [sys.executable, executable]
+    else:
+        command = [executable]
+    return command + [mode, "-i", input_dir, "-o", output_dir, "-m", method_file]
+
+
+def _new_outputs(output_dir, started):
+    if not os.path.isdir(output_dir):
+        return []
+    return [name for name in os.listdir(output_dir)
+            if os.path.isfile(os.path.join(output_dir, name)) and os.path.getmtime(os.path.join(output_dir, name)) >= started]
+
+
+def run_shard(job, retries=1, timeout=None):
+    """
+    Run MS-DIAL on one shard, with retries.
+
+    A run succeeds when the exit code is 0 and the output folder contains new files. The console output of
+    every attempt is appended to the shard log file.
+
+    Parameters:
+        job (dict): 'name', 'command', 'output_dir' and 'log_path' of the shard.
+        retries (int, optional): Number of retries after a failed run. Defaults to 1.
+        timeout (float, optional): Time limit of a run in seconds. Default is None (no limit).
+
+    Returns:
+        dict: The job with 'ok', 'returncode', 'attempts', 'outputs' and 'seconds'.
+    """
+    os.makedirs(job['output_dir'], exist_ok=True)
+    result = dict(job, ok=False, returncode=None, attempts=0, outputs=[])
+    begin = time.time()
+    for attempt in range(1, retries + 2):
+        started = time.time() - 1
+        result['attempts'] = attempt
+        with open(job['log_path'], 'a', encoding='utf-8', errors='replace') as log:
+            log.write(f"--- attempt {attempt}: {subprocess.list2cmdline(job['command'])}\n")
+            log.flush()
+            try:
+                completed = subprocess.run(job['command'], stdout=log, stderr=subprocess.STDOUT, timeout=timeout)
+                result['returncode'] = completed.returncode
+            except subprocess.TimeoutExpired:
+                log.write(f"--- attempt {attempt}: timeout after {timeout} s\n")
+                result['returncode'] = None
+                continue
+            except OSError as error:
+                log.write(f"--- attempt {attempt}: {error}\n")
+                result['returncode'] = None
+                break
+
+        result['outputs'] = _new_outputs(job['output_dir'], started)
+        if result['returncode'] == 0 and result['outputs']:
+            result['ok'] = True
+            break
+    result['seconds'] = time.time() - begin
+    return result
+
+
+def merge_shard_exports(shard_dirs, output_path, export_pattern='Align*.csv', sep=';', ppm=None,
+                        rt_tolerance=None):
+    """
+    Merge the alignment exports of the shards of a polarity into one alignment file.
+
+    Every shard is aligned separately by MS-DIAL, so the same feature has slightly different m/z and retention
+    times in the shard exports: features are matched within ppm and retention time tolerances
+    (feature_alignment.merge_batches); features not detected in a shard are left empty for its samples.
+
+    Parameters:
+        shard_dirs (list): Output folders of the shards.
+        output_path (str): Merged alignment file (same layout as an export: Rt(min), Mz and the samples).
+        export_pattern (str, optional): File name pattern of the alignment export of a shard (with Rt(min) and
+            Mz columns). Defaults to 'Align*.csv'.
+        sep (str, optional): Separator of the exports and of the merged file. Defaults to ';'.
+        ppm (float, optional): m/z tolerance in ppm. Default is None (feature_alignment.DEFAULT_PPM).
+        rt_tolerance (float, optional): Retention time tolerance in minutes. Default is None
+            (feature_alignment.DEFAULT_RT_TOLERANCE).
+
+    Returns:
+        str: output_path, or None when a shard has no export matching export_pattern (nothing merged).
+    """
+    from feature_alignment import DEFAULT_PPM, DEFAULT_RT_TOLERANCE, merge_batches
+    from tools import ALIGNMENT_FEATURE_COLUMNS, infer_sample_columns, read_file
+
+    alignments = {}
+    for shard_dir in shard_dirs:
+        exports = sorted(name for name in os.listdir(shard_dir)
+                         if fnmatch.fnmatch(name.lower(), export_pattern.lower()))
+        if not exports:
+            print(f"No {export_pattern} alignment export in {shard_dir}: shards not merged.")
+            return None
+        path = os.path.join(shard_dir, exports[-1])
+        alignments[os.path.basename(shard_dir)] = \
+            read_file(path, sep=sep)[ALIGNMENT_FEATURE_COLUMNS + infer_sample_columns(path, sep=sep)]
+
+    merged, consensus = merge_batches(alignments, ppm or DEFAULT_PPM, rt_tolerance or DEFAULT_RT_TOLERANCE)
+    merged.drop(columns=['metabolite']).to_csv(output_path, sep=sep, index=False)
+    print(f"{len(alignments)} shard alignments merged into {output_path}: {len(consensus)} features, "
+          f"{int((consensus['n_batches'] == len(alignments)).sum())} found in every shard.")
+    return output_path
+
+
+def run_batch(executable, polarity_settings, mode='lcmsdda', n_shards=1, workers=None, retries=1, timeout=None,
+              pattern='*.mzML'):
+    """
+    Run MS-DIAL on all polarities at once, each polarity split into shards processed in parallel.
+
+    With n_shards > 1 every shard is processed (and aligned) separately: the input files of shard i are linked
+    in '<output_dir>/shards-input/shard-i' and its results are written to '<output_dir>/shard-i'. The shard
+    alignments are not comparable as such: when all the shards of a polarity succeed, their alignment exports
+    (polarity setting 'export_pattern', default 'Align*.csv', separator 'export_sep', default ';') are merged
+    on matched features into '<output_dir>/AlignMerged.csv' (see merge_shard_exports), the file to read in
+    main.py. Without such exports, the shards stay separate alignments. With one shard the input folder is
+    used as is and the results are written to the output folder.
+
+    Parameters:
+        executable (str): Path to MsdialConsoleApp (or 'fake', see console_command).
+        polarity_settings (dict): 'input_dir', 'output_dir' and 'method_file' by polarity name.
+        mode (str, optional): MS-DIAL mode. Defaults to 'lcmsdda'.
+        n_shards (int, optional): Number of shards per polarity. Defaults to 1.
+        workers (int, optional): Number of console processes run at once. Default is None (one per shard).
+        retries (int, optional): Number of retries of a failed shard. Defaults to 1.
+        timeout (float, optional): Time limit of a run in seconds. Default is None (no limit).
+        pattern (str, optional): Input file name pattern. Defaults to '*.mzML'.
+
+    Returns:
+        list: Result of every shard (see run_shard).
+    """
+    jobs = []
+    for polarity, settings in polarity_settings.items():
+        output_dir = settings['output_dir']
+        log_dir = os.path.join(output_dir, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+
+        files = list_input_files(settings['input_dir'], pattern)
+        if not files:
+            raise FileNotFoundError(f"No {pattern} file in {settings['input_dir']}")
+        shards = shard_files(files, n_shards)
+        for index, shard in enumerate(shards):
+            if len(shards) == 1:
+                input_dir, shard_output_dir = settings['input_dir'], output_dir
+            else:
+                input_dir = prepare_shard_input(shard, os.path.join(output_dir, 'shards-input', f'shard-{index:02d}'))
+                shard_output_dir = os.path.join(output_dir, f'shard-{index:02d}')
+            name = f'{polarity}-shard-{index:02d}'
+            jobs.append({
+                'name': name,
+                'polarity': polarity,
+                'files': len(shard),
+                'command': console_command(executable, mode, input_dir, shard_output_dir, settings['method_file']),
+                'output_dir': shard_output_dir,
+                'log_path': os.path.join(log_dir, name + '.log'),
+            })
+
+    with ThreadPoolExecutor(max_workers=workers or len(jobs)) as executor:
+        results = list(executor.map(lambda job: run_shard(job, retries=retries, timeout=timeout), jobs))
+
+    for result in results:
+        status = 'ok' if result['ok'] else f"FAILED (exit code {result['returncode']}, see {result['log_path']})"
+        print(f"{result['name']}: {result['files']} files, {result['attempts']} attempt(s), "
+              f"{result['seconds']:.0f} s, {status}")
+
+    # Sharded polarities: one alignment from the separate shard alignments
+    for polarity, settings in polarity_settings.items():
+        shard_results = [result for result in results if result['polarity'] == polarity]
+        if len(shard_results) < 2:
+            continue
+        if not all(result['ok'] for result in shard_results):
+            print(f"{polarity}: failed shard(s), shard alignments not merged.")
+            continue
+        merge_shard_exports([result['output_dir'] for result in shard_results],
+                            os.path.join(settings['output_dir'], 'AlignMerged.csv'),
+                            settings.get('export_pattern', 'Align*.csv'), settings.get('export_sep', ';'))
+    return results
+
+
+def fake_console(argv):
+    """
+    Fake MsdialConsoleApp for local testing: writes one '.msdial' file per input file and a small alignment
+    export 'Align<output folder>.csv' (';' separated Rt(min), Mz and one intensity column per input file, the
+    same features in every run) that merge_shard_exports can merge.
+
+    Set FAKE_MSDIAL_FAIL_ONCE=1 to make the first run in every output folder fail (retry testing).
+
+    Parameters:
+        argv (list): Console arguments (mode -i input -o output -m method).
+
+    Returns:
+        int: Exit code.
+    """
+    parser = argparse.ArgumentParser(prog='fake-msdial')
+    parser.add_argument('mode')
+    parser.add_argument('-i', dest='input_dir', required=True)
+    parser.add_argument('-o', dest='output_dir', required=True)
+    parser.add_argument('-m', dest='method_file', required=True)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    marker = os.path.join(args.output_dir, '.fake-failed-once')
+    if os.environ.get('FAKE_MSDIAL_FAIL_ONCE') == '1' and not os.path.exists(marker):
+        open(marker, 'w').close()
+        print("fake MS-DIAL: simulated failure")
+        return 1
+
+    files = list_input_files(args.input_dir)
+    for file_path in files:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        with open(os.path.join(args.output_dir, name + '.msdial'), 'w') as handle:
+            handle.write(f"{args.mode}\n")
+    samples = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    shard_name = os.path.basename(os.path.normpath(args.output_dir))
+    with open(os.path.join(args.output_dir, f'Align{shard_name}.csv'), 'w') as handle:
+        handle.write(';'.join(['Rt(min)', 'Mz'] + samples) + '\n')
+        for feature in range(20):
+            # Deterministic intensities: reruns give the same export
+            intensities = [str(zlib.crc32(f'{sample}-{feature}'.encode()) % 100000 + 1000) for sample in samples]
+            handle.write(';'.join([f'{1 + 0.5 * feature:.2f}', f'{100 + 37.1234 * feature:.4f}'] + intensities)
+                         + '\n')
+    print(f"fake MS-DIAL: {len(files)} files processed")
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--fake-console':
+        sys.exit(fake_console(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description="Run MsdialConsoleApp on the POS and NEG mzML folders.")
+    parser.add_argument('--executable', default=batch_file_path, help="MsdialConsoleApp path, or 'fake'.")
+    parser.add_argument('--polarities', nargs='+', default=list(polarities), help="Polarities to process.")
+    parser.add_argument('--mode', default='lcmsdda', help="MS-DIAL mode.")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of shards per polarity. Each shard is aligned separately by MS-DIAL; the "
+                             "shard Align*.csv exports are merged on m/z and RT tolerance into AlignMerged.csv "
+                             "(without such exports the shards stay separate alignments).")
+    parser.add_argument('--workers', type=int, help="Number of console processes run at once.")
+    parser.add_argument('--retries', type=int, default=1, help="Retries of a failed shard.")
+    parser.add_argument('--timeout', type=float, help="Time limit of a run in seconds.")
+    args = parser.parse_args()
+
+    batch_results = run_batch(args.executable, {name: polarities[name] for name in args.polarities},
+                              mode=args.mode, n_shards=args.shards, workers=args.workers, retries=args.retries,
+                              timeout=args.timeout)
+    sys.exit(0 if all(result['ok'] for result in batch_results) else 1)
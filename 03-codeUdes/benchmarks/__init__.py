@@ -0,0 +1,3 @@
+# Benchmarks of the tools.py functions on synthetic MS-DIAL alignments.
+# Run from 03-codeUdes: python -m benchmarks.run --features 1000 10000 --samples 50 200
+# main_chain times one polarity of main.py end to end (grouping, drift correction, filters, normalization, imputation).
@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from tools import (read_file, add_metabolite_column, transpose_data, filter_rows, merge_data, filter_column,
+                   attach_metadata, blank_filter, QC_filter_with_zeros, cv_filter, qc_filter, save_as_csv,
+                   numeric_metabolite_columns)
+from drift_correction import drift_correction
+from feature_grouping import feature_table, collapse_feature_groups
+from imputation import impute
+from normalization import normalize
+from benchmarks.synthetic import SAMPLE_PREFIX, write_dataset
+
+# Rows excluded and CV rows of main.py (adapted to the synthetic sample names)
+EXCLUDED_ROWS = ["sample_name == 'blc'", "sample_name == 'istd_ode'"]
+
+
+def cv_rows(n_qc=3, qc_dilutions=(2, 8)):
+    return [f"sample_name == '{SAMPLE_PREFIX}QC{n_qc}'"] + \
+        [f"sample_name == '{SAMPLE_PREFIX}QC{n_qc}-DIL{factor}'" for factor in qc_dilutions]
+
+
+def main_chain(alignment_path, metadata_path, output_dir, sep=';', workers=None):
+    """
+    One polarity of main.py, end to end: lazy import (streaming read, transpose, row exclusion, metadata),
+    isotope / adduct grouping, drift correction, qc_filter, PQN normalization, imputation and CSV output.
+
+    Parameters:
+        alignment_path (str): Alignment file.
+        metadata_path (str): Metadata file.
+        output_dir (str): Output directory.
+        sep (str, optional): Separator of the alignment file. Defaults to ';'.
+        workers (int, optional): Worker processes of the drift correction. Default is None (all CPUs, as
+            main.py).
+
+    Returns:
+        DataFrame: Filtered data.
+    """
+    metadata = read_file(metadata_path, sep=';', encoding='latin-1')
+    metadata = filter_column(metadata, exclude=['id natif', 'class']).set_index('sample_name')
+    data = (read_file(alignment_path, sep=sep, streaming=True, add_metabolite=True, lazy=True)
+            .filter_column(exclude=['Rt(min)', 'Mz'])
+            .transpose_data('metabolite', dtype='float32')
+            .filter_rows(exclude=EXCLUDED_ROWS)
+            .attach_metadata(metadata)
+            .collect())
+    data, _ = collapse_feature_groups(data, feature_table(alignment_path, sep=sep), polarity='positive')
+    data, _ = drift_correction(data, qc_rows="SampleType == 'QC'", workers=workers)
+    filtered, _ = qc_filter(data, cv_rows(), zero_threshold=0.75, cv_threshold=10, cv_operation="<=")
+    filtered, _ = normalize(filtered, method='pqn', reference_rows="SampleType == 'QC'")
+    filtered = impute(filtered, method='half_min')
+    save_as_csv(filtered, output_dir=output_dir, output_file='chain', file_conflict='replace')
+    return filtered
+
+
+def measure(function, setup, repeats=3):
+    """
+    Time and memory profile of a function call.
+
+    The call is timed repeats times (setup excluded), then run once more under tracemalloc for the peak
+    memory allocated during the call (Python and NumPy allocations).
+
+    Parameters:
+        function (callable): Function to measure.
+        setup (callable): Returns the (args, kwargs) of a call; run before every call.
+        repeats (int, optional): Number of timed calls. Defaults to 3.
+
+    Returns:
+        dict: seconds_min, seconds_median, peak_mb and output_shape.
+    """
+    timings = []
+    result = None
+    for _ in range(repeats):
+        args, kwargs = setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            timings.append(time.perf_counter() - start)
+
+    args, kwargs = setup()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'seconds_min': min(timings),
+        'seconds_median': statistics.median(timings),
+        'peak_mb': peak / 2 ** 20,
+        'output_shape': list(result.shape) if hasattr(result, 'shape') else None,
+    }
+
+
+def benchmark_size(n_features, n_samples, work_dir, repeats=3, zero_fraction=0.3, functions=None):
+    """
+    Benchmark every tools.py function and the main.py chain on one synthetic dataset.
+
+    Each function gets the output of the previous step of the chain as input, prepared outside the
+    measurement.
+
+    Parameters:
+        n_features (int): Number of features.
+        n_samples (int): Number of biological samples.
+        work_dir (str): Directory of the synthetic files and outputs.
+        repeats (int, optional): Number of timed calls. Defaults to 3.
+        zero_fraction (float, optional): Mean fraction of zero intensities. Defaults to 0.3.
+        functions (list, optional): Names of the benchmarks to run. Default is None (all).
+
+    Returns:
+        list: One record per benchmark (see measure), with 'function', 'n_features' and 'n_samples'.
+    """
+    paths = write_dataset(work_dir, n_features, n_samples, zero_fraction=zero_fraction)
+    output_dir = os.path.join(work_dir, 'output')
+
+    # Inputs of every step (legacy chain of tools.py)
+    raw = read_file(paths['alignment'], sep=';')
+    metadata = read_file(paths['metadata'], sep=';', encoding='latin-1').set_index('sample_name')
+    named = add_metabolite_column(raw).drop(columns=['Rt(min)', 'Mz'])
+    transposed = transpose_data(named, 'metabolite')
+    transposed_typed = transpose_data(named, 'metabolite', dtype='float32')
+    rows_filtered = filter_rows(transposed_typed, exclude=EXCLUDED_ROWS)
+    merged = merge_data(rows_filtered, metadata)
+    features = merged[numeric_metabolite_columns(merged)]
+    attached = attach_metadata(rows_filtered, metadata[['SampleType', 'Condition', 'batch']])
+
+    benchmarks = {
+        'read_file': (read_file, lambda: ((paths['alignment'],), {'sep': ';'})),
+        'read_file[streaming]': (read_file, lambda: ((paths['alignment'],), {
+            'sep': ';', 'streaming': True, 'exclude': ['Rt(min)', 'Mz'], 'add_metabolite': True})),
+        'add_metabolite_column': (add_metabolite_column, lambda: ((raw,), {})),
+        'transpose_data': (transpose_data, lambda: ((named, 'metabolite'), {})),
+        'transpose_data[float32]': (transpose_data, lambda: ((named, 'metabolite'), {'dtype': 'float32'})),
+        'filter_rows': (filter_rows, lambda: ((transposed,), {'exclude': EXCLUDED_ROWS})),
+        'merge_data': (merge_data, lambda: ((rows_filtered, metadata), {})),
+        'blank_filter': (blank_filter, lambda: ((merged,), {})),
+        'QC_filter_with_zeros': (QC_filter_with_zeros, lambda: ((features,), {})),
+        'cv_filter': (cv_filter, lambda: ((features, cv_rows()), {})),
+        'qc_filter': (qc_filter, lambda: ((attached, cv_rows()), {'cv_threshold': 10})),
+        'save_as_csv': (save_as_csv, lambda: ((merged, output_dir, 'save'), {'file_conflict': 'replace'})),
+        'main_chain': (main_chain, lambda: ((paths['alignment'], paths['metadata'], output_dir), {})),
+    }
+
+    records = []
+    for name, (function, setup) in benchmarks.items():
+        if functions is not None and name not in functions:
+            continue
+        record = {'function': name, 'n_features': n_features, 'n_samples': n_samples}
+        record.update(measure(function, setup, repeats))
+        print(f"{name:24s} {n_features:>8d} x {n_samples:<6d} {record['seconds_min']:9.4f} s "
+              f"{record['peak_mb']:9.1f} MB")
+        records.append(record)
+    return records
+
+
+def environment():
+    """
+    Versions and machine of a benchmark run (stored with the results).
+
+    Returns:
+        dict: Python, NumPy and pandas versions, platform, CPU count, git commit (if any) and time.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run_grid(features_grid, samples_grid, output_path, repeats=3, zero_fraction=0.3, functions=None,
+             work_dir=None):
+    """
+    Run the benchmarks over a grid of sizes and save the results as JSON.
+
+    Parameters:
+        features_grid (list): Numbers of features.
+        samples_grid (list): Numbers of biological samples.
+        output_path (str): JSON result file.
+        repeats (int, optional): Number of timed calls. Defaults to 3.
+        zero_fraction (float, optional): Mean fraction of zero intensities. Defaults to 0.3.
+        functions (list, optional): Names of the benchmarks to run. Default is None (all).
+        work_dir (str, optional): Directory of the synthetic files. Default is None (temporary directory).
+
+    Returns:
+        dict: 'environment' and 'results'.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_features in features_grid:
+            for n_samples in samples_grid:
+                size_dir = os.path.join(work_dir or tmp_dir, f'{n_features}x{n_samples}')
+                results += benchmark_size(n_features, n_samples, size_dir, repeats, zero_fraction, functions)
+
+    report = {'environment': environment(), 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as handle:
+        json.dump(report, handle, indent=1)
+    print(f"Results saved at: {output_path}")
+    return report
+
+
+def compare(baseline_path, current_path, tolerance=0.2):
+    """
+    Compare two benchmark result files and list the regressions.
+
+    Parameters:
+        baseline_path (str): Result file of the reference version.
+        current_path (str): Result file of the new version.
+        tolerance (float, optional): Relative slowdown (time or peak memory) reported as a regression.
+            Defaults to 0.2.
+
+    Returns:
+        list: (function, n_features, n_samples, metric, baseline, current) of the regressions.
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as handle:
+        baseline = {(r['function'], r['n_features'], r['n_samples']): r for r in json.load(handle)['results']}
+    with open(current_path, 'r', encoding='utf-8') as handle:
+        current = json.load(handle)['results']
+
+    regressions = []
+    for record in current:
+        key = (record['function'], record['n_features'], record['n_samples'])
+        if key not in baseline:
+            continue
+        for metric in ('seconds_min', 'peak_mb'):
+            before, after = baseline[key][metric], record[metric]
+            ratio = after / before if before else float('inf')
+            print(f"{key[0]:24s} {key[1]:>8d} x {key[2]:<6d} {metric:12s} {before:10.4f} -> {after:10.4f} "
+                  f"({ratio:5.2f}x)")
+            if before and ratio > 1 + tolerance:
+                regressions.append(key + (metric, before, after))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the tools.py functions on synthetic alignments.")
+    parser.add_argument('--features', type=int, nargs='+', default=[1000, 10000], help="Numbers of features.")
+    parser.add_argument('--samples', type=int, nargs='+', default=[50, 200], help="Numbers of samples.")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of timed calls.")
+    parser.add_argument('--zero-fraction', type=float, default=0.3, help="Mean fraction of zero intensities.")
+    parser.add_argument('--functions', nargs='+', help="Benchmarks to run (default: all).")
+    parser.add_argument('--output', default='benchmark-results.json', help="JSON result file.")
+    parser.add_argument('--work-dir', help="Keep the synthetic files in this directory.")
+    parser.add_argument('--compare', help="Baseline result file to compare the new results with.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative slowdown reported as a regression.")
+    args = parser.parse_args()
+
+    run_grid(args.features, args.samples, args.output, args.repeats, args.zero_fraction, args.functions,
+             args.work_dir)
+    if args.compare:
+        found = compare(args.compare, args.output, args.tolerance)
+        print(f"{len(found)} regression(s)")
@@ -0,0 +1,139 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Sample name prefix of the acquisitions (as in the MS-DIAL exports used by main.py)
+SAMPLE_PREFIX = '240326NCE_Globale_neg_'
+
+
+def sample_layout(n_samples, n_blanks=2, n_qc=3, qc_dilutions=(2, 8), n_batches=2):
+    """
+    Sample names and metadata of a synthetic run: machine blank, blanks, QCs, QC dilutions, internal standard
+    and samples, in injection order.
+
+    Parameters:
+        n_samples (int): Number of biological samples.
+        n_blanks (int, optional): Number of extraction blanks. Defaults to 2.
+        n_qc (int, optional): Number of pooled QCs. Defaults to 3.
+        qc_dilutions (tuple, optional): Dilution factors of the last QC (one 'QC DIL' sample each).
+            Defaults to (2, 8).
+        n_batches (int, optional): Number of batches. Defaults to 2.
+
+    Returns:
+        DataFrame: Metadata with sample_name, SampleType, Condition, batch, injectionOrder, id natif, class
+        and dilution (1 for undiluted samples).
+    """
+    rows = [('blc', 'machine', 1)]
+    rows += [(f'{SAMPLE_PREFIX}blank{index + 1}', 'blank', 1) for index in range(n_blanks)]
+    rows += [(f'{SAMPLE_PREFIX}QC{index + 1}', 'QC', 1) for index in range(n_qc)]
+    rows += [(f'{SAMPLE_PREFIX}QC{n_qc}-DIL{factor}', 'QC DIL', factor) for factor in qc_dilutions]
+    rows += [('istd_ode', 'istd', 1)]
+    rows += [(f'{SAMPLE_PREFIX}S{index + 1:04d}', 'sample', 1) for index in range(n_samples)]
+
+    metadata = pd.DataFrame(rows, columns=['sample_name', 'SampleType', 'dilution'])
+    conditions = np.array(['Controle', 'T2D', "Hirschsprung's disease"])
+    metadata['Condition'] = np.where(metadata['SampleType'] == 'sample',
+                                     conditions[np.arange(len(metadata)) % len(conditions)], '')
+    metadata['injectionOrder'] = np.arange(1, len(metadata) + 1)
+    metadata['batch'] = 1 + metadata['injectionOrder'] * n_batches // (len(metadata) + 1)
+    metadata['id natif'] = np.arange(len(metadata))
+    metadata['class'] = metadata['SampleType']
+    return metadata[['sample_name', 'SampleType', 'Condition', 'batch', 'injectionOrder', 'id natif', 'class',
+                     'dilution']]
+
+
+def make_alignment(n_features, n_samples, n_blanks=2, n_qc=3, qc_dilutions=(2, 8), zero_fraction=0.3,
+                   blank_fraction=0.1, n_batches=2, seed=0):
+    """
+    Generate a synthetic MS-DIAL alignment (features x samples) and its sample metadata.
+
+    Feature abundances are log-normal; samples vary around them (with a condition effect on 5% of the
+    features), QCs are close replicates of the pool, QC dilutions are scaled down by their factor, blanks
+    only contain a blank_fraction of contaminant features. Zeros (missing peaks) are drawn with probability
+    zero_fraction, more often for low-abundance features.
+
+    Parameters:
+        n_features (int): Number of features.
+        n_samples (int): Number of biological samples.
+        n_blanks, n_qc, qc_dilutions, n_batches: See sample_layout.
+        zero_fraction (float, optional): Mean fraction of zero intensities. Defaults to 0.3.
+        blank_fraction (float, optional): Fraction of features present in the blanks. Defaults to 0.1.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        tuple: (alignment DataFrame with Rt(min), Mz and one column per sample, metadata DataFrame)
+    """
+    rng = np.random.default_rng(seed)
+    metadata = sample_layout(n_samples, n_blanks, n_qc, qc_dilutions, n_batches)
+    n_columns = len(metadata)
+    sample_type = metadata['SampleType'].to_numpy()
+
+    abundance = rng.lognormal(mean=11, sigma=1.5, size=n_features)
+    noise_sd = np.select([sample_type == 'QC', sample_type == 'QC DIL'], [0.05, 0.08], default=0.35)
+    intensities = abundance[:, None] * rng.lognormal(0, 1, size=(n_features, n_columns)) ** noise_sd
+    intensities /= metadata['dilution'].to_numpy()
+
+    # Condition effect on 5% of the features
+    effect = rng.random(n_features) < 0.05
+    condition_factor = np.where(metadata['Condition'].to_numpy() == 'T2D', 2.0, 1.0)
+    intensities[effect] *= condition_factor
+
+    # Blanks and machine blank: contaminants only
+    in_blanks = rng.random(n_features) < blank_fraction
+    blank_columns = np.isin(sample_type, ['blank', 'machine'])
+    intensities[np.ix_(~in_blanks, blank_columns)] = 0
+
+    # Missing peaks, more likely for low-abundance features
+    rank = abundance.argsort().argsort() / max(n_features - 1, 1)
+    zero_probability = np.clip(zero_fraction * 2 * (1 - rank), 0, 1)
+    intensities[rng.random((n_features, n_columns)) < zero_probability[:, None]] = 0
+
+    alignment = pd.DataFrame(np.round(intensities, 1), columns=metadata['sample_name'])
+    alignment.columns.name = None
+    alignment.insert(0, 'Mz', np.round(rng.uniform(80, 1200, n_features), 4))
+    alignment.insert(0, 'Rt(min)', np.round(rng.uniform(0.5, 15, n_features), 3))
+    return alignment, metadata.drop(columns='dilution')
+
+
+def write_dataset(output_dir, n_features, n_samples, sep=';', **options):
+    """
+    Write a synthetic alignment and its metadata as CSV files (MS-DIAL export and metadata layouts).
+
+    Parameters:
+        output_dir (str): Output directory.
+        n_features (int): Number of features.
+        n_samples (int): Number of biological samples.
+        sep (str, optional): Separator of the alignment file. Defaults to ';'.
+        **options: Passed to make_alignment.
+
+    Returns:
+        dict: 'alignment' and 'metadata' file paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    alignment, metadata = make_alignment(n_features, n_samples, **options)
+    name = f'align_{n_features}x{n_samples}'
+    paths = {
+        'alignment': os.path.join(output_dir, name + '.csv'),
+        'metadata': os.path.join(output_dir, name + '_metadata.csv'),
+    }
+    alignment.to_csv(paths['alignment'], sep=sep, index=False)
+    metadata.to_csv(paths['metadata'], sep=';', index=False, encoding='latin-1')
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic MS-DIAL alignment and its metadata.")
+    parser.add_argument('output_dir', help="Output directory.")
+    parser.add_argument('--features', type=int, default=10000, help="Number of features.")
+    parser.add_argument('--samples', type=int, default=100, help="Number of biological samples.")
+    parser.add_argument('--blanks', type=int, default=2, help="Number of blanks.")
+    parser.add_argument('--qc', type=int, default=3, help="Number of QCs.")
+    parser.add_argument('--dilutions', type=int, nargs='*', default=[2, 8], help="QC dilution factors.")
+    parser.add_argument('--zero-fraction', type=float, default=0.3, help="Mean fraction of zero intensities.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    written = write_dataset(args.output_dir, args.features, args.samples, n_blanks=args.blanks, n_qc=args.qc,
+                            qc_dilutions=tuple(args.dilutions), zero_fraction=args.zero_fraction, seed=args.seed)
+    print(written)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+# Default size bound of a cache directory (5 GB)
+DEFAULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+INDEX_FILE = 'index.json'
+ENTRY_EXT = '.parquet'
+
+
+def file_content_hash(file_path, block_size=1 << 20):
+    """
+    Compute the content hash of a file.
+
+    Parameters:
+        file_path (str): Path to the file.
+        block_size (int, optional): Number of bytes read at a time. Defaults to 1 MB.
+
+    Returns:
+        str: Hex digest (blake2b, 128 bits) of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_index(cache_dir):
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        # A corrupted index only costs a re-hash
+        return {}
+
+
+def _write_index(cache_dir, index):
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+        json.dump(index, handle)
+    os.replace(tmp_path, os.path.join(cache_dir, INDEX_FILE))
+
+
+def cache_key(cache_dir, file_path, **params):
+    """
+    Build the cache key of a parsed file.
+
+    The key combines the content hash of the file with the parameters that change the parsed result. The
+    content hash is stored in the cache index together with the path, size and mtime of the file, so an
+    unchanged file is not hashed again; a file touched without being modified still hits the cache.
+
+    Parameters:
+        cache_dir (str): Cache directory.
+        file_path (str): Path to the source file.
+        **params: Read parameters (separator, encoding, ...).
+
+    Returns:
+        str: Cache key.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+
+    index = _read_index(cache_dir)
+    record = index.get(path)
+    if record is not None and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+        content_hash = record['content_hash']
+    else:
+        content_hash = file_content_hash(path)
+        index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'content_hash': content_hash}
+        _write_index(cache_dir, index)
+
+    params_hash = hashlib.blake2b(json.dumps(params, sort_keys=True, default=str).encode(), digest_size=8)
+    return content_hash + '-' + params_hash.hexdigest()
+
+
+def load_cached_frame(cache_dir, key):
+    """
+    Load a cached DataFrame.
+
+    Parameters:
+        cache_dir (str): Cache directory.
+        key (str): Cache key.
+
+    Returns:
+        DataFrame: Cached DataFrame, or None if the key is not in the cache.
+    """
+    entry_path = os.path.join(cache_dir, key + ENTRY_EXT)
+    if not os.path.exists(entry_path):
+        return None
+    data = pd.read_parquet(entry_path)
+    # Mark the entry as recently used for the eviction
+    os.utime(entry_path)
+    return data
+
+
+def store_cached_frame(cache_dir, key, data, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """
+    Store a DataFrame in the cache as Parquet and evict the least recently used entries above max_bytes.
+
+    Parameters:
+        cache_dir (str): Cache directory.
+        key (str): Cache key.
+        data (DataFrame): DataFrame to store.
+        max_bytes (int, optional): Size bound of the cache directory. Defaults to DEFAULT_CACHE_MAX_BYTES.
+
+    Returns:
+        str: Path to the cache entry, or None if the DataFrame can not be stored as Parquet.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, key + ENTRY_EXT)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        data.to_parquet(tmp_path)
+    except (ImportError, ValueError, TypeError) as error:
+        os.remove(tmp_path)
+        print(f"Caching skipped: {error}")
+        return None
+    os.replace(tmp_path, entry_path)
+
+    evict_cache(cache_dir, max_bytes)
+    return entry_path
+
+
+def evict_cache(cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """
+    Remove the least recently used cache entries until the cache fits in max_bytes.
+
+    Parameters:
+        cache_dir (str): Cache directory.
+        max_bytes (int, optional): Size bound of the cache directory. Defaults to DEFAULT_CACHE_MAX_BYTES.
+
+    Returns:
+        list: Paths of the removed entries.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(ENTRY_EXT):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, name)))
+
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(entry_path)
+        total -= size
+        removed.append(entry_path)
+    return removed
+
+
+def invalidate_cache(cache_dir, file_path=None):
+    """
+    Invalidate cache entries.
+
+    Parameters:
+        cache_dir (str): Cache directory.
+        file_path (str, optional): Only invalidate the entries of this source file. Default is None (whole cache).
+
+    Returns:
+        int: Number of removed entries.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    if file_path is None:
+        removed = len([name for name in os.listdir(cache_dir) if name.endswith(ENTRY_EXT)])
+        shutil.rmtree(cache_dir)
+        return removed
+
+    path = os.path.abspath(file_path)
+    index = _read_index(cache_dir)
+    record = index.pop(path, None)
+    if record is None:
+        return 0
+    _write_index(cache_dir, index)
+
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if name.startswith(record['content_hash'] + '-') and name.endswith(ENTRY_EXT):
+            os.remove(os.path.join(cache_dir, name))
+            removed += 1
+    return removed
@@ -0,0 +1,218 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+from tools import read_file, numeric_metabolite_columns, save_data
+
+CORRELATION_METHODS = ('pearson', 'spearman')
+
+
+def standardize_columns(values, method='pearson'):
+    """
+    Standardize the feature columns so that the correlation of two features is the dot product of their columns.
+
+    Each column is centered and scaled to unit norm (after ranking for Spearman). Missing values are replaced
+    by the feature mean, i.e. they do not contribute to the correlations. Constant features are left at 0.
+
+    Parameters:
+        values (ndarray): Samples x features matrix.
+        method (str, optional): 'pearson' or 'spearman'. Defaults to 'pearson'.
+
+    Returns:
+        ndarray: Standardized float32 matrix (samples x features).
+    """
+    if method not in CORRELATION_METHODS:
+        raise ValueError(f"Unsupported correlation method '{method}'. Supported methods: {CORRELATION_METHODS}")
+
+    values = np.array(values, dtype=np.float64)
+    missing = np.isnan(values)
+    if method == 'spearman':
+        # Average ranks of the observed values, as cor(method = "spearman")
+        values = stats.rankdata(np.where(missing, np.inf, values), axis=0)
+        values[missing] = np.nan
+    mean = np.nanmean(values, axis=0)
+    centered = np.where(missing, 0.0, values - mean)
+    norm = np.sqrt((centered * centered).sum(axis=0))
+    norm[norm == 0] = 1.0
+    return (centered / norm).astype(np.float32)
+
+
+def feature_tiles(n_features, tile_size):
+    """
+    Tiles of the upper triangle of the feature x feature correlation matrix.
+
+    Parameters:
+        n_features (int): Number of features.
+        tile_size (int): Number of features per tile side.
+
+    Returns:
+        list: (row_start, row_stop, column_start, column_stop) of every tile with row_start <= column_start.
+    """
+    bounds = [(start, min(start + tile_size, n_features)) for start in range(0, n_features, tile_size)]
+    return [(row_start, row_stop, column_start, column_stop)
+            for index, (row_start, row_stop) in enumerate(bounds)
+            for column_start, column_stop in bounds[index:]]
+
+
+def _tile_correlations(standardized, tile):
+    row_start, row_stop, column_start, column_stop = tile
+    correlations = standardized[:, row_start:row_stop].T @ standardized[:, column_start:column_stop]
+    # Rounding of float32 products can go slightly beyond [-1, 1]
+    return np.clip(correlations, -1.0, 1.0, out=correlations)
+
+
+def correlation_matrix(standardized, output_path, tile_size=2048, workers=None):
+    """
+    Dense correlation matrix computed tile by tile into a memory-mapped .npy file.
+
+    Only the tiles of the upper triangle are computed, each one is written with its mirror image. Tiles are
+    matrix products of float32 blocks, run in a thread pool (NumPy releases the GIL during the products).
+
+    Parameters:
+        standardized (ndarray): Result of standardize_columns.
+        output_path (str): Output .npy file (open it with np.load(output_path, mmap_mode='r')).
+        tile_size (int, optional): Number of features per tile side. Defaults to 2048.
+        workers (int, optional): Number of threads. Default is None (one per CPU core).
+
+    Returns:
+        ndarray: Memory-mapped features x features float32 matrix.
+    """
+    n_features = standardized.shape[1]
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    result = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(n_features, n_features))
+
+    def write_tile(tile):
+        row_start, row_stop, column_start, column_stop = tile
+        correlations = _tile_correlations(standardized, tile)
+        result[row_start:row_stop, column_start:column_stop] = correlations
+        result[column_start:column_stop, row_start:row_stop] = correlations.T
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(write_tile, feature_tiles(n_features, tile_size)))
+    result.flush()
+    return result
+
+
+def correlation_edges(standardized, features, threshold=0.8, tile_size=2048, workers=None):
+    """
+    Sparse correlation network: the feature pairs with |r| >= threshold, computed tile by tile.
+
+    Only the edges of each tile are kept, so the memory use depends on the number of edges and the tile size,
+    not on the square of the number of features.
+
+    Parameters:
+        standardized (ndarray): Result of standardize_columns.
+        features (list): Feature names (one per column of standardized).
+        threshold (float, optional): Minimum absolute correlation. Defaults to 0.8.
+        tile_size (int, optional): Number of features per tile side. Defaults to 2048.
+        workers (int, optional): Number of threads. Default is None (one per CPU core).
+
+    Returns:
+        DataFrame: Edge list with source, target (source before target in the feature order) and r.
+    """
+    def tile_edges(tile):
+        row_start, _, column_start, _ = tile
+        correlations = _tile_correlations(standardized, tile)
+        rows, columns = np.nonzero(np.abs(correlations) >= threshold)
+        rows += row_start
+        columns += column_start
+        # Upper triangle only: each pair once, no self-correlation
+        upper = rows < columns
+        return rows[upper], columns[upper], correlations[rows[upper] - row_start, columns[upper] - column_start]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        parts = list(executor.map(tile_edges, feature_tiles(standardized.shape[1], tile_size)))
+
+    features = np.asarray(features, dtype=object)
+    rows = np.concatenate([part[0] for part in parts])
+    columns = np.concatenate([part[1] for part in parts])
+    return pd.DataFrame({
+        'source': features[rows],
+        'target': features[columns],
+        'r': np.concatenate([part[2] for part in parts]),
+    })
+
+
+def correlate(data, feature_columns=None, method='pearson', output='edges', threshold=0.8, output_path=None,
+              tile_size=2048, workers=None):
+    """
+    Feature x feature correlation of a samples x features DataFrame (replaces the dense cor() of correlation.R).
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        method (str, optional): 'pearson' or 'spearman'. Defaults to 'pearson'.
+        output (str, optional): 'edges' (sparse edge list, see correlation_edges) or 'dense' (memory-mapped
+            matrix, see correlation_matrix). Defaults to 'edges'.
+        threshold (float, optional): Minimum absolute correlation of the edges. Defaults to 0.8.
+        output_path (str, optional): .npy file of the dense matrix (required with output='dense').
+        tile_size (int, optional): Number of features per tile side. Defaults to 2048.
+        workers (int, optional): Number of threads. Default is None (one per CPU core).
+
+    Returns:
+        DataFrame or tuple: Edge list, or (memory-mapped matrix, list of features) with output='dense'.
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    standardized = standardize_columns(data[feature_columns].to_numpy(), method)
+
+    if output == 'edges':
+        return correlation_edges(standardized, feature_columns, threshold, tile_size, workers)
+    if output == 'dense':
+        if output_path is None:
+            raise ValueError("output_path is required for a dense correlation matrix.")
+        return correlation_matrix(standardized, output_path, tile_size, workers), list(feature_columns)
+    raise ValueError("Unsupported output. Supported outputs: 'edges', 'dense'.")
+
+
+def combine_datasets(datasets):
+    """
+    Join the features of several datasets (e.g. POS and NEG) on their common samples.
+
+    Feature names get the dataset name as suffix (e.g. 'M123.4567T2.31_POS'), so they still start with "M".
+
+    Parameters:
+        datasets (dict): Dataset name -> samples x features DataFrame (indexed or with a 'sample_name' column).
+
+    Returns:
+        DataFrame: Samples x features DataFrame of the common samples.
+    """
+    parts = []
+    for name, data in datasets.items():
+        if 'sample_name' in data.columns:
+            data = data.set_index('sample_name')
+        features = numeric_metabolite_columns(data)
+        parts.append(data[features].rename(columns=lambda col: f'{col}_{name}'))
+    return pd.concat(parts, axis=1, join='inner')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Blockwise feature correlation (sparse edge list or dense matrix).")
+    parser.add_argument('inputs', nargs='+', help="Dataset files as NAME=PATH (e.g. POS=POS-manipulated.csv).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='correlation', help="Output file name (without extension).")
+    parser.add_argument('--method', default='pearson', choices=CORRELATION_METHODS, help="Correlation method.")
+    parser.add_argument('--dense', action='store_true', help="Write the dense matrix (.npy) instead of edges.")
+    parser.add_argument('--threshold', type=float, default=0.8, help="Minimum |r| of the edges.")
+    parser.add_argument('--tile-size', type=int, default=2048, help="Number of features per tile side.")
+    parser.add_argument('--workers', type=int, help="Number of threads.")
+    args = parser.parse_args()
+
+    inputs = dict(item.split('=', 1) for item in args.inputs)
+    combined = combine_datasets({name: read_file(path, sep=';') for name, path in inputs.items()})
+    print(f"{combined.shape[1]} features, {combined.shape[0]} common samples")
+
+    if args.dense:
+        matrix_path = os.path.join(args.output_dir, args.output_file + '.npy')
+        _, matrix_features = correlate(combined, method=args.method, output='dense', output_path=matrix_path,
+                                       tile_size=args.tile_size, workers=args.workers)
+        save_data(pd.DataFrame({'metabolite': matrix_features}), args.output_dir, args.output_file + '-features',
+                  file_conflict='replace')
+        print(f"Dense matrix written to {matrix_path}")
+    else:
+        edges = correlate(combined, method=args.method, threshold=args.threshold, tile_size=args.tile_size,
+                          workers=args.workers)
+        save_data(edges, args.output_dir, args.output_file, file_conflict='replace', file_format='parquet')
+        print(f"{len(edges)} edges with |r| >= {args.threshold}")
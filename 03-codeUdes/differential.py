@@ -0,0 +1,352 @@
+import argparse
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+from tools import read_file, numeric_metabolite_columns, save_data
+
+# Contrasts of the volcano plots of statistics.R: (condition1_col, condition1_val, condition2_col, condition2_val)
+VOLCANO_CONTRASTS = {
+    'C_T': ('Condition', 'Controle', 'Condition', 'T2D'),
+    'C_H': ('Condition', 'Controle', 'Condition', "Hirschsprung's disease"),
+    'T_H': ('Condition', 'T2D', 'Condition', "Hirschsprung's disease"),
+    'C1_C2': ('Duration', 'C1', 'Duration', 'C2'),
+    'C1_T': ('Duration', 'C1', 'Condition', 'T2D'),
+    'C1_H': ('Duration', 'C1', 'Condition', "Hirschsprung's disease"),
+    'C2_T': ('Duration', 'C2', 'Condition', 'T2D'),
+    'C2_H': ('Duration', 'C2', 'Condition', "Hirschsprung's disease"),
+}
+
+
+def group_statistics(data, groups, feature_columns=None):
+    """
+    Compute the sufficient statistics (n, sum, sum of squares) of every feature in every group at once.
+
+    The statistics come from three matrix products of the group indicator matrix with the intensity matrix.
+    Missing values (NaN) are skipped. Sums are computed on values centered on the feature mean (returned as
+    'shift'), which keeps the variances accurate for large intensities.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the group columns.
+        groups (dict): Group name -> (column, value).
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+
+    Returns:
+        dict: 'features' (list), 'groups' (list), 'n', 'sum', 'sumsq' (groups x features arrays) and 'shift'
+        (features array).
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+
+    values = data[feature_columns].to_numpy(dtype=np.float64)
+    observed = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        shift = np.nan_to_num(np.nanmean(values, axis=0))
+    centered = np.where(observed, values - shift, 0.0)
+
+    # Group indicator matrix (groups x samples)
+    names = list(groups)
+    indicator = np.zeros((len(names), len(data)))
+    for row, name in enumerate(names):
+        column, value = groups[name]
+        indicator[row] = (data[column] == value).to_numpy()
+
+    return {
+        'features': list(feature_columns),
+        'groups': names,
+        'n': indicator @ observed,
+        'sum': indicator @ centered,
+        'sumsq': indicator @ (centered * centered),
+        'shift': shift,
+    }
+
+
+def welch_from_statistics(n1, sum1, sumsq1, n2, sum2, sumsq2, shift, equal_var=False):
+    """
+    Compute means, fold change and t-test results from the sufficient statistics of two groups.
+
+    Parameters:
+        n1, sum1, sumsq1, n2, sum2, sumsq2 (ndarray): Statistics of the two groups (see group_statistics).
+        shift (ndarray): Feature centering of the sums.
+        equal_var (bool, optional): Student t-test with pooled variance instead of Welch. Defaults to False.
+
+    Returns:
+        dict: mean_1, mean_2, Fold_Change (mean_2 / mean_1), log2FoldChange, t, df and P_Value arrays.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centered_mean1 = sum1 / n1
+        centered_mean2 = sum2 / n2
+        var1 = (sumsq1 - n1 * centered_mean1 ** 2) / (n1 - 1)
+        var2 = (sumsq2 - n2 * centered_mean2 ** 2) / (n2 - 1)
+        var1 = np.maximum(var1, 0)
+        var2 = np.maximum(var2, 0)
+
+        if equal_var:
+            df = n1 + n2 - 2
+            pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+            standard_error = np.sqrt(pooled * (1 / n1 + 1 / n2))
+        else:
+            se1, se2 = var1 / n1, var2 / n2
+            standard_error = np.sqrt(se1 + se2)
+            df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+
+        # Same orientation as t.test(condition1, condition2) in statistics.R
+        t = (centered_mean1 - centered_mean2) / standard_error
+        p_value = 2 * stats.t.sf(np.abs(t), df)
+
+        mean1 = centered_mean1 + shift
+        mean2 = centered_mean2 + shift
+        fold_change = mean2 / mean1
+        log2_fold_change = np.log2(fold_change)
+
+    return {'mean_1': mean1, 'mean_2': mean2, 'Fold_Change': fold_change, 'log2FoldChange': log2_fold_change,
+            't': t, 'df': df, 'P_Value': p_value}
+
+
+def p_adjust_bh(p_values):
+    """
+    Benjamini-Hochberg adjusted p-values (as p.adjust(method = "BH") in R). Missing p-values stay missing and
+    are not counted as tests.
+
+    Parameters:
+        p_values (array-like): Raw p-values.
+
+    Returns:
+        ndarray: Adjusted p-values.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    # Missing p-values are left out of the ranks and of the number of tests
+    valid = np.flatnonzero(np.isfinite(p_values))
+    if len(valid) == 0:
+        return adjusted
+
+    order = valid[np.argsort(p_values[valid])]
+    ranks = np.arange(1, len(order) + 1)
+    # Cumulative minimum from the largest p-value down keeps the adjusted values monotonic
+    scaled = np.minimum.accumulate((p_values[order] * len(order) / ranks)[::-1])[::-1]
+    adjusted[order] = np.minimum(scaled, 1.0)
+    return adjusted
+
+
+# Centered intensities of the permutation workers, set once per process by _init_permutation_worker
+_PERMUTATION_DATA = {}
+
+
+def _init_permutation_worker(centered, observed):
+    _PERMUTATION_DATA.clear()
+    _PERMUTATION_DATA['centered'] = centered
+    _PERMUTATION_DATA['observed'] = observed
+
+
+def _permutation_batch(rows, n1, seed, batch_size, equal_var, t_observed):
+    # Statistics of the rows of the contrast are kept between the batches of the same contrast
+    rows_key = (rows.tobytes(), n1)
+    if _PERMUTATION_DATA.get('rows_key') != rows_key:
+        centered = _PERMUTATION_DATA['centered'][rows]
+        observed = _PERMUTATION_DATA['observed'][rows]
+        _PERMUTATION_DATA.update(rows_key=rows_key, rows_centered=centered, rows_squared=centered * centered,
+                                 rows_observed=observed, totals=(observed.sum(axis=0), centered.sum(axis=0),
+                                                                 (centered * centered).sum(axis=0)))
+    centered = _PERMUTATION_DATA['rows_centered']
+    squared = _PERMUTATION_DATA['rows_squared']
+    observed = _PERMUTATION_DATA['rows_observed']
+    total_n, total_sum, total_sumsq = _PERMUTATION_DATA['totals']
+
+    # Label matrix (permutations x samples): n1 randomly chosen samples of each permutation are in group 1
+    rng = np.random.default_rng(seed)
+    order = np.argsort(rng.random((batch_size, len(rows))), axis=1)
+    labels = np.zeros((batch_size, len(rows)))
+    labels[np.arange(batch_size)[:, None], order[:, :n1]] = 1.0
+
+    n_1 = labels @ observed
+    sum_1 = labels @ centered
+    sumsq_1 = labels @ squared
+    t = welch_from_statistics(n_1, sum_1, sumsq_1, total_n - n_1, total_sum - sum_1, total_sumsq - sumsq_1,
+                              0.0, equal_var=equal_var)['t']
+    # Relative tolerance, so that permutations equal to the observed split are counted
+    with np.errstate(invalid='ignore'):
+        return (np.abs(t) >= np.abs(t_observed) * (1 - 1e-9)).sum(axis=0)
+
+
+def permutation_pvalues(data, contrasts, t_observed, feature_columns=None, n_permutations=1000, batch_size=100,
+                        workers=None, seed=0, equal_var=False):
+    """
+    Permutation p-values of the t statistics: the group labels of each contrast are shuffled and the t-test is
+    recomputed for all the features at once.
+
+    Each batch of permutations is a label matrix multiplied with the intensity matrix (same sufficient
+    statistics as group_statistics). Batches are distributed over a process pool; every batch has its own
+    seed spawned from 'seed', so the results do not depend on the number of workers.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the condition columns.
+        contrasts (dict): Contrast name -> (condition1_col, condition1_val, condition2_col, condition2_val).
+        t_observed (dict): Contrast name -> observed t statistics (array, one value per feature).
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        n_permutations (int, optional): Number of permutations per contrast. Defaults to 1000.
+        batch_size (int, optional): Number of permutations per matrix product. Defaults to 100.
+        workers (int, optional): Number of worker processes. Default is None (one per CPU core). With 1 worker
+            the batches run in this process.
+        seed (int, optional): Random seed. Defaults to 0.
+        equal_var (bool, optional): Student t-test instead of Welch. Defaults to False.
+
+    Returns:
+        dict: Contrast name -> permutation p-values ((count + 1) / (n_permutations + 1)), NaN where the
+        observed t statistic is missing (e.g. a group with one value or no variance).
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+
+    values = data[feature_columns].to_numpy(dtype=np.float64)
+    observed = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        shift = np.nan_to_num(np.nanmean(values, axis=0))
+    centered = np.where(observed, values - shift, 0.0)
+    observed = observed.astype(np.float64)
+
+    # One task per batch: (contrast, rows, n1, seed, size)
+    batch_sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(contrasts) * len(batch_sizes))
+    tasks = []
+    for index, (name, (condition1_col, condition1_val, condition2_col, condition2_val)) in enumerate(contrasts.items()):
+        in_first = (data[condition1_col] == condition1_val).to_numpy()
+        in_second = (data[condition2_col] == condition2_val).to_numpy()
+        if (in_first & in_second).any():
+            raise ValueError(f"The conditions of contrast '{name}' share samples: labels cannot be permuted.")
+        rows = np.flatnonzero(in_first | in_second)
+        n1 = int(in_first.sum())
+        for batch, size in enumerate(batch_sizes):
+            tasks.append((name, rows, n1, seeds[index * len(batch_sizes) + batch], size))
+
+    counts = {name: np.zeros(len(feature_columns)) for name in contrasts}
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        _init_permutation_worker(centered, observed)
+        for name, rows, n1, batch_seed, size in tasks:
+            counts[name] += _permutation_batch(rows, n1, batch_seed, size, equal_var, t_observed[name])
+        _PERMUTATION_DATA.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_permutation_worker,
+                                 initargs=(centered, observed)) as executor:
+            futures = [(name, executor.submit(_permutation_batch, rows, n1, batch_seed, size, equal_var,
+                                              t_observed[name]))
+                       for name, rows, n1, batch_seed, size in tasks]
+            for name, future in futures:
+                counts[name] += future.result()
+
+    # No observed t (NaN is never exceeded): no p-value, rather than the smallest one
+    return {name: np.where(np.isfinite(t_observed[name]), (count + 1) / (n_permutations + 1), np.nan)
+            for name, count in counts.items()}
+
+
+def welch_contrasts(data, contrasts, feature_columns=None, equal_var=False, fc_threshold=0.6, p_threshold=0.05,
+                    p_column='P_Value', n_permutations=0, workers=None, seed=0):
+    """
+    Fold change and t-test of every feature for every contrast, as one tidy table.
+
+    Replaces the per-feature, per-contrast t-tests of statistics.R (generate_volcano_plot) and of the notebook
+    (common_metabolites_detection): the group statistics are computed once for all the contrasts.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the condition columns (e.g. POS-manipulated.csv).
+        contrasts (dict): Contrast name -> (condition1_col, condition1_val, condition2_col, condition2_val).
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        equal_var (bool, optional): Student t-test (as scipy.stats.ttest_ind in the notebook) instead of Welch
+            (as t.test in statistics.R). Defaults to False.
+        fc_threshold (float, optional): |log2FoldChange| threshold of 'diffexpressed'. Defaults to 0.6.
+        p_threshold (float, optional): p-value threshold of 'diffexpressed'. Defaults to 0.05.
+        p_column (str, optional): p-value column of 'diffexpressed': 'P_Value', 'P_Adj' (Benjamini-Hochberg),
+            'P_Perm' or 'P_Perm_Adj' (with n_permutations > 0). Defaults to 'P_Value'.
+        n_permutations (int, optional): Number of label permutations per contrast (see permutation_pvalues).
+            Default is 0 (no permutation test).
+        workers (int, optional): Number of worker processes of the permutation test. Default is None (one per
+            CPU core).
+        seed (int, optional): Random seed of the permutation test. Defaults to 0.
+
+    Returns:
+        DataFrame: One row per contrast and feature: contrast, Metabolite, n_1, n_2, mean_1, mean_2,
+        Fold_Change, log2FoldChange, t, df, P_Value, P_Adj, [P_Perm, P_Perm_Adj] and diffexpressed ('UP', 'DOWN'
+        or 'NO'). The adjusted p-values are corrected within each contrast.
+    """
+    groups = {}
+    for condition1_col, condition1_val, condition2_col, condition2_val in contrasts.values():
+        groups[(condition1_col, condition1_val)] = (condition1_col, condition1_val)
+        groups[(condition2_col, condition2_val)] = (condition2_col, condition2_val)
+    statistics = group_statistics(data, groups, feature_columns)
+    position = {name: row for row, name in enumerate(statistics['groups'])}
+
+    tables = []
+    for name, (condition1_col, condition1_val, condition2_col, condition2_val) in contrasts.items():
+        first = position[(condition1_col, condition1_val)]
+        second = position[(condition2_col, condition2_val)]
+        if statistics['n'][first].max() == 0 or statistics['n'][second].max() == 0:
+            raise ValueError(f"One or both conditions of contrast '{name}' have no observations.")
+
+        result = welch_from_statistics(
+            statistics['n'][first], statistics['sum'][first], statistics['sumsq'][first],
+            statistics['n'][second], statistics['sum'][second], statistics['sumsq'][second],
+            statistics['shift'], equal_var=equal_var)
+        table = pd.DataFrame({'contrast': name, 'Metabolite': statistics['features'],
+                              'n_1': statistics['n'][first], 'n_2': statistics['n'][second], **result})
+        table['P_Adj'] = p_adjust_bh(table['P_Value'])
+        tables.append(table)
+
+    if n_permutations > 0:
+        permuted = permutation_pvalues(data, contrasts, {table['contrast'].iloc[0]: table['t'].to_numpy()
+                                                         for table in tables},
+                                       feature_columns=statistics['features'], n_permutations=n_permutations,
+                                       workers=workers, seed=seed, equal_var=equal_var)
+        for table in tables:
+            table['P_Perm'] = permuted[table['contrast'].iloc[0]]
+            table['P_Perm_Adj'] = p_adjust_bh(table['P_Perm'])
+
+    results = pd.concat(tables, ignore_index=True)
+    results['diffexpressed'] = label_differential(results, p_column, fc_threshold, p_threshold)
+    return results
+
+
+def label_differential(results, p_column='P_Value', fc_threshold=0.6, p_threshold=0.05):
+    """
+    Label the features as in statistics.R: 'UP', 'DOWN' or 'NO'.
+
+    Parameters:
+        results (DataFrame): Table with 'log2FoldChange' and p_column.
+        p_column (str, optional): p-value column used. Defaults to 'P_Value'.
+        fc_threshold (float, optional): |log2FoldChange| threshold. Defaults to 0.6.
+        p_threshold (float, optional): p-value threshold. Defaults to 0.05.
+
+    Returns:
+        ndarray: Labels.
+    """
+    significant = (results[p_column] < p_threshold).to_numpy()
+    log2_fold_change = results['log2FoldChange'].to_numpy()
+    return np.select([significant & (log2_fold_change > fc_threshold),
+                      significant & (log2_fold_change < -fc_threshold)], ['UP', 'DOWN'], default='NO')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fold change and t-tests of all the volcano contrasts.")
+    parser.add_argument('inputs', nargs='+', help="Filtered data files (e.g. POS-manipulated.csv NEG-manipulated.csv).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='volcano', help="Output file name (without extension).")
+    parser.add_argument('--file-format', default='csv', help="Output format (csv, parquet, feather, hdf5).")
+    parser.add_argument('--p-column', default='P_Value', help="p-value column of 'diffexpressed' (e.g. P_Adj).")
+    parser.add_argument('--permutations', type=int, default=0, help="Number of label permutations per contrast.")
+    parser.add_argument('--workers', type=int, help="Number of worker processes of the permutation test.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the permutation test.")
+    args = parser.parse_args()
+
+    all_results = []
+    for input_path in args.inputs:
+        input_data = read_file(input_path, sep=';')
+        input_results = welch_contrasts(input_data, VOLCANO_CONTRASTS, p_column=args.p_column,
+                                        n_permutations=args.permutations, workers=args.workers, seed=args.seed)
+        input_results.insert(0, 'dataset', input_path)
+        all_results.append(input_results)
+    save_data(pd.concat(all_results, ignore_index=True), args.output_dir, args.output_file,
+              file_conflict='replace', file_format=args.file_format)
@@ -0,0 +1,224 @@
+import argparse
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from instrument import traced
+from predicates import row_mask
+from tools import read_file, numeric_metabolite_columns, save_data
+
+# QC injections used to fit the drift (as accepted by filter_rows 'include')
+DEFAULT_QC_ROWS = "SampleType == 'QC'"
+
+# Smoother weights of every batch, cached once per worker process
+_DRIFT_DATA = {}
+
+
+def loess_weights(qc_order, sample_order, span=0.75):
+    """
+    Tricube weights of a local linear (LOESS) fit of the QC injections, evaluated at the sample injections.
+
+    As loess() in R, the neighbourhood of an injection is its span * n_qc nearest QC injections. The weights
+    only depend on the injection order, so one matrix serves every feature of a batch.
+
+    Parameters:
+        qc_order (ndarray): Injection order of the QC injections.
+        sample_order (ndarray): Injection order of the injections to correct.
+        span (float, optional): Fraction of the QC injections in each neighbourhood. Defaults to 0.75.
+
+    Returns:
+        ndarray: Weights (injections x QC injections).
+    """
+    n_neighbours = min(len(qc_order), max(3, int(np.ceil(span * len(qc_order)))))
+    distances = np.abs(sample_order[:, None] - qc_order[None, :])
+    radius = np.partition(distances, n_neighbours - 1, axis=1)[:, n_neighbours - 1]
+    radius = np.maximum(radius, 1e-12)[:, None]
+    return np.clip(1 - (distances / radius) ** 3, 0, None) ** 3
+
+
+def loess_fit(weights, qc_order, sample_order, qc_values, min_qc=4):
+    """
+    Drift curves of a block of features: local linear fits of the QC intensities against the injection order.
+
+    Every feature has its own missing QC values (zero or NaN), so the weighted least-squares sums are built
+    with matrix products of the weights and the valid-value mask; the fits of all the features of the block
+    are solved at once. Features with less than min_qc valid QC values get a constant curve (median of the
+    valid QC values), features without valid QC values get NaN.
+
+    Parameters:
+        weights (ndarray): loess_weights of the batch (injections x QC injections).
+        qc_order (ndarray): Injection order of the QC injections.
+        sample_order (ndarray): Injection order of the injections to correct.
+        qc_values (ndarray): QC intensities (QC injections x features).
+        min_qc (int, optional): Minimum number of valid QC values of a fitted curve. Defaults to 4.
+
+    Returns:
+        ndarray: Fitted intensities (injections x features).
+    """
+    qc_values = qc_values.astype(np.float64)
+    valid = np.isfinite(qc_values) & (qc_values > 0)
+    y = np.where(valid, qc_values, 0.0)
+    mask = valid.astype(np.float64)
+    x = qc_order[:, None]
+
+    s0 = weights @ mask
+    s1 = weights @ (x * mask)
+    s2 = weights @ (x * x * mask)
+    t0 = weights @ y
+    t1 = weights @ (x * y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        determinant = s0 * s2 - s1 * s1
+        slope = (s0 * t1 - s1 * t0) / determinant
+        fit = (t0 - slope * s1) / s0 + slope * sample_order[:, None]
+        # Single distinct injection order in the neighbourhood: weighted mean
+        flat = ~(np.abs(determinant) > 1e-9 * s0 * s0)
+        fit[flat] = (t0 / s0)[flat]
+
+    n_valid = valid.sum(axis=0)
+    few = n_valid < min_qc
+    if few.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            fit[:, few] = np.nanmedian(np.where(valid[:, few], qc_values[:, few], np.nan), axis=0)
+    return fit
+
+
+def _init_drift_worker(batches):
+    _DRIFT_DATA.clear()
+    _DRIFT_DATA['batches'] = batches
+
+
+def _correct_block(values):
+    # Correct one block of features (all injections x block) batch by batch
+    values = values.astype(np.float64)
+    corrected = values.copy()
+    qc_rows = np.concatenate([batch['qc_rows'] for batch in _DRIFT_DATA['batches']])
+    qc_values = np.where(values[qc_rows] > 0, values[qc_rows], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        target = np.nanmedian(qc_values, axis=0)
+    fitted = np.zeros(values.shape[1], dtype=int)
+
+    for batch in _DRIFT_DATA['batches']:
+        fit = loess_fit(batch['weights'], batch['qc_order'], batch['sample_order'], values[batch['qc_rows']],
+                        batch['min_qc'])
+        usable = np.isfinite(fit) & (fit > 0) & np.isfinite(target)
+        factor = np.where(usable, target / np.where(usable, fit, 1.0), 1.0)
+        corrected[batch['rows']] = values[batch['rows']] * factor
+        fitted += usable.all(axis=0)
+    return corrected, fitted
+
+
+def _qc_cv(values):
+    # CV (%) of the positive QC intensities of every feature
+    values = np.where(values > 0, values, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanstd(values, axis=0, ddof=1) / np.nanmean(values, axis=0) * 100
+
+
+@traced
+def drift_correction(data, qc_rows=DEFAULT_QC_ROWS, order_column='injectionOrder', batch_column='batch',
+                     feature_columns=None, span=0.75, min_qc=4, block_size=2048, workers=None):
+    """
+    QC-based signal drift correction (QC-RLSC): in every batch, a LOESS curve of each feature is fitted on the
+    QC injections against the injection order, and all the injections of the batch are divided by the curve
+    and scaled to the median QC intensity of the feature (over all batches, which also removes the batch
+    offsets).
+
+    The LOESS weights depend on the injection order only, so they are computed once per batch (loess_weights)
+    and the fits of a block of features are matrix products (loess_fit). Feature blocks are distributed over
+    a process pool. Zero intensities stay zero; injections without batch or injection order are not
+    corrected.
+
+    Parameters:
+        data (DataFrame): Merged DataFrame (samples x features + metadata columns, injectionOrder kept).
+        qc_rows (list, str or RowPredicate, optional): QC injections, as accepted by filter_rows 'include'.
+            Defaults to DEFAULT_QC_ROWS.
+        order_column (str, optional): Injection order column. Defaults to 'injectionOrder'.
+        batch_column (str, optional): Batch column (None: a single batch). Defaults to 'batch'.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        span (float, optional): LOESS span (fraction of the QC injections of the batch). Defaults to 0.75.
+        min_qc (int, optional): Minimum number of valid QC values to fit a curve; below, only the batch
+            median is corrected. Defaults to 4.
+        block_size (int, optional): Number of features per task. Defaults to 2048.
+        workers (int, optional): Number of worker processes. Default is None (all CPUs); 1 runs in process.
+
+    Returns:
+        tuple: (corrected DataFrame, per-feature report DataFrame with qc_cv_before, qc_cv_after and
+        batches_fitted)
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    if order_column not in data.columns:
+        raise ValueError(f"Injection order column '{order_column}' not found (keep it in the metadata).")
+
+    order = pd.to_numeric(data[order_column], errors='coerce').to_numpy(dtype=np.float64)
+    is_qc = row_mask(data, include=qc_rows)
+    batch_labels = data[batch_column].to_numpy() if batch_column is not None else np.zeros(len(data))
+
+    batches = []
+    for label in pd.unique(batch_labels[~np.isnan(order)]):
+        rows = np.flatnonzero((batch_labels == label) & ~np.isnan(order))
+        qc = rows[is_qc[rows]]
+        if len(qc) == 0:
+            print(f"Batch {label}: no QC injection, not corrected.")
+            continue
+        qc_order = order[qc]
+        # No extrapolation outside the QC injections
+        sample_order = np.clip(order[rows], qc_order.min(), qc_order.max())
+        batches.append({'rows': rows, 'qc_rows': qc, 'qc_order': qc_order, 'sample_order': sample_order,
+                        'weights': loess_weights(qc_order, sample_order, span), 'min_qc': min_qc})
+    if not batches:
+        raise ValueError("No QC injection with an injection order: the drift cannot be fitted.")
+
+    values = data[feature_columns].to_numpy()
+    corrected = np.empty(values.shape, dtype=values.dtype if values.dtype.kind == 'f' else np.float64)
+    fitted = np.zeros(len(feature_columns), dtype=int)
+    blocks = [slice(start, start + block_size) for start in range(0, len(feature_columns), block_size)]
+
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(blocks) <= 1:
+        _init_drift_worker(batches)
+        results = (_correct_block(values[:, block]) for block in blocks)
+        for block, (block_values, block_fitted) in zip(blocks, results):
+            corrected[:, block], fitted[block] = block_values, block_fitted
+        _DRIFT_DATA.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_drift_worker,
+                                 initargs=(batches,)) as executor:
+            futures = [executor.submit(_correct_block, np.ascontiguousarray(values[:, block])) for block in blocks]
+            for block, future in zip(blocks, futures):
+                corrected[:, block], fitted[block] = future.result()
+
+    report = pd.DataFrame({
+        'qc_cv_before': _qc_cv(values[is_qc].astype(np.float64)),
+        'qc_cv_after': _qc_cv(corrected[is_qc].astype(np.float64)),
+        'batches_fitted': fitted,
+    }, index=pd.Index(feature_columns, name='metabolite'))
+
+    other_columns = [col for col in data.columns if col not in set(feature_columns)]
+    result = pd.concat([pd.DataFrame(corrected, index=data.index, columns=feature_columns, copy=False),
+                        data[other_columns]], axis=1)
+    return result[data.columns], report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="QC-based drift correction of a merged data file.")
+    parser.add_argument('input', help="Merged data file (samples x features + metadata with injectionOrder).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='drift-corrected', help="Output file name (without extension).")
+    parser.add_argument('--sep', default=';', help="Separator of the input file.")
+    parser.add_argument('--span', type=float, default=0.75, help="LOESS span.")
+    parser.add_argument('--min-qc', type=int, default=4, help="Minimum number of valid QC values per batch.")
+    parser.add_argument('--workers', type=int, help="Number of worker processes.")
+    parser.add_argument('--file-format', default='csv', help="Output format (csv, parquet, feather, hdf5).")
+    args = parser.parse_args()
+
+    input_data = read_file(args.input, sep=args.sep)
+    corrected_data, drift_report = drift_correction(input_data, span=args.span, min_qc=args.min_qc,
+                                                    workers=args.workers)
+    print(drift_report[['qc_cv_before', 'qc_cv_after']].median())
+    save_data(corrected_data, args.output_dir, args.output_file, file_conflict='replace', file_format=args.file_format)
+    save_data(drift_report, args.output_dir, args.output_file + '-report', file_conflict='replace')
@@ -0,0 +1,245 @@
+import argparse
+import numpy as np
+import pandas as pd
+from tools import ALIGNMENT_FEATURE_COLUMNS, infer_sample_columns, metabolite_names, read_file, save_data
+
+# Default matching tolerances: m/z in ppm, retention time in minutes
+DEFAULT_PPM = 10
+DEFAULT_RT_TOLERANCE = 0.1
+
+
+class FeatureIndex:
+    """
+    Sorted m/z index of a feature list, to find the features matching other features within ppm and retention
+    time tolerances.
+
+    The features are sorted by m/z once; each query finds its m/z window with a binary search (searchsorted),
+    so matching n features costs O(n log n) plus the number of candidates in the windows.
+
+    Attributes:
+        mz (ndarray): m/z of the indexed features (original order).
+        rt (ndarray): Retention times of the indexed features (original order).
+    """
+
+    def __init__(self, mz, rt):
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        self._order = np.argsort(self.mz, kind='stable')
+        self._sorted_mz = self.mz[self._order]
+
+    def __len__(self):
+        return len(self.mz)
+
+    def candidates(self, mz, rt, ppm=DEFAULT_PPM, rt_tolerance=DEFAULT_RT_TOLERANCE):
+        """
+        All the (query, indexed feature) pairs within the tolerances.
+
+        Parameters:
+            mz (array-like): m/z of the query features.
+            rt (array-like): Retention times of the query features.
+            ppm (float, optional): m/z tolerance in ppm. Defaults to DEFAULT_PPM.
+            rt_tolerance (float, optional): Retention time tolerance in minutes. Defaults to DEFAULT_RT_TOLERANCE.
+
+        Returns:
+            tuple: (query positions, indexed positions, score) arrays; score is the squared distance in
+            tolerance units (0 = same m/z and retention time, up to 2 at the edge of both windows).
+        """
+        mz = np.asarray(mz, dtype=np.float64)
+        rt = np.asarray(rt, dtype=np.float64)
+        low = np.searchsorted(self._sorted_mz, mz * (1 - ppm * 1e-6), side='left')
+        high = np.searchsorted(self._sorted_mz, mz * (1 + ppm * 1e-6), side='right')
+
+        # Expand the m/z windows into candidate pairs
+        counts = high - low
+        queries = np.repeat(np.arange(len(mz)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        indexed = self._order[np.repeat(low, counts) + offsets]
+
+        mz_error = (self.mz[indexed] - mz[queries]) / (mz[queries] * ppm * 1e-6)
+        rt_error = (self.rt[indexed] - rt[queries]) / rt_tolerance
+        within = np.abs(rt_error) <= 1
+        score = mz_error[within] ** 2 + rt_error[within] ** 2
+        return queries[within], indexed[within], score
+
+    def match(self, mz, rt, ppm=DEFAULT_PPM, rt_tolerance=DEFAULT_RT_TOLERANCE):
+        """
+        Match query features one-to-one with the indexed features.
+
+        Greedy matching: the candidate pairs are taken by increasing score and a pair is kept when neither its
+        query nor its indexed feature is matched yet, so a query whose closest feature went to a closer query
+        still gets its next candidate.
+
+        Parameters:
+            mz, rt, ppm, rt_tolerance: See candidates.
+
+        Returns:
+            ndarray: Position of the matched indexed feature for every query, -1 when unmatched.
+        """
+        queries, indexed, score = self.candidates(mz, rt, ppm, rt_tolerance)
+        order = np.argsort(score, kind='stable')
+        queries, indexed = queries[order], indexed[order]
+
+        matches = np.full(len(mz), -1)
+        used = np.zeros(len(self.mz), dtype=bool)
+        for query, feature in zip(queries.tolist(), indexed.tolist()):
+            if matches[query] < 0 and not used[feature]:
+                matches[query] = feature
+                used[feature] = True
+        return matches
+
+
+def feature_ids(mz, rt, mz_decimals=4, rt_decimals=2):
+    """
+    Feature IDs built from m/z and retention time with enough decimals to keep distinct features apart
+    ('M<m/z>T<rt>', e.g. 'M301.1412T5.23'). Colliding IDs get a '_2', '_3'... suffix.
+
+    Parameters:
+        mz (array-like): m/z values.
+        rt (array-like): Retention times in minutes.
+        mz_decimals (int, optional): m/z decimals. Defaults to 4.
+        rt_decimals (int, optional): Retention time decimals. Defaults to 2.
+
+    Returns:
+        ndarray: Unique feature IDs.
+    """
+    rt_text = pd.Series(np.asarray(rt, dtype=np.float64)).round(rt_decimals).map(f'{{:.{rt_decimals}f}}'.format)
+    ids = metabolite_names(pd.Series(np.asarray(mz, dtype=np.float64)), rt_text, mz_decimals=mz_decimals)
+    duplicate_rank = ids.groupby(ids).cumcount()
+    ids = ids.where(duplicate_rank == 0, ids + '_' + (duplicate_rank + 1).astype(str))
+    return ids.to_numpy()
+
+
+def align_features(feature_tables, ppm=DEFAULT_PPM, rt_tolerance=DEFAULT_RT_TOLERANCE, mz_decimals=4):
+    """
+    Build the consensus feature list of several batches.
+
+    Batches are added in order: the features of each batch are matched (FeatureIndex.match) against the
+    consensus features found so far, whose m/z and retention time are the running means of their matched
+    features; unmatched features become new consensus features. IDs are built from the m/z and retention
+    time of the first occurrence, so they do not change when later batches are added.
+
+    Parameters:
+        feature_tables (dict): Batch name -> DataFrame with 'Mz' and 'Rt(min)' columns (one row per feature).
+        ppm (float, optional): m/z tolerance in ppm. Defaults to DEFAULT_PPM.
+        rt_tolerance (float, optional): Retention time tolerance in minutes. Defaults to DEFAULT_RT_TOLERANCE.
+        mz_decimals (int, optional): m/z decimals of the IDs. Defaults to 4.
+
+    Returns:
+        tuple: (consensus DataFrame indexed by feature ID with Mz, Rt(min), n_batches and first_batch,
+        dict batch name -> consensus position of every feature of the batch)
+    """
+    consensus_mz = np.empty(0)
+    consensus_rt = np.empty(0)
+    first_mz = np.empty(0)
+    first_rt = np.empty(0)
+    counts = np.empty(0)
+    first_batch = []
+    positions = {}
+
+    for batch, table in feature_tables.items():
+        mz = table['Mz'].to_numpy(dtype=np.float64)
+        rt = table['Rt(min)'].to_numpy(dtype=np.float64)
+        if len(consensus_mz):
+            matches = FeatureIndex(consensus_mz, consensus_rt).match(mz, rt, ppm, rt_tolerance)
+        else:
+            matches = np.full(len(mz), -1)
+
+        # Running means of the matched consensus features
+        matched = matches >= 0
+        targets = matches[matched]
+        consensus_mz[targets] += (mz[matched] - consensus_mz[targets]) / (counts[targets] + 1)
+        consensus_rt[targets] += (rt[matched] - consensus_rt[targets]) / (counts[targets] + 1)
+        counts[targets] += 1
+
+        # New consensus features
+        new = np.flatnonzero(~matched)
+        matches[new] = len(consensus_mz) + np.arange(len(new))
+        consensus_mz = np.concatenate([consensus_mz, mz[new]])
+        consensus_rt = np.concatenate([consensus_rt, rt[new]])
+        first_mz = np.concatenate([first_mz, mz[new]])
+        first_rt = np.concatenate([first_rt, rt[new]])
+        counts = np.concatenate([counts, np.ones(len(new))])
+        first_batch += [batch] * len(new)
+        positions[batch] = matches
+
+    consensus = pd.DataFrame({
+        'Mz': consensus_mz,
+        'Rt(min)': consensus_rt,
+        'n_batches': counts.astype(int),
+        'first_batch': first_batch,
+    }, index=pd.Index(feature_ids(first_mz, first_rt, mz_decimals), name='metabolite'))
+    return consensus, positions
+
+
+def merge_batches(alignments, ppm=DEFAULT_PPM, rt_tolerance=DEFAULT_RT_TOLERANCE, mz_decimals=4,
+                  prefix_samples=False, dtype=np.float32):
+    """
+    Merge the alignment exports of several batches (or instruments) on matched features.
+
+    Replaces the string join on 'M<integer m/z>T<rt>' names: features are matched within ppm and retention time
+    tolerances (see align_features) and every batch block is written once into a preallocated matrix.
+    Features not detected in a batch are left empty (NaN) for its samples.
+
+    Parameters:
+        alignments (dict): Batch name -> alignment DataFrame (Rt(min), Mz and one column per sample).
+        ppm (float, optional): m/z tolerance in ppm. Defaults to DEFAULT_PPM.
+        rt_tolerance (float, optional): Retention time tolerance in minutes. Defaults to DEFAULT_RT_TOLERANCE.
+        mz_decimals (int, optional): m/z decimals of the IDs. Defaults to 4.
+        prefix_samples (bool, optional): Prefix the sample names with the batch name (needed when batches
+            share sample names, e.g. QC1). Defaults to False.
+        dtype (dtype, optional): dtype of the intensities. Defaults to float32.
+
+    Returns:
+        tuple: (merged alignment DataFrame with metabolite, Rt(min), Mz and the sample columns of all the
+        batches, ready for transpose_data; consensus feature DataFrame (see align_features))
+    """
+    sample_columns = {}
+    for batch, data in alignments.items():
+        numeric_columns = data.select_dtypes(include='number').columns
+        sample_columns[batch] = [col for col in numeric_columns if col not in ALIGNMENT_FEATURE_COLUMNS]
+
+    names = [f'{batch}_{col}' if prefix_samples else col
+             for batch, columns in sample_columns.items() for col in columns]
+    duplicated = pd.Index(names)[pd.Index(names).duplicated()].unique().tolist()
+    if duplicated:
+        raise ValueError(f"Sample names found in several batches (use prefix_samples=True): {duplicated}")
+
+    consensus, positions = align_features(alignments, ppm, rt_tolerance, mz_decimals)
+    values = np.full((len(consensus), len(names)), np.nan, dtype=dtype)
+    start = 0
+    for batch, data in alignments.items():
+        columns = sample_columns[batch]
+        values[positions[batch], start:start + len(columns)] = data[columns].to_numpy(dtype=dtype)
+        start += len(columns)
+
+    merged = pd.DataFrame(values, columns=names, copy=False)
+    merged.insert(0, 'Mz', consensus['Mz'].to_numpy())
+    merged.insert(0, 'Rt(min)', consensus['Rt(min)'].to_numpy())
+    merged.insert(0, 'metabolite', consensus.index.to_numpy())
+    return merged, consensus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge MS-DIAL alignment exports of several batches on matched features.")
+    parser.add_argument('inputs', nargs='+', help="Batches as NAME=PATH (e.g. B1=AlignB1.csv B2=AlignB2.csv).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='merged-alignment', help="Output file name (without extension).")
+    parser.add_argument('--sep', default=';', help="Separator of the alignment files.")
+    parser.add_argument('--ppm', type=float, default=DEFAULT_PPM, help="m/z tolerance in ppm.")
+    parser.add_argument('--rt-tolerance', type=float, default=DEFAULT_RT_TOLERANCE, help="RT tolerance in minutes.")
+    parser.add_argument('--prefix-samples', action='store_true', help="Prefix the sample names with the batch name.")
+    parser.add_argument('--file-format', default='csv', help="Output format (csv, parquet, feather, hdf5).")
+    args = parser.parse_args()
+
+    batches = {}
+    for item in args.inputs:
+        batch_name, path = item.split('=', 1)
+        batch_samples = infer_sample_columns(path, sep=args.sep)
+        batches[batch_name] = read_file(path, sep=args.sep)[ALIGNMENT_FEATURE_COLUMNS + batch_samples]
+
+    merged_alignment, consensus_features = merge_batches(batches, args.ppm, args.rt_tolerance,
+                                                         prefix_samples=args.prefix_samples)
+    print(consensus_features['n_batches'].value_counts().sort_index())
+    save_data(merged_alignment, args.output_dir, args.output_file, file_conflict='replace',
+              file_format=args.file_format)
+    save_data(consensus_features, args.output_dir, args.output_file + '-features', file_conflict='replace')
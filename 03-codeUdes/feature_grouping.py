@@ -0,0 +1,241 @@
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from correlation import standardize_columns
+from instrument import traced
+from predicates import row_mask
+from tools import ALIGNMENT_FEATURE_COLUMNS, read_file, numeric_metabolite_columns, add_metabolite_column, save_data
+
+# m/z differences between features of the same compound (Da): 13C isotopes and common adducts / in-source
+# losses, relative to [M+H]+ (positive) or [M-H]- (negative)
+ISOTOPE_SHIFTS = {
+    '13C': 1.003355,
+    '13C2': 2.006710,
+    '13C (z=2)': 0.501677,
+}
+ADDUCT_SHIFTS = {
+    'positive': {
+        '[M+Na]+': 21.981944,
+        '[M+K]+': 37.955882,
+        '[M+NH4]+': 17.026549,
+        '[M+H-H2O]+': 18.010565,
+    },
+    'negative': {
+        '[M+Cl]-': 35.976678,
+        '[M+HCOO]-': 46.005479,
+        '[M+CH3COO]-': 60.021129,
+        '[M-H-H2O]-': 18.010565,
+        '[M+Na-2H]-': 21.981944,
+    },
+}
+
+
+def mass_shifts(polarity='positive'):
+    """
+    Isotope and adduct m/z differences of a polarity.
+
+    Parameters:
+        polarity (str, optional): 'positive' or 'negative'. Defaults to 'positive'.
+
+    Returns:
+        dict: Relation name -> m/z difference (Da).
+    """
+    if polarity not in ADDUCT_SHIFTS:
+        raise ValueError(f"Unsupported polarity. Supported polarities: {', '.join(ADDUCT_SHIFTS)}.")
+    return {**ISOTOPE_SHIFTS, **ADDUCT_SHIFTS[polarity]}
+
+
+def coeluting_pairs(rt, rt_tolerance=0.02, block_size=20000):
+    """
+    Pairs of features eluting within rt_tolerance of each other.
+
+    Features are sorted by retention time once; the partners of every feature are the next features of the
+    sorted list up to rt + rt_tolerance (binary search), expanded block by block.
+
+    Parameters:
+        rt (ndarray): Retention times (minutes).
+        rt_tolerance (float, optional): Retention time window (minutes). Defaults to 0.02.
+        block_size (int, optional): Number of features expanded at a time. Defaults to 20000.
+
+    Returns:
+        iterator: (first, second) position arrays of each block of pairs.
+    """
+    order = np.argsort(rt, kind='stable')
+    sorted_rt = rt[order]
+    high = np.searchsorted(sorted_rt, sorted_rt + rt_tolerance, side='right')
+    for start in range(0, len(rt), block_size):
+        anchors = np.arange(start, min(start + block_size, len(rt)))
+        counts = high[anchors] - anchors - 1
+        first = np.repeat(anchors, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = first + 1 + offsets
+        yield order[first], order[second]
+
+
+def group_features(mz, rt, values, polarity='positive', rt_tolerance=0.02, mz_tolerance=0.003, ppm=5,
+                   min_correlation=0.8, shifts=None):
+    """
+    Group the features of the same compound: co-eluting features whose m/z difference is an isotope or
+    adduct shift and whose (log) intensities are correlated across the samples.
+
+    The candidate pairs come from the retention time sorted features (coeluting_pairs); the m/z differences
+    are checked against all the shifts at once, and only the remaining pairs get a correlation (dot product of
+    the standardized intensity columns). Groups are the connected components of the pair graph; the
+    representative of a group is its most intense feature (median intensity).
+
+    Parameters:
+        mz (ndarray): m/z of the features.
+        rt (ndarray): Retention times of the features (minutes).
+        values (ndarray): Intensities (samples x features).
+        polarity (str, optional): 'positive' or 'negative' (adduct shifts). Defaults to 'positive'.
+        rt_tolerance (float, optional): Retention time window (minutes). Defaults to 0.02.
+        mz_tolerance (float, optional): Absolute m/z tolerance of a shift (Da). Defaults to 0.003.
+        ppm (float, optional): Relative m/z tolerance of a shift, added to mz_tolerance. Defaults to 5.
+        min_correlation (float, optional): Minimum Pearson correlation of the intensities. Defaults to 0.8.
+        shifts (dict, optional): Relation name -> m/z difference. Default is None (mass_shifts(polarity)).
+
+    Returns:
+        DataFrame: One row per feature (in input order): feature_group, group_size, representative (bool),
+        relation (shift linking the feature to its group, '' for single features) and correlation.
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    rt = np.asarray(rt, dtype=np.float64)
+    shifts = shifts if shifts is not None else mass_shifts(polarity)
+    shift_names = np.array(list(shifts))
+    shift_values = np.array(list(shifts.values()))
+    # Correlation of the log intensities (zeros and NaN ignored): the most intense samples do not dominate
+    with np.errstate(all='ignore'):
+        standardized = standardize_columns(np.where(np.isfinite(values) & (values > 0), np.log(values), np.nan))
+
+    pair_first, pair_second, pair_relation, pair_correlation = [], [], [], []
+    for first, second in coeluting_pairs(rt, rt_tolerance):
+        difference = np.abs(mz[second] - mz[first])
+        tolerance = mz_tolerance + ppm * 1e-6 * np.maximum(mz[first], mz[second])
+        error = np.abs(difference[:, None] - shift_values[None, :])
+        matched = error <= tolerance[:, None]
+        keep = matched.any(axis=1)
+        first, second = first[keep], second[keep]
+        relation = np.argmin(np.where(matched[keep], error[keep], np.inf), axis=1)
+        correlation = np.einsum('ij,ij->j', standardized[:, first], standardized[:, second])
+        correlated = correlation >= min_correlation
+        pair_first.append(first[correlated])
+        pair_second.append(second[correlated])
+        pair_relation.append(relation[correlated])
+        pair_correlation.append(correlation[correlated])
+
+    n_features = len(mz)
+    first = np.concatenate(pair_first) if pair_first else np.empty(0, dtype=int)
+    second = np.concatenate(pair_second) if pair_second else np.empty(0, dtype=int)
+    relation = np.concatenate(pair_relation) if pair_relation else np.empty(0, dtype=int)
+    correlation = np.concatenate(pair_correlation) if pair_correlation else np.empty(0)
+    graph = coo_matrix((np.ones(len(first)), (first, second)), shape=(n_features, n_features))
+    _, labels = connected_components(graph, directed=False)
+
+    # Representative: most intense feature of each group
+    with np.errstate(all='ignore'):
+        intensity = np.nan_to_num(np.nanmedian(np.where(values > 0, values, np.nan), axis=0), nan=0.0)
+    order = np.lexsort((-intensity, labels))
+    first_of_group = np.r_[True, labels[order][1:] != labels[order][:-1]]
+    representative = np.zeros(n_features, dtype=bool)
+    representative[order[first_of_group]] = True
+
+    # Group numbers in order of the representatives, relation of each grouped feature (strongest pair)
+    group_number = np.empty(labels.max() + 1 if n_features else 0, dtype=int)
+    group_number[labels[np.flatnonzero(representative)]] = np.arange(representative.sum())
+    feature_relation = np.full(n_features, '', dtype=object)
+    feature_correlation = np.full(n_features, np.nan)
+    strongest = np.argsort(correlation, kind='stable')
+    for side in (first, second):
+        feature_relation[side[strongest]] = shift_names[relation[strongest]]
+        feature_correlation[side[strongest]] = correlation[strongest]
+    feature_relation[representative] = ''
+
+    return pd.DataFrame({
+        'feature_group': group_number[labels],
+        'group_size': np.bincount(labels)[labels],
+        'representative': representative,
+        'relation': feature_relation,
+        'correlation': feature_correlation,
+    })
+
+
+@traced
+def collapse_feature_groups(data, features, polarity='positive', feature_columns=None, rows=None,
+                            rt_tolerance=0.02, mz_tolerance=0.003, ppm=5, min_correlation=0.8):
+    """
+    Keep one feature per isotope / adduct group (see group_features), before the QC filters.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame (e.g. the output of attach_metadata).
+        features (DataFrame): Feature table indexed by feature name with 'Mz' and 'Rt(min)' columns (e.g. the
+            'metabolite', 'Rt(min)' and 'Mz' columns of the alignment, see feature_table).
+        polarity (str, optional): 'positive' or 'negative'. Defaults to 'positive'.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        rows (list, str or RowPredicate, optional): Samples used for the correlations, as accepted by
+            filter_rows 'include'. Default is None (all).
+        rt_tolerance, mz_tolerance, ppm, min_correlation: See group_features.
+
+    Returns:
+        tuple: (DataFrame with the representative features only, per-feature report DataFrame indexed by
+        feature name)
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    features = features[~features.index.duplicated()]
+    missing = pd.Index(feature_columns).difference(features.index)
+    if len(missing):
+        raise ValueError(f"Features without m/z and retention time: {missing[:10].tolist()}")
+    features = features.reindex(feature_columns)
+
+    values = data[feature_columns].to_numpy()
+    if rows is not None:
+        values = values[row_mask(data, include=rows)]
+    report = group_features(features['Mz'].to_numpy(), features['Rt(min)'].to_numpy(), values, polarity,
+                            rt_tolerance, mz_tolerance, ppm, min_correlation)
+    report.index = pd.Index(feature_columns, name='metabolite')
+
+    columns_to_drop = report.index[~report['representative']].tolist()
+    print(f"{len(columns_to_drop)} redundant features collapsed into {report['feature_group'].nunique()} groups.")
+    return data.drop(columns_to_drop, axis=1), report
+
+
+def feature_table(file_path, sep=';', encoding='utf-8'):
+    """
+    Feature table of an MS-DIAL alignment export: 'Rt(min)' and 'Mz' indexed by the metabolite name (only these
+    two columns are parsed).
+
+    Parameters:
+        file_path (str): Path to the alignment CSV file.
+        sep (str, optional): Separator of the file. Defaults to ';'.
+        encoding (str, optional): Encoding of the file. Defaults to 'utf-8'.
+
+    Returns:
+        DataFrame: Feature table.
+    """
+    table = read_file(file_path, sep=sep, encoding=encoding, lazy=True) \
+        .filter_column(include=ALIGNMENT_FEATURE_COLUMNS).add_metabolite_column().collect()
+    return table.set_index('metabolite')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Isotope and adduct grouping of the features of an alignment.")
+    parser.add_argument('input', help="Alignment export (features as rows, with Rt(min), Mz and the samples).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='feature-groups', help="Output file name (without extension).")
+    parser.add_argument('--sep', default=';', help="Separator of the input file.")
+    parser.add_argument('--polarity', default='positive', choices=list(ADDUCT_SHIFTS), help="Ionization mode.")
+    parser.add_argument('--rt-tolerance', type=float, default=0.02, help="Retention time window (minutes).")
+    parser.add_argument('--min-correlation', type=float, default=0.8, help="Minimum intensity correlation.")
+    args = parser.parse_args()
+
+    alignment = add_metabolite_column(read_file(args.input, sep=args.sep, streaming=True))
+    sample_columns = [col for col in alignment.select_dtypes(include='number').columns
+                      if col not in ALIGNMENT_FEATURE_COLUMNS]
+    groups = group_features(alignment['Mz'].to_numpy(), alignment['Rt(min)'].to_numpy(),
+                            alignment[sample_columns].to_numpy().T, args.polarity, args.rt_tolerance,
+                            min_correlation=args.min_correlation)
+    groups.insert(0, 'metabolite', alignment['metabolite'].to_numpy())
+    print(groups['group_size'].value_counts().sort_index())
+    save_data(groups, args.output_dir, args.output_file, file_conflict='replace')
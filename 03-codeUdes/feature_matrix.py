@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+
+class FeatureMatrix:
+    """
+    Typed intensity matrix with its feature and sample tables.
+
+    Attributes:
+        values (ndarray): C-contiguous float32/float64 intensities (samples x features).
+        features (DataFrame): Feature table indexed by feature name ('Mz', 'Rt(min)', identification...),
+            one row per column of values.
+        samples (DataFrame): Sample metadata table indexed by sample name, one row per row of values.
+    """
+
+    def __init__(self, values, features, samples):
+        if values.ndim != 2:
+            raise ValueError("values must be a 2D array (samples x features).")
+        if values.shape != (len(samples), len(features)):
+            raise ValueError(f"values shape {values.shape} does not match {len(samples)} samples "
+                             f"x {len(features)} features.")
+        self.values = values
+        self.features = features
+        self.samples = samples
+
+    @classmethod
+    def from_alignment(cls, data, metabolite_column='metabolite', feature_columns=None,
+                       dtype=np.float32):
+        """
+        Build a FeatureMatrix from an alignment DataFrame (one row per feature, one column per sample).
+
+        Parameters:
+            data (DataFrame): Alignment DataFrame, e.g. the output of add_metabolite_column.
+            metabolite_column (str, optional): Column holding the feature names. Defaults to 'metabolite'.
+            feature_columns (list, optional): Numeric feature descriptor columns. Default is None
+                (['Rt(min)', 'Mz']).
+            dtype (dtype, optional): dtype of the intensities. Defaults to float32.
+
+        Returns:
+            FeatureMatrix: Matrix with the sample columns as rows. Non-numeric columns and feature_columns
+            go to the feature table.
+        """
+        if feature_columns is None:
+            feature_columns = ['Rt(min)', 'Mz']
+        numeric_columns = data.select_dtypes(include='number').columns
+        sample_columns = [col for col in numeric_columns
+                          if col not in feature_columns and col != metabolite_column]
+        descriptor_columns = [col for col in data.columns
+                              if col not in sample_columns and col != metabolite_column]
+
+        features = data[descriptor_columns].set_axis(pd.Index(data[metabolite_column], name='metabolite'))
+        samples = pd.DataFrame(index=pd.Index(sample_columns, name='sample_name'))
+        # One copy: each sample column is cast straight into its row of the sample-major array
+        values = np.empty((len(sample_columns), len(data)), dtype=dtype)
+        for row, col in enumerate(sample_columns):
+            values[row] = data[col].to_numpy()
+        return cls(values, features, samples)
+
+    @classmethod
+    def from_dataframe(cls, data, feature_columns=None, dtype=np.float32):
+        """
+        Build a FeatureMatrix from a wide DataFrame (one row per sample, as used by the tools.py filters).
+
+        Parameters:
+            data (DataFrame): Samples x (features + metadata) DataFrame.
+            feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+            dtype (dtype, optional): dtype of the intensities. Defaults to float32.
+
+        Returns:
+            FeatureMatrix: Matrix with the other columns as sample metadata.
+        """
+        if feature_columns is None:
+            numeric_columns = data.select_dtypes(include='number').columns
+            feature_columns = [col for col in numeric_columns if str(col).startswith("M")]
+
+        metadata_columns = [col for col in data.columns if col not in set(feature_columns)]
+        values = np.ascontiguousarray(data[feature_columns].to_numpy(dtype=dtype))
+        features = pd.DataFrame(index=pd.Index(feature_columns, name='metabolite'))
+        samples = data[metadata_columns]
+        return cls(values, features, samples)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @staticmethod
+    def _indexer(selection, index):
+        # Slices stay slices (numpy views), everything else becomes positions
+        if selection is None:
+            return slice(None)
+        if isinstance(selection, slice):
+            if isinstance(selection.start, str) or isinstance(selection.stop, str):
+                return index.slice_indexer(selection.start, selection.stop, selection.step)
+            return selection
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            if len(selection) != len(index):
+                raise ValueError("Boolean mask length does not match the axis length.")
+            return np.flatnonzero(selection)
+        if selection.dtype.kind in 'iu':
+            return selection
+        positions = index.get_indexer(selection)
+        if (positions == -1).any():
+            raise KeyError(f"Labels not found: {list(selection[positions == -1])}")
+        return positions
+
+    def select(self, samples=None, features=None):
+        """
+        Select samples (rows) and/or features (columns).
+
+        Slices (positions or labels) return views on the same memory, so no intensity is copied; label lists,
+        positions and boolean masks return a compact copy of the selected block only.
+
+        Parameters:
+            samples (slice, list or ndarray, optional): Samples to keep. Default is None (all).
+            features (slice, list or ndarray, optional): Features to keep. Default is None (all).
+
+        Returns:
+            FeatureMatrix: Selected matrix.
+        """
+        rows = self._indexer(samples, self.samples.index)
+        cols = self._indexer(features, self.features.index)
+
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            values = self.values[rows, cols]
+        else:
+            values = self.values[np.ix_(rows, cols)]
+        return FeatureMatrix(values, self.features.iloc[cols], self.samples.iloc[rows])
+
+    def to_dataframe(self, include_samples=True):
+        """
+        Convert to the wide DataFrame used by the tools.py functions.
+
+        Parameters:
+            include_samples (bool, optional): Add the sample metadata columns after the features. Defaults to True.
+
+        Returns:
+            DataFrame: Samples x features DataFrame sharing the intensity memory of the matrix.
+        """
+        data = pd.DataFrame(self.values, index=self.samples.index.copy(), columns=self.features.index.copy(),
+                            copy=False)
+        data.index.name = 'sample_name'
+        data.columns.name = 'metabolite'
+        if include_samples:
+            for col in self.samples.columns:
+                data[col] = self.samples[col].to_numpy()
+        return data
@@ -0,0 +1,234 @@
+import argparse
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from instrument import traced
+from tools import read_file, numeric_metabolite_columns, save_data
+
+IMPUTATION_METHODS = ('half_min', 'group_median', 'knn')
+
+# Neighbour order of the samples, cached once per worker process
+_KNN_DATA = {}
+
+
+def _missing_mask(values, zero_as_missing):
+    missing = ~np.isfinite(values)
+    if zero_as_missing:
+        missing |= values == 0
+    return missing
+
+
+def half_minimum(values, missing):
+    """
+    Half of the smallest observed value of every feature.
+
+    Parameters:
+        values (ndarray): Intensity matrix (samples x features).
+        missing (ndarray of bool): Missing values.
+
+    Returns:
+        ndarray: One value per feature (NaN for the features without observed values).
+    """
+    observed = np.where(missing, np.inf, values)
+    minimum = observed.min(axis=0)
+    return np.where(np.isfinite(minimum), minimum / 2, np.nan)
+
+
+def group_medians(values, missing, groups):
+    """
+    Median of the observed values of every feature in every group of samples.
+
+    Parameters:
+        values (ndarray): Intensity matrix (samples x features).
+        missing (ndarray of bool): Missing values.
+        groups (ndarray): Group label of every sample.
+
+    Returns:
+        ndarray: Median of the group of every sample (samples x features, NaN when the group has no observed
+        value).
+    """
+    medians = np.full(values.shape, np.nan, dtype=np.float64)
+    observed = np.where(missing, np.nan, values)
+    for group in pd.unique(groups):
+        rows = groups == group
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            medians[rows] = np.nanmedian(observed[rows], axis=0)
+    return medians
+
+
+def _standardized_block(values, missing):
+    # Autoscaled observed values (0 where missing) and the float32 observed mask of a feature block
+    values = np.where(missing, np.nan, values.astype(np.float64))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0)
+    std[~(std > 0)] = 1.0
+    scaled = np.nan_to_num((values - mean) / std).astype(np.float32)
+    return scaled, (~missing).astype(np.float32)
+
+
+def _distance_block(values, missing):
+    # Squared distances over the features observed in both samples, and the number of such features
+    scaled, observed = _standardized_block(values, missing)
+    squared = scaled * scaled
+    distances = squared @ observed.T + observed @ squared.T - 2 * (scaled @ scaled.T)
+    return distances.astype(np.float64), (observed @ observed.T).astype(np.float64)
+
+
+def _init_knn_worker(neighbours, n_neighbors):
+    _KNN_DATA.clear()
+    _KNN_DATA['neighbours'] = neighbours
+    _KNN_DATA['n_neighbors'] = n_neighbors
+
+
+def _knn_block(values, missing):
+    # Mean of the n_neighbors nearest samples where the feature is observed, for every missing value
+    neighbours = _KNN_DATA['neighbours']
+    n_neighbors = _KNN_DATA['n_neighbors']
+    imputed = values.astype(np.float64)
+    observed = ~missing
+    for sample in np.flatnonzero(missing.any(axis=1)):
+        columns = np.flatnonzero(missing[sample])
+        order = neighbours[sample]
+        order_observed = observed[np.ix_(order, columns)]
+        # First n_neighbors observed values along the neighbour order
+        selected = order_observed & (np.cumsum(order_observed, axis=0) <= n_neighbors)
+        counts = selected.sum(axis=0)
+        totals = np.where(selected, values[np.ix_(order, columns)], 0).sum(axis=0, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            imputed[sample, columns] = np.where(counts > 0, totals / counts, np.nan)
+    return imputed
+
+
+def _run_blocks(function, blocks, values, missing, workers, initializer=None, initargs=()):
+    if workers <= 1 or len(blocks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = [function(values[:, block], missing[:, block]) for block in blocks]
+        _KNN_DATA.clear()
+        return results
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        futures = [executor.submit(function, np.ascontiguousarray(values[:, block]),
+                                   np.ascontiguousarray(missing[:, block])) for block in blocks]
+        return [future.result() for future in futures]
+
+
+def knn_neighbours(values, missing, block_size=2048, workers=None):
+    """
+    Samples ordered by nan-euclidean distance to every sample.
+
+    Distances are computed on the autoscaled features (so that the most intense features do not dominate),
+    over the features observed in both samples and rescaled to all the features (as sklearn nan_euclidean).
+    Each feature block adds its float32 samples x samples partial sums, so there is no samples x samples x
+    features intermediate; blocks are distributed over a process pool.
+
+    Parameters:
+        values (ndarray): Intensity matrix (samples x features).
+        missing (ndarray of bool): Missing values.
+        block_size (int, optional): Number of features per task. Defaults to 2048.
+        workers (int, optional): Number of worker processes. Default is None (all CPUs).
+
+    Returns:
+        ndarray: Sample positions by increasing distance (samples x samples - 1, the sample itself excluded).
+    """
+    blocks = [slice(start, start + block_size) for start in range(0, values.shape[1], block_size)]
+    distances = np.zeros((len(values), len(values)))
+    shared = np.zeros((len(values), len(values)))
+    for block_distances, block_shared in _run_blocks(_distance_block, blocks, values, missing,
+                                                     workers or os.cpu_count()):
+        distances += block_distances
+        shared += block_shared
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        distances = np.sqrt(np.clip(distances, 0, None) * values.shape[1] / shared)
+    distances[~(shared > 0)] = np.inf
+    np.fill_diagonal(distances, -np.inf)
+    return np.argsort(distances, axis=1, kind='stable')[:, 1:]
+
+
+@traced
+def impute(data, method='half_min', feature_columns=None, group_column='Condition', n_neighbors=5,
+           zero_as_missing=True, block_size=2048, workers=None):
+    """
+    Impute the missing intensities (zeros and NaN, e.g. from the outer joins of merge_data).
+
+    Methods:
+        'half_min': half of the smallest observed value of the feature.
+        'group_median': median of the observed values of the feature in the group of the sample
+            (group_column), half_min when the group has no observed value.
+        'knn': mean of the n_neighbors nearest samples (knn_neighbours) where the feature is observed,
+            half_min when no sample has it. Feature blocks are distributed over a process pool.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame (metadata columns are kept unchanged).
+        method (str, optional): 'half_min', 'group_median' or 'knn'. Defaults to 'half_min'.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        group_column (str, optional): Group column of 'group_median'. Defaults to 'Condition'.
+        n_neighbors (int, optional): Number of neighbours of 'knn'. Defaults to 5.
+        zero_as_missing (bool, optional): Impute the zero intensities too. Defaults to True.
+        block_size (int, optional): Number of features per task of 'knn'. Defaults to 2048.
+        workers (int, optional): Number of worker processes of 'knn'. Default is None (all CPUs); 1 runs in
+            process.
+
+    Returns:
+        DataFrame: Imputed copy of data.
+    """
+    if method not in IMPUTATION_METHODS:
+        raise ValueError(f"Unsupported method. Supported methods: {', '.join(IMPUTATION_METHODS)}.")
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+
+    values = data[feature_columns].to_numpy()
+    dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+    # Observed values keep the input dtype (only the knn distance blocks are float32)
+    values = values.astype(dtype, copy=False)
+    missing = _missing_mask(values, zero_as_missing)
+    fallback = half_minimum(values, missing)
+
+    if method == 'half_min':
+        imputed = np.where(missing, fallback, values)
+    elif method == 'group_median':
+        if group_column not in data.columns:
+            raise ValueError(f"Group column '{group_column}' not found.")
+        medians = group_medians(values, missing, data[group_column].to_numpy())
+        imputed = np.where(missing, np.where(np.isnan(medians), fallback, medians), values)
+    else:
+        workers = workers or os.cpu_count()
+        neighbours = knn_neighbours(values, missing, block_size, workers)
+        blocks = [slice(start, start + block_size) for start in range(0, len(feature_columns), block_size)]
+        imputed = np.concatenate(_run_blocks(_knn_block, blocks, values, missing, workers, _init_knn_worker,
+                                             (neighbours, n_neighbors)), axis=1)
+        imputed = np.where(np.isnan(imputed) & missing, fallback, imputed)
+
+    # Features without any observed value keep their original values
+    imputed = np.where(np.isnan(imputed), values, imputed).astype(dtype, copy=False)
+    n_imputed = int((missing & ~np.isnan(fallback)).sum())
+    print(f"{n_imputed} missing values imputed ({method}).")
+
+    other_columns = [col for col in data.columns if col not in set(feature_columns)]
+    result = pd.concat([pd.DataFrame(imputed, index=data.index, columns=feature_columns, copy=False),
+                        data[other_columns]], axis=1)
+    return result[data.columns]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Impute the missing intensities of a filtered data file.")
+    parser.add_argument('input', help="Filtered data file (e.g. POS-manipulated.csv).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='imputed', help="Output file name (without extension).")
+    parser.add_argument('--sep', default=';', help="Separator of the input file.")
+    parser.add_argument('--method', default='half_min', choices=IMPUTATION_METHODS, help="Imputation method.")
+    parser.add_argument('--group-column', default='Condition', help="Group column of group_median.")
+    parser.add_argument('--neighbors', type=int, default=5, help="Number of neighbours of knn.")
+    parser.add_argument('--workers', type=int, help="Number of worker processes of knn.")
+    parser.add_argument('--file-format', default='csv', help="Output format (csv, parquet, feather, hdf5).")
+    args = parser.parse_args()
+
+    input_data = read_file(args.input, sep=args.sep)
+    imputed_data = impute(input_data, args.method, group_column=args.group_column, n_neighbors=args.neighbors,
+                          workers=args.workers)
+    save_data(imputed_data, args.output_dir, args.output_file, file_conflict='replace', file_format=args.file_format)
@@ -0,0 +1,332 @@
+import argparse
+import fnmatch
+import json
+import os
+import tempfile
+import time
+from collections import deque
+import pandas as pd
+from MSDial import console_command, prepare_shard_input, run_shard
+from feature_alignment import DEFAULT_PPM, DEFAULT_RT_TOLERANCE, FeatureIndex
+from tools import (read_file, transpose_data, filter_rows, attach_metadata, filter_column, qc_filter, save_data,
+                   OUTPUT_FORMATS)
+
+STATE_FILE = 'ingest-state.json'
+
+# Exports matching less than this fraction of the output features are not appended
+DEFAULT_MIN_MATCHED = 0.5
+
+
+def load_state(state_dir):
+    """
+    Load the ingestion state (processed files and output layout of each dataset).
+
+    Parameters:
+        state_dir (str): State directory.
+
+    Returns:
+        dict: State with 'processed' (path -> size, mtime) and 'outputs' (dataset -> columns, samples and
+        features, the m/z and retention time of every feature column).
+    """
+    state_path = os.path.join(state_dir, STATE_FILE)
+    if not os.path.exists(state_path):
+        return {'processed': {}, 'outputs': {}}
+    with open(state_path, 'r', encoding='utf-8') as handle:
+        return json.load(handle)
+
+
+def save_state(state_dir, state):
+    """
+    Save the ingestion state atomically.
+
+    Parameters:
+        state_dir (str): State directory.
+        state (dict): State (see load_state).
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+        json.dump(state, handle, indent=1)
+    os.replace(tmp_path, os.path.join(state_dir, STATE_FILE))
+
+
+def scan_directory(directory, pattern):
+    """
+    List the files of a directory tree matching a pattern.
+
+    Parameters:
+        directory (str): Directory to scan (recursively).
+        pattern (str): File name pattern (case insensitive).
+
+    Returns:
+        dict: path -> (size, mtime) of the matching files.
+    """
+    found = {}
+    if not os.path.isdir(directory):
+        return found
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if fnmatch.fnmatch(name.lower(), pattern.lower()):
+                path = os.path.abspath(os.path.join(root, name))
+                stat = os.stat(path)
+                found[path] = (stat.st_size, stat.st_mtime)
+    return found
+
+
+def new_files(found, state, settle_seconds):
+    """
+    Select the files not processed yet and not modified for settle_seconds (acquisition or export finished).
+
+    Parameters:
+        found (dict): Result of scan_directory.
+        state (dict): Ingestion state.
+        settle_seconds (float): Minimum age of the last modification.
+
+    Returns:
+        list: Paths of the files to process, oldest first.
+    """
+    now = time.time()
+    ready = []
+    for path, (size, mtime) in found.items():
+        record = state['processed'].get(path)
+        if record is not None and record == [size, mtime]:
+            continue
+        if now - mtime >= settle_seconds:
+            ready.append((mtime, path))
+    return [path for _, path in sorted(ready)]
+
+
+def _mark_processed(state, paths):
+    for path in paths:
+        stat = os.stat(path)
+        state['processed'][path] = [stat.st_size, stat.st_mtime]
+
+
+def process_acquisitions(config, dataset_name, files):
+    """
+    Run MS-DIAL on newly acquired mzML files only.
+
+    The files are linked in a batch input folder and processed into '<export_dir>/batch-<time>', where the
+    export is picked up by the next scan.
+
+    Parameters:
+        config (dict): Ingestion configuration.
+        dataset_name (str): Dataset name.
+        files (list): New mzML files.
+
+    Returns:
+        bool: True if MS-DIAL succeeded.
+    """
+    dataset = config['datasets'][dataset_name]
+    msdial = config['msdial']
+    batch = time.strftime('batch-%Y%m%d-%H%M%S')
+    input_dir = prepare_shard_input(files, os.path.join(config['state_dir'], 'mzml', dataset_name, batch))
+    output_dir = os.path.join(dataset['export_dir'], batch)
+    job = {
+        'name': f'{dataset_name}-{batch}',
+        'command': console_command(msdial['executable'], msdial.get('mode', 'lcmsdda'), input_dir, output_dir,
+                                   dataset['method_file']),
+        'output_dir': output_dir,
+        'log_path': os.path.join(config['state_dir'], f'{dataset_name}-{batch}.log'),
+    }
+    result = run_shard(job, retries=msdial.get('retries', 1))
+    print(f"[{dataset_name}] MS-DIAL on {len(files)} new file(s): {'ok' if result['ok'] else 'FAILED'}")
+    return result['ok']
+
+
+def match_output_features(alignment, output, ppm=DEFAULT_PPM, rt_tolerance=DEFAULT_RT_TOLERANCE):
+    """
+    Match the features of a new alignment export to the feature columns of an existing output.
+
+    Every export of new acquisitions comes from its own MS-DIAL alignment, so the same feature has slightly
+    different m/z and retention time (and 'M<mz>T<rt>' name) in each export: features are matched one-to-one
+    within ppm and rt_tolerance (feature_alignment.FeatureIndex) and renamed to the output columns. Outputs
+    written before the features were recorded in the state are matched by exact name.
+
+    Parameters:
+        alignment (DataFrame): Alignment export with 'Rt(min)', 'Mz' and 'metabolite' columns.
+        output (dict): Output layout of the dataset in the ingestion state.
+        ppm (float, optional): m/z tolerance in ppm. Defaults to DEFAULT_PPM.
+        rt_tolerance (float, optional): Retention time tolerance (minutes). Defaults to DEFAULT_RT_TOLERANCE.
+
+    Returns:
+        DataFrame: Matched rows of alignment, 'metabolite' renamed to the output feature names.
+    """
+    features = output.get('features')
+    if features is None:
+        return alignment[alignment['metabolite'].isin(output['columns'])]
+
+    names = list(features)
+    index = FeatureIndex([features[name][0] for name in names], [features[name][1] for name in names])
+    matches = index.match(alignment['Mz'].to_numpy(), alignment['Rt(min)'].to_numpy(), ppm, rt_tolerance)
+    matched = alignment[matches >= 0].copy()
+    matched['metabolite'] = [names[position] for position in matches[matches >= 0]]
+    return matched
+
+
+def process_export(config, dataset_name, export_path, state):
+    """
+    Run the tools.py chain on a new alignment export and update the dataset output.
+
+    The first export creates the output with the full QC filtering (qc_filter), and its feature m/z and
+    retention times are recorded in the state. Later exports only add their new samples: their features are
+    matched to the output features within m/z and retention time tolerances (match_output_features; features
+    missing from the export are left empty) and appended with save_data, so the cost depends on the new data
+    only. An export matching less than 'min_matched' (fraction of the output features, default
+    DEFAULT_MIN_MATCHED) of the output features is not appended.
+
+    Parameters:
+        config (dict): Ingestion configuration.
+        dataset_name (str): Dataset name.
+        export_path (str): Alignment export (CSV).
+        state (dict): Ingestion state, updated with the output layout.
+
+    Returns:
+        int: Number of samples written.
+    """
+    dataset = config['datasets'][dataset_name]
+    cache_dir = os.path.join(config['state_dir'], 'cache')
+    output = state['outputs'].get(dataset_name)
+    metadata = read_file(dataset['metadata_file'], sep=';', encoding='latin-1', cache_dir=cache_dir)
+    metadata = filter_column(metadata, exclude=dataset.get('metadata_exclude', [])).set_index('sample_name')
+
+    alignment = read_file(export_path, sep=dataset.get('sep', ';'), streaming=True, add_metabolite=True)
+    if output is not None:
+        n_features = len([col for col in output['columns'] if col not in metadata.columns])
+        alignment = match_output_features(alignment, output, dataset.get('match_ppm', DEFAULT_PPM),
+                                          dataset.get('match_rt_tolerance', DEFAULT_RT_TOLERANCE))
+        matched = alignment['metabolite'].nunique()
+        print(f"[{dataset_name}] {matched} of {n_features} output features matched in "
+              f"{os.path.basename(export_path)}")
+        if matched < dataset.get('min_matched', DEFAULT_MIN_MATCHED) * n_features:
+            print(f"[{dataset_name}] Too few features matched: {os.path.basename(export_path)} not appended.")
+            return 0
+    positions = alignment.drop_duplicates('metabolite').set_index('metabolite')[['Mz', 'Rt(min)']]
+    data = transpose_data(alignment.drop(columns=['Rt(min)', 'Mz']), 'metabolite', dtype='float32')
+    if dataset.get('exclude_injections'):
+        data = filter_rows(data, exclude=dataset['exclude_injections'])
+
+    file_format = dataset.get('file_format', 'parquet')
+    if output is None:
+        data = attach_metadata(data, metadata)
+        data, _ = qc_filter(data, **dataset.get('qc', {}))
+        file_conflict = 'replace'
+        kept = positions.loc[positions.index.isin(data.columns)]
+        output = {'columns': [str(col) for col in data.columns], 'samples': [],
+                  'features': {str(name): [float(mz), float(rt)] for name, (mz, rt) in kept.iterrows()}}
+    else:
+        # Only the samples not written yet, on the feature columns of the existing output
+        data = data[~data.index.isin(output['samples'])]
+        if data.empty:
+            return 0
+        features = [col for col in output['columns'] if col not in metadata.columns]
+        data = attach_metadata(data.reindex(columns=features), metadata)[output['columns']]
+        file_conflict = 'append'
+
+    save_data(data, dataset['output_dir'], dataset['output_file'], file_conflict=file_conflict,
+              file_format=file_format)
+    output['samples'] = output['samples'] + [str(sample) for sample in data.index]
+    state['outputs'][dataset_name] = output
+    print(f"[{dataset_name}] {len(data)} sample(s) from {os.path.basename(export_path)} written to "
+          f"{dataset['output_file'] + OUTPUT_FORMATS[file_format]}")
+    return len(data)
+
+
+def ingest_once(config, state):
+    """
+    Scan the watched folders once and process the queued new files.
+
+    Parameters:
+        config (dict): Ingestion configuration.
+        state (dict): Ingestion state (updated).
+
+    Returns:
+        int: Number of processed files.
+    """
+    settle_seconds = config.get('settle_seconds', 60)
+    queue = deque()
+    # Acquisitions first: their MS-DIAL exports are queued by the next scan
+    for dataset_name, dataset in config['datasets'].items():
+        if dataset.get('mzml_dir'):
+            found = scan_directory(dataset['mzml_dir'], dataset.get('mzml_pattern', '*.mzML'))
+            files = new_files(found, state, settle_seconds)
+            if files:
+                queue.append(('acquisitions', dataset_name, files))
+    for dataset_name, dataset in config['datasets'].items():
+        found = scan_directory(dataset['export_dir'], dataset.get('export_pattern', '*.csv'))
+        for path in new_files(found, state, settle_seconds):
+            queue.append(('export', dataset_name, [path]))
+
+    processed = 0
+    while queue:
+        kind, dataset_name, files = queue.popleft()
+        if kind == 'acquisitions':
+            if not process_acquisitions(config, dataset_name, files):
+                # Left unprocessed: retried at the next scan
+                continue
+        else:
+            try:
+                process_export(config, dataset_name, files[0], state)
+            except Exception as error:
+                # Left unprocessed: the other files are still processed, this one is retried at the next scan
+                print(f"[{dataset_name}] Processing of {files[0]} failed: {error}")
+                continue
+        _mark_processed(state, files)
+        save_state(config['state_dir'], state)
+        processed += len(files)
+    return processed
+
+
+def mark_existing(config, state):
+    """
+    Record the files already in the watched folders as processed (start watching an existing study).
+
+    Parameters:
+        config (dict): Ingestion configuration.
+        state (dict): Ingestion state (updated).
+    """
+    for dataset in config['datasets'].values():
+        found = {}
+        if dataset.get('mzml_dir'):
+            found.update(scan_directory(dataset['mzml_dir'], dataset.get('mzml_pattern', '*.mzML')))
+        found.update(scan_directory(dataset['export_dir'], dataset.get('export_pattern', '*.csv')))
+        _mark_processed(state, found)
+    save_state(config['state_dir'], state)
+
+
+def watch(config, once=False):
+    """
+    Watch the input folders and ingest new acquisitions and exports as they arrive.
+
+    Parameters:
+        config (dict or str): Ingestion configuration or path to its JSON file.
+        once (bool, optional): Scan once and return (for scheduled runs). Defaults to False.
+    """
+    if isinstance(config, str):
+        with open(config, 'r', encoding='utf-8') as handle:
+            config = json.load(handle)
+    state = load_state(config['state_dir'])
+
+    while True:
+        processed = ingest_once(config, state)
+        if processed:
+            print(f"{processed} new file(s) processed.")
+        if once:
+            return
+        time.sleep(config.get('interval', 60))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental ingestion of new acquisitions and MS-DIAL exports.")
+    parser.add_argument('config', help="Ingestion configuration file (JSON).")
+    parser.add_argument('--once', action='store_true', help="Scan once and exit.")
+    parser.add_argument('--mark-existing', action='store_true',
+                        help="Record the files already present as processed, then exit.")
+    args = parser.parse_args()
+
+    if args.mark_existing:
+        with open(args.config, 'r', encoding='utf-8') as handle:
+            ingest_config = json.load(handle)
+        mark_existing(ingest_config, load_state(ingest_config['state_dir']))
+    else:
+        watch(args.config, once=args.once)
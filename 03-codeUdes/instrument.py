@@ -0,0 +1,240 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from multiprocessing import util
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Trace settings (see enable_trace); LCMS_TRACE=<output file> enables tracing at import
+_STATE = {'enabled': False, 'path': None, 'format': 'json', 'memory': 'rss', 'events': [], 'origin': None,
+          'pid': None}
+_LOCAL = threading.local()
+
+
+def _rss_bytes():
+    # Current and peak resident memory of the process (peak: None where the platform does not report it)
+    rss, peak = None, None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        # peak_wset: Windows only
+        rss, peak = info.rss, getattr(info, 'peak_wset', None)
+    if peak is None and resource is not None:
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return rss, peak
+
+
+def _shape(value):
+    if isinstance(value, tuple):
+        value = next((item for item in value if hasattr(item, 'shape')), None)
+    shape = getattr(value, 'shape', None)
+    return list(shape) if shape is not None else None
+
+
+def _feature_count(value):
+    if isinstance(value, tuple):
+        value = next((item for item in value if hasattr(item, 'columns')), None)
+    columns = getattr(value, 'columns', None)
+    if columns is None:
+        return None
+    return sum(1 for col in columns if str(col).startswith('M'))
+
+
+def enable_trace(path=None, trace_format='json', memory='rss'):
+    """
+    Enable the tracing of the @traced functions (tools.py steps).
+
+    Tracing is also enabled at import when the LCMS_TRACE environment variable is set to an output file
+    (LCMS_TRACE_FORMAT and LCMS_TRACE_MEMORY set the other parameters). Worker processes write their own
+    file, suffixed with their process id.
+
+    Parameters:
+        path (str, optional): Output file, written at exit. Default is None (use write_trace).
+        trace_format (str, optional): 'json' (list of step records) or 'chrome' (chrome://tracing and
+            Perfetto format). Defaults to 'json'.
+        memory (str, optional): 'rss' (resident memory after each step and process peak, cheap) or
+            'tracemalloc' (peak of the Python and NumPy allocations above the memory in use when the step
+            starts, measured from the start of the top-level step; slower). Defaults to 'rss'.
+    """
+    if trace_format not in ('json', 'chrome'):
+        raise ValueError("Unsupported trace format. Supported formats are 'json' and 'chrome'.")
+    if memory not in ('rss', 'tracemalloc'):
+        raise ValueError("Unsupported memory mode. Supported modes are 'rss' and 'tracemalloc'.")
+    _STATE.update(enabled=True, path=path, format=trace_format, memory=memory, events=[],
+                  origin=time.perf_counter(), pid=None)
+    if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_trace():
+    """
+    Disable tracing (the recorded steps are kept until the next enable_trace).
+    """
+    _STATE['enabled'] = False
+
+
+def trace_events():
+    """
+    Steps recorded since tracing was enabled.
+
+    Returns:
+        list: One dict per call: name, start and seconds, depth, input/output shapes, rows_removed,
+        features_removed (columns starting with "M"; negative when the step adds features, e.g. transpose_data),
+        memory fields and error (exception name of a failed call, whose output_shape is None).
+    """
+    return list(_STATE['events'])
+
+
+def traced(function):
+    """
+    Decorator recording the calls of a function when tracing is enabled (see enable_trace).
+
+    When tracing is disabled the only cost is one flag check per call.
+
+    Parameters:
+        function (callable): Function to trace.
+
+    Returns:
+        callable: Wrapped function.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _STATE['enabled']:
+            return function(*args, **kwargs)
+        return _traced_call(function, args, kwargs)
+    return wrapper
+
+
+def _start_process_trace():
+    # First traced call of a process (main process or multiprocessing worker): own event list and exit hook
+    _STATE.update(pid=os.getpid(), events=[])
+    if _STATE['path'] is not None:
+        # Finalizers run at exit in the main process and in multiprocessing workers (which skip atexit)
+        util.Finalize(None, _write_at_exit, exitpriority=100)
+
+
+def _traced_call(function, args, kwargs):
+    if _STATE['pid'] != os.getpid():
+        _start_process_trace()
+    data = args[0] if args else None
+    depth = getattr(_LOCAL, 'depth', 0)
+    event = {'name': function.__name__, 'depth': depth, 'input_shape': _shape(data), 'output_shape': None}
+    features_before = _feature_count(data)
+
+    use_tracemalloc = _STATE['memory'] == 'tracemalloc' and tracemalloc.is_tracing()
+    if use_tracemalloc:
+        if depth == 0:
+            tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    _LOCAL.depth = depth + 1
+    try:
+        result = function(*args, **kwargs)
+    except BaseException as error:
+        # Recorded as failed; the exception is raised unchanged
+        event['error'] = type(error).__name__
+        raise
+    finally:
+        _LOCAL.depth = depth
+        end = time.perf_counter()
+        event['start'] = start - _STATE['origin']
+        event['seconds'] = end - start
+        event['thread'] = threading.get_ident()
+        if use_tracemalloc:
+            event['peak_mb'] = (tracemalloc.get_traced_memory()[1] - traced_before) / 2 ** 20
+        else:
+            rss, peak = _rss_bytes()
+            event['rss_mb'] = rss / 2 ** 20 if rss is not None else None
+            event['peak_rss_mb'] = peak / 2 ** 20 if peak is not None else None
+        _STATE['events'].append(event)
+
+    event['output_shape'] = _shape(result)
+    input_shape, output_shape = event['input_shape'], event['output_shape']
+    # Row attrition only for steps that do not add columns (a transposition is not a row filter)
+    if input_shape and output_shape and len(input_shape) == len(output_shape) == 2 and \
+            output_shape[1] <= input_shape[1]:
+        event['rows_removed'] = input_shape[0] - output_shape[0]
+    features_after = _feature_count(result)
+    if features_before is not None and features_after is not None:
+        event['features_removed'] = features_before - features_after
+    return result
+
+
+def write_trace(path, trace_format=None):
+    """
+    Write the recorded steps.
+
+    Parameters:
+        path (str): Output file.
+        trace_format (str, optional): 'json' or 'chrome'. Default is None (format given to enable_trace).
+
+    Returns:
+        str: path
+    """
+    trace_format = trace_format or _STATE['format']
+    events = trace_events()
+    if trace_format == 'chrome':
+        pid = os.getpid()
+        payload = {'traceEvents': [{
+            'name': event['name'], 'cat': 'tools', 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+            'ts': event['start'] * 1e6, 'dur': event['seconds'] * 1e6,
+            'args': {key: value for key, value in event.items() if key not in ('name', 'start', 'seconds', 'thread')},
+        } for event in events], 'displayTimeUnit': 'ms'}
+    else:
+        payload = {'pid': os.getpid(), 'steps': events}
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as handle:
+        json.dump(payload, handle, indent=1)
+    return path
+
+
+def _write_at_exit():
+    path = _STATE['path']
+    if path is None or not _STATE['events']:
+        return
+    # Worker processes write next to the main trace file
+    if os.getpid() != int(os.environ.get('LCMS_TRACE_PID', os.getpid())):
+        root, ext = os.path.splitext(path)
+        path = f'{root}.{os.getpid()}{ext}'
+    write_trace(path)
+
+
+def print_trace_summary():
+    """
+    Print the recorded top-level steps: time, memory, shapes and removed rows/features.
+    """
+    for event in trace_events():
+        if event['depth'] != 0:
+            continue
+        memory = next((event[key] for key in ('peak_mb', 'rss_mb', 'peak_rss_mb') if event.get(key) is not None), None)
+        memory = f"{memory:8.1f} MB" if memory is not None else '       - MB'
+        removed = ''
+        if event.get('features_removed', 0) > 0:
+            removed += f" -{event['features_removed']} features"
+        if event.get('rows_removed', 0) > 0:
+            removed += f" -{event['rows_removed']} rows"
+        output = f"FAILED ({event['error']})" if event.get('error') else event.get('output_shape')
+        print(f"{event['name']:40s} {event['seconds']:9.3f} s {memory} "
+              f"{event['input_shape']} -> {output}{removed}")
+
+
+if os.environ.get('LCMS_TRACE'):
+    os.environ.setdefault('LCMS_TRACE_PID', str(os.getpid()))
+    enable_trace(os.environ['LCMS_TRACE'], os.environ.get('LCMS_TRACE_FORMAT', 'json'),
+                 os.environ.get('LCMS_TRACE_MEMORY', 'rss'))
@@ -0,0 +1,269 @@
+import os
+import pandas as pd
+from predicates import row_mask
+from tools import (ALIGNMENT_FEATURE_COLUMNS, read_file, infer_sample_columns, metabolite_names,
+                   add_metabolite_column, filter_column, select_columns_with_metabolites_columns, filter_rows,
+                   transpose_data, merge_data, attach_metadata, blank_filter, cv_filter, QC_filter_with_zeros,
+                   save_data, save_as_csv)
+
+
+def _fuse_column_filters(steps):
+    # Neighbouring filter_column steps become one step with the same result
+    fused = []
+    for step in steps:
+        if not fused or step[0] != 'filter_column' or fused[-1][0] != 'filter_column':
+            fused.append(step)
+            continue
+        previous, current = fused[-1][3], step[3]
+        if previous.get('exclude') is not None and current.get('exclude') is not None:
+            kwargs = {'exclude': list(previous['exclude']) +
+                      [col for col in current['exclude'] if col not in previous['exclude']]}
+        elif previous.get('include') is not None and current.get('exclude') is not None:
+            kwargs = {'include': [col for col in previous['include'] if col not in set(current['exclude'])]}
+        elif previous.get('include') is not None and set(current['include']) <= set(previous['include']):
+            kwargs = {'include': list(current['include'])}
+        elif previous.get('exclude') is not None and not set(current['include']) & set(previous['exclude']):
+            kwargs = {'include': list(current['include'])}
+        else:
+            fused.append(step)
+            continue
+        fused[-1] = ('filter_column', filter_column, (), kwargs)
+    return fused
+
+
+def _format_step(name, args, kwargs):
+    parameters = [repr(arg) if not isinstance(arg, pd.DataFrame) else f'<DataFrame {arg.shape}>' for arg in args]
+    parameters += [f'{key}={value!r}' if not isinstance(value, pd.DataFrame) else f'{key}=<DataFrame {value.shape}>'
+                   for key, value in kwargs.items()]
+    return f"{name}({', '.join(parameters)})"
+
+
+class LazyFrame:
+    """
+    Lazy chain of tools.py steps on a file, built with read_file(..., lazy=True).
+
+    Every method adds a step to the plan and returns a new LazyFrame; nothing is read before collect (or
+    save_data / save_as_csv). The plan is optimized first (see optimize):
+        - neighbouring filter_column steps are fused;
+        - add_metabolite_column and the column exclusions at the start of the plan are pushed into the
+          reader, so the excluded columns are never parsed;
+        - filter_rows steps after transpose_data whose conditions only use the sample names (and the
+          attached metadata) are pushed into the reader as excluded sample columns, e.g. the blank and
+          internal standard injections.
+    Pushdown is done for CSV files only; other formats are read whole and the steps run in order.
+
+    Attributes:
+        file_path (str): Input file.
+        read_options (dict): read_file parameters.
+        steps (tuple): (name, function, args, kwargs) of every step, in order.
+    """
+
+    def __init__(self, file_path, steps=(), **read_options):
+        self.file_path = file_path
+        self.read_options = read_options
+        self.steps = tuple(steps)
+
+    def __repr__(self):
+        return f'LazyFrame({self.file_path!r}, {len(self.steps)} steps)'
+
+    def _then(self, name, function, *args, **kwargs):
+        return LazyFrame(self.file_path, self.steps + ((name, function, args, kwargs),), **self.read_options)
+
+    # Plan steps (same parameters as the tools.py functions)
+
+    def add_metabolite_column(self, mz_decimals=None):
+        return self._then('add_metabolite_column', add_metabolite_column, mz_decimals=mz_decimals)
+
+    def filter_column(self, include=None, exclude=None):
+        if include is None and exclude is None:
+            raise ValueError("Either 'include' or 'exclude' must be provided.")
+        if include is not None and exclude is not None:
+            raise ValueError("Only one of 'include' or 'exclude' should be provided.")
+        if include is not None:
+            return self._then('filter_column', filter_column, include=list(include))
+        return self._then('filter_column', filter_column, exclude=list(exclude))
+
+    def select_columns_with_metabolites_columns(self, list_columns=None):
+        return self._then('select_columns_with_metabolites_columns', select_columns_with_metabolites_columns,
+                          list_columns=list_columns)
+
+    def filter_rows(self, include=None, exclude=None):
+        return self._then('filter_rows', filter_rows, include=include, exclude=exclude)
+
+    def transpose_data(self, metabolite_column, dtype=None):
+        return self._then('transpose_data', transpose_data, metabolite_column=metabolite_column, dtype=dtype)
+
+    def merge_data(self, other):
+        return self._then('merge_data', merge_data, other)
+
+    def attach_metadata(self, metadata, strict=False):
+        return self._then('attach_metadata', attach_metadata, metadata, strict=strict)
+
+    def blank_filter(self, **kwargs):
+        return self._then('blank_filter', blank_filter, **kwargs)
+
+    def cv_filter(self, raw_list, threshold=20, operation="<="):
+        return self._then('cv_filter', cv_filter, raw_list, threshold=threshold, operation=operation)
+
+    def QC_filter_with_zeros(self, threshold=0.75):
+        return self._then('QC_filter_with_zeros', QC_filter_with_zeros, threshold=threshold)
+
+    def pipe(self, function, *args, **kwargs):
+        """
+        Add any function called as function(data, *args, **kwargs) returning a DataFrame. Nothing is pushed
+        through a pipe step.
+        """
+        return self._then(getattr(function, '__name__', 'pipe'), function, *args, **kwargs)
+
+    # Optimization and execution
+
+    def _pushdown_supported(self):
+        return os.path.splitext(self.file_path)[1].lower() == '.csv' and not os.path.isdir(self.file_path)
+
+    def _header(self):
+        return pd.read_csv(self.file_path, sep=self.read_options.get('sep', ';'),
+                           encoding=self.read_options.get('encoding', 'utf-8'), nrows=0).columns.tolist()
+
+    def optimize(self):
+        """
+        Optimized plan.
+
+        Returns:
+            tuple: (reader parameters dict with 'exclude' and 'add_metabolite', remaining steps list)
+        """
+        steps = _fuse_column_filters(list(self.steps))
+        exclude = list(self.read_options.get('exclude') or [])
+        add_metabolite = self.read_options.get('add_metabolite', False)
+        if not self._pushdown_supported():
+            return {'exclude': exclude, 'add_metabolite': add_metabolite}, steps
+        header = self._header()
+
+        def _push(columns):
+            exclude.extend(col for col in columns if col not in exclude)
+            # Columns already excluded at read time are removed from the remaining include lists
+            for index, (name, function, args, kwargs) in enumerate(steps[:position]):
+                if name == 'filter_column' and kwargs.get('include') is not None:
+                    steps[index] = (name, function, args,
+                                    {'include': [col for col in kwargs['include'] if col not in set(exclude)]})
+
+        # Column steps at the start of the plan (one row per feature): pushed into the reader
+        position = 0
+        while position < len(steps):
+            name, function, args, kwargs = steps[position]
+            if name == 'add_metabolite_column' and kwargs.get('mz_decimals') is None and not add_metabolite \
+                    and 'metabolite' not in header and position == 0 \
+                    and not set(ALIGNMENT_FEATURE_COLUMNS) & set(exclude):
+                add_metabolite = True
+                steps.pop(position)
+            elif name == 'filter_column' and kwargs.get('exclude') is not None:
+                _push([col for col in kwargs['exclude'] if col in header])
+                residual = [col for col in kwargs['exclude'] if col not in header]
+                if residual:
+                    steps[position] = (name, function, args, {'exclude': residual})
+                    position += 1
+                else:
+                    steps.pop(position)
+            elif name == 'filter_column':
+                # The include step is kept for the column order
+                _push([col for col in header if col not in set(kwargs['include'])])
+                position += 1
+            else:
+                break
+
+        # Sample rows removed after the transposition: pushed into the reader as excluded sample columns
+        if position < len(steps) and steps[position][0] == 'transpose_data':
+            transpose = steps[position][3]
+            rows = [col for col in header if col not in exclude and col != transpose['metabolite_column']]
+            for name, _, _, kwargs in steps[:position]:
+                if name == 'filter_column' and kwargs.get('include') is not None:
+                    rows = [col for col in kwargs['include'] if col in set(rows)]
+            if transpose['dtype'] is not None:
+                numeric = set(infer_sample_columns(self.file_path, sep=self.read_options.get('sep', ';'),
+                                                   encoding=self.read_options.get('encoding', 'utf-8')))
+                rows = [col for col in rows if col in numeric]
+            probe = pd.DataFrame(index=pd.Index(rows, name='sample_name'))
+
+            current = position + 1
+            while current < len(steps):
+                name, function, args, kwargs = steps[current]
+                if name == 'attach_metadata':
+                    aligned = args[0].reindex(probe.index)
+                    for col in aligned.columns:
+                        probe[col] = aligned[col].to_numpy()
+                elif name == 'filter_column':
+                    if kwargs.get('exclude') is not None:
+                        probe = probe.drop(columns=[col for col in kwargs['exclude'] if col in probe.columns])
+                    else:
+                        probe = probe[[col for col in probe.columns if col in set(kwargs['include'])]]
+                elif name == 'filter_rows':
+                    try:
+                        mask = row_mask(probe, include=kwargs['include'], exclude=kwargs['exclude'])
+                    except Exception:
+                        # The condition needs more than the sample names (e.g. intensities): run on the data
+                        break
+                    _push(probe.index[~mask].tolist())
+                    probe = probe[mask]
+                    steps.pop(current)
+                    continue
+                else:
+                    break
+                current += 1
+
+        return {'exclude': exclude, 'add_metabolite': add_metabolite}, steps
+
+    def explain(self):
+        """
+        Optimized plan as text: the reader call, then the remaining steps.
+
+        Returns:
+            str: One line per step.
+        """
+        read_params, steps = self.optimize()
+        lines = [_format_step('read_file', (self.file_path,), {**self.read_options, **read_params})]
+        lines += ['  ' + _format_step(name, args, kwargs) for name, _, args, kwargs in steps]
+        return '\n'.join(lines)
+
+    def _read(self, exclude, add_metabolite):
+        options = {**self.read_options, 'exclude': exclude, 'add_metabolite': add_metabolite}
+        if not self._pushdown_supported() or options.get('streaming') or not (exclude or add_metabolite):
+            return read_file(self.file_path, **options)
+
+        # Non-streaming CSV: projected read with the default pandas dtypes
+        needed = ALIGNMENT_FEATURE_COLUMNS if add_metabolite else []
+        usecols = [col for col in self._header() if col not in exclude or col in needed]
+        data = pd.read_csv(self.file_path, sep=options.get('sep', ';'), encoding=options.get('encoding', 'utf-8'),
+                           usecols=usecols)
+        if add_metabolite:
+            data['metabolite'] = metabolite_names(data['Mz'], data['Rt(min)'])
+        return data.drop(columns=[col for col in usecols if col in exclude])
+
+    def collect(self):
+        """
+        Run the optimized plan.
+
+        Returns:
+            DataFrame: Result of the last step.
+        """
+        read_params, steps = self.optimize()
+        data = self._read(**read_params)
+        for _, function, args, kwargs in steps:
+            data = function(data, *args, **kwargs)
+        return data
+
+    def save_data(self, output_dir, output_file, **kwargs):
+        """
+        Run the plan and save the result (see tools.save_data).
+
+        Returns:
+            str: Path to the saved file, or None if saving is skipped.
+        """
+        return save_data(self.collect(), output_dir, output_file, **kwargs)
+
+    def save_as_csv(self, output_dir, output_file, file_conflict="skip"):
+        """
+        Run the plan and save the result as CSV (see tools.save_as_csv).
+
+        Returns:
+            str: Path to the saved CSV file, or None if saving is skipped.
+        """
+        return save_as_csv(self.collect(), output_dir, output_file, file_conflict=file_conflict)
@@ -1,4 +1,10 @@
 from tools import *
+from instrument import print_trace_summary
+from drift_correction import drift_correction
+from imputation import impute
+from normalization import normalize
+from feature_grouping import feature_table, collapse_feature_groups
+# step trace: run with LCMS_TRACE=<file.json> (LCMS_TRACE_FORMAT=chrome for chrome://tracing) to record time, memory and removed features of every step
 
 # INPUT FILES
 
@@ -9,71 +15,88 @@ metadataNEG = "D:/data/MSDial/02-Nico_metadata/TermoMetaData/thermoNEG.csv"
 outputPath = "D:/data/MSDial/05-codeOutput/Thermo_results/"
 outputPOSFile = 'POS-manipulated'
 outputNEGFile = 'NEG-manipulated'
+# parsed-file cache: unchanged inputs are loaded back from Parquet on re-runs
+cacheDir = os.path.join(outputPath, '.cache')
 
 
-## POS
+# the processing runs under the __main__ guard: the process pools (drift correction, knn imputation) start
+# their workers by re-importing this script on Windows
+if __name__ == '__main__':
 
-#data import
-dataPOS = read_file(inputPOSFile, sep = '\t')
-metadataPOSData = read_file(metadataPOS, sep = ';', encoding='latin-1' )
-#creating metabolite column start with M
-dataPOS = add_metabolite_column(dataPOS)
-excludDataPOS = ['Rt(min)', 'Mz']
-fdataPOS = filter_column(dataPOS, exclude = excludDataPOS)
-#transposing => metabolites as columns name
-tdataPOS = transpose_data(fdataPOS, 'metabolite')
-#exclud machine blc
-exludRaw = ["sample_name == 'blc'","sample_name == 'blc_20240403164953'","sample_name == 'blc_20240404121923'", "sample_name == 'blc_20240404124839'", "sample_name == 'istd_ode'"]
-ftdataPOS = filter_rows (tdataPOS,exclude=exludRaw)
-#metadata merging 
-excludDataPOS = ['id natif', 'class', 'injectionOrder']
-metadataPOSData = filter_column(metadataPOSData,exclude=excludDataPOS)
-metadataPOSData.set_index('sample_name', inplace = True)
-start_dataPOS = merge_data(ftdataPOS, metadataPOSData)
-# blank filtering 0 besed
-blank_filtered_dataPOS= blank_filter(start_dataPOS)
-# QC filtering: if 0 in 3/4 QC elimined
-QC_blank_filterPOS = QC_filter_with_zeros (blank_filtered_dataPOS, 0.75)
-# QCDil filtering CV <=10 elimined
-raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]
-QCDil_QC_blank_filterPOS = cv_filter (QC_blank_filterPOS, raw_list, 10, "<=")
-# metadata merging for filtered data
-QCDil_QC_blank_filterPOS = merge_data(QCDil_QC_blank_filterPOS, metadataPOSData)
-# caving in a csv
-output_pathPOS = save_as_csv(QCDil_QC_blank_filterPOS, output_dir=outputPath, output_file=outputPOSFile, file_conflict="replace")
-print("CSV file saved at:", output_pathPOS)
+    ## POS
 
+    #data import
+    metadataPOSData = read_file(metadataPOS, sep = ';', encoding='latin-1', cache_dir=cacheDir)
+    #metadata: sample_name as index
+    excludDataPOS = ['id natif', 'class']
+    metadataPOSData = filter_column(metadataPOSData,exclude=excludDataPOS)
+    metadataPOSData.set_index('sample_name', inplace = True)
+    #exclud machine blc
+    exludRaw = ["sample_name == 'blc'","sample_name == 'blc_20240403164953'","sample_name == 'blc_20240404121923'", "sample_name == 'blc_20240404124839'", "sample_name == 'istd_ode'"]
+    #lazy import (run at collect): metabolite column start with M built while reading, Rt/Mz and the excluded injections never parsed,
+    #transposing => metabolites as columns name (typed float32 matrix), metadata attaching (intensities not copied)
+    start_dataPOS = (read_file(inputPOSFile, sep = '\t', streaming=True, add_metabolite=True, cache_dir=cacheDir, lazy=True)
+                     .filter_column(exclude=['Rt(min)', 'Mz'])
+                     .transpose_data('metabolite', dtype='float32')
+                     .filter_rows(exclude=exludRaw)
+                     .attach_metadata(metadataPOSData)
+                     .collect())
+    # isotope/adduct grouping: co-eluting features at a 13C or adduct m/z shift with correlated intensities, most intense kept (only Rt/Mz parsed)
+    featuresPOS = feature_table(inputPOSFile, sep = '\t')
+    start_dataPOS, feature_groupsPOS = collapse_feature_groups(start_dataPOS, featuresPOS, polarity='positive')
+    # drift correction: per batch LOESS of every feature on the QC injections against injectionOrder (QC-RLSC)
+    start_dataPOS, drift_reportPOS = drift_correction(start_dataPOS, qc_rows="SampleType == 'QC'")
+    print(drift_reportPOS[['qc_cv_before', 'qc_cv_after']].median())
+    # blank filtering 0 besed, QC filtering: if 0 in 3/4 QC elimined, QCDil filtering CV <=10 elimined (single pass, metadata kept)
+    raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]
+    QCDil_QC_blank_filterPOS, QC_reportPOS = qc_filter(start_dataPOS, raw_list, zero_threshold=0.75, cv_threshold=10, cv_operation="<=")
+    print(QC_reportPOS['removed_by'].value_counts())
+    # sample normalization: probabilistic quotient against the QC reference spectrum ('tic', 'median', 'istd' also available)
+    QCDil_QC_blank_filterPOS, normalization_factorsPOS = normalize(QCDil_QC_blank_filterPOS, method='pqn', reference_rows="SampleType == 'QC'")
+    # missing values (zeros, NaN): half of the feature minimum ('group_median' and 'knn' also available)
+    QCDil_QC_blank_filterPOS = impute(QCDil_QC_blank_filterPOS, method='half_min')
+    # caving in a csv
+    output_pathPOS = save_as_csv(QCDil_QC_blank_filterPOS, output_dir=outputPath, output_file=outputPOSFile, file_conflict="replace")
+    print("CSV file saved at:", output_pathPOS)
 
 
 
-## NEG
 
-#data import
-dataNEG = read_file(inputNEGFile, sep = ';')
-metadataNEGData = read_file(metadataNEG, sep = ';', encoding='latin-1' )
-#creating metabolite column start with M
-dataNEG = add_metabolite_column(dataNEG)
-excludDataNEG = ['Rt(min)', 'Mz']
-fdataNEG = filter_column(dataNEG, exclude=excludDataNEG)
-#transposing => metabolites as columns name
-tdataNEG = transpose_data(fdataNEG, 'metabolite')
-#exclud machine blc
-exludRawNEG = ["sample_name == 'blc'","sample_name == 'blc_20240403164953'","sample_name == 'blc_20240404121923'", "sample_name == 'blc_20240404124839'", "sample_name == 'istd_ode'"]
-ftdataNEG = filter_rows (tdataNEG,exclude=exludRawNEG)
-#metadata merging 
-excludDataNEG = ['id natif', 'class', 'injectionOrder']
-metadataNEGData = filter_column(metadataNEGData,exclude=excludDataNEG)
-metadataNEGData.set_index('sample_name', inplace = True)
-start_dataNEG = merge_data(ftdataNEG, metadataNEGData)
-# blank filtering 0 besed
-blank_filtered_dataNEG= blank_filter(start_dataNEG)
-# QC filtering: if 0 in 3/4 QC elimined
-QC_blank_filterNEG = QC_filter_with_zeros (blank_filtered_dataNEG, 0.75)
-# QCDil filtering CV <=10 elimined
-raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]
-QCDil_QC_blank_filterNEG = cv_filter (QC_blank_filterNEG, raw_list, 10, "<=")
-# metadata merging for filtered data
-QCDil_QC_blank_filterNEG = merge_data(QCDil_QC_blank_filterNEG, metadataNEGData)
-# caving in a csv
-output_pathNEG = save_as_csv(QCDil_QC_blank_filterNEG, output_dir=outputPath, output_file=outputNEGFile, file_conflict="replace")
-print("CSV file saved at:", output_pathNEG)
\ No newline at end of file
+    ## NEG
+
+    #data import
+    metadataNEGData = read_file(metadataNEG, sep = ';', encoding='latin-1', cache_dir=cacheDir)
+    #metadata: sample_name as index
+    excludDataNEG = ['id natif', 'class']
+    metadataNEGData = filter_column(metadataNEGData,exclude=excludDataNEG)
+    metadataNEGData.set_index('sample_name', inplace = True)
+    #exclud machine blc
+    exludRawNEG = ["sample_name == 'blc'","sample_name == 'blc_20240403164953'","sample_name == 'blc_20240404121923'", "sample_name == 'blc_20240404124839'", "sample_name == 'istd_ode'"]
+    #lazy import (run at collect): metabolite column start with M built while reading, Rt/Mz and the excluded injections never parsed,
+    #transposing => metabolites as columns name (typed float32 matrix), metadata attaching (intensities not copied)
+    start_dataNEG = (read_file(inputNEGFile, sep = ';', streaming=True, add_metabolite=True, cache_dir=cacheDir, lazy=True)
+                     .filter_column(exclude=['Rt(min)', 'Mz'])
+                     .transpose_data('metabolite', dtype='float32')
+                     .filter_rows(exclude=exludRawNEG)
+                     .attach_metadata(metadataNEGData)
+                     .collect())
+    # isotope/adduct grouping: co-eluting features at a 13C or adduct m/z shift with correlated intensities, most intense kept (only Rt/Mz parsed)
+    featuresNEG = feature_table(inputNEGFile, sep = ';')
+    start_dataNEG, feature_groupsNEG = collapse_feature_groups(start_dataNEG, featuresNEG, polarity='negative')
+    # drift correction: per batch LOESS of every feature on the QC injections against injectionOrder (QC-RLSC)
+    start_dataNEG, drift_reportNEG = drift_correction(start_dataNEG, qc_rows="SampleType == 'QC'")
+    print(drift_reportNEG[['qc_cv_before', 'qc_cv_after']].median())
+    # blank filtering 0 besed, QC filtering: if 0 in 3/4 QC elimined, QCDil filtering CV <=10 elimined (single pass, metadata kept)
+    raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]
+    QCDil_QC_blank_filterNEG, QC_reportNEG = qc_filter(start_dataNEG, raw_list, zero_threshold=0.75, cv_threshold=10, cv_operation="<=")
+    print(QC_reportNEG['removed_by'].value_counts())
+    # sample normalization: probabilistic quotient against the QC reference spectrum ('tic', 'median', 'istd' also available)
+    QCDil_QC_blank_filterNEG, normalization_factorsNEG = normalize(QCDil_QC_blank_filterNEG, method='pqn', reference_rows="SampleType == 'QC'")
+    # missing values (zeros, NaN): half of the feature minimum ('group_median' and 'knn' also available)
+    QCDil_QC_blank_filterNEG = impute(QCDil_QC_blank_filterNEG, method='half_min')
+    # caving in a csv
+    output_pathNEG = save_as_csv(QCDil_QC_blank_filterNEG, output_dir=outputPath, output_file=outputNEGFile, file_conflict="replace")
+    print("CSV file saved at:", output_pathNEG)
+
+    if os.environ.get('LCMS_TRACE'):
+        print_trace_summary()
@@ -0,0 +1,436 @@
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from feature_matrix import FeatureMatrix
+from predicates import row_mask
+from tools import infer_sample_columns, metabolite_names, numeric_metabolite_columns, qc_feature_report, save_data
+
+MANIFEST_FILE = 'store.json'
+FEATURES_FILE = 'features.parquet'
+SAMPLES_FILE = 'samples.parquet'
+# Features per chunk file: a chunk of 1000 samples x 4096 features is 16 MB in float32
+DEFAULT_CHUNK_FEATURES = 4096
+
+# Stores opened by the worker processes of map_blocks, by path
+_OPEN_STORES = {}
+
+
+def _chunk_file(index):
+    return f'chunk-{index:05d}.npy'
+
+
+def _write_table(table, path):
+    # Parquet needs string column names
+    table = table.copy()
+    table.columns = [str(col) for col in table.columns]
+    table.to_parquet(path)
+
+
+def write_store(path, blocks, features, samples, chunk_features=DEFAULT_CHUNK_FEATURES, dtype=np.float32):
+    """
+    Write a matrix store from blocks of feature columns, without holding the whole matrix in memory.
+
+    The intensities are stored as chunk files of chunk_features columns each (samples x features, C order),
+    next to the feature and sample tables (Parquet) and a JSON manifest. The store is written to a temporary
+    directory and renamed into place.
+
+    Parameters:
+        path (str): Store directory (replaced if it exists).
+        blocks (iterable): Arrays of shape (n_samples, k), consecutive features in the order of the
+            feature table.
+        features (DataFrame or callable): Feature table indexed by feature name, or a function returning it
+            (called once all the blocks are written).
+        samples (DataFrame): Sample table indexed by sample name.
+        chunk_features (int, optional): Number of features per chunk file. Defaults to DEFAULT_CHUNK_FEATURES.
+        dtype (dtype, optional): Stored dtype. Defaults to float32.
+
+    Returns:
+        MatrixStore: The opened store.
+    """
+    tmp_path = f'{os.path.abspath(path).rstrip(os.sep)}.tmp-{os.getpid()}'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    n_samples = len(samples)
+    buffer = np.empty((n_samples, chunk_features), dtype=dtype)
+    filled = 0
+    n_chunks = 0
+    written = 0
+    for block in blocks:
+        block = np.asarray(block, dtype=dtype)
+        if block.shape[0] != n_samples:
+            raise ValueError(f"Block with {block.shape[0]} rows for {n_samples} samples.")
+        start = 0
+        while start < block.shape[1]:
+            taken = min(chunk_features - filled, block.shape[1] - start)
+            buffer[:, filled:filled + taken] = block[:, start:start + taken]
+            filled += taken
+            start += taken
+            if filled == chunk_features:
+                np.save(os.path.join(tmp_path, _chunk_file(n_chunks)), buffer)
+                n_chunks += 1
+                written += filled
+                filled = 0
+    if filled:
+        np.save(os.path.join(tmp_path, _chunk_file(n_chunks)), np.ascontiguousarray(buffer[:, :filled]))
+        n_chunks += 1
+        written += filled
+    if callable(features):
+        features = features()
+    if written != len(features):
+        shutil.rmtree(tmp_path)
+        raise ValueError(f"{written} feature columns written for {len(features)} features.")
+
+    _write_table(features, os.path.join(tmp_path, FEATURES_FILE))
+    _write_table(samples, os.path.join(tmp_path, SAMPLES_FILE))
+    manifest = {'n_samples': n_samples, 'n_features': written, 'chunk_features': chunk_features,
+                'n_chunks': n_chunks, 'dtype': np.dtype(dtype).name}
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=1)
+
+    if os.path.exists(path):
+        # The previous store stays readable until the new one is in place
+        old_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.old')
+        os.replace(path, os.path.join(old_path, 'store'))
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
+    return MatrixStore(path)
+
+
+def _open_store(path):
+    if path not in _OPEN_STORES:
+        _OPEN_STORES[path] = MatrixStore(path)
+    return _OPEN_STORES[path]
+
+
+def _map_block(path, chunk_index, rows, function, kwargs):
+    return function(_open_store(path).chunk(chunk_index, rows), **kwargs)
+
+
+def _block_feature_report(block, blank_rows, cv_rows, rules):
+    return qc_feature_report(block.values, block.features.index, blank_rows, cv_rows=cv_rows, **rules)
+
+
+class MatrixStore:
+    """
+    On-disk intensity matrix (samples x features) made of memory-mapped float32 chunk files, with its feature
+    and sample tables.
+
+    Only the slices that are read are loaded. The chunk files are opened read-only, so any number of
+    processes can open the same store and share the pages of the OS cache without copies; a MatrixStore is
+    pickled as its path (e.g. when sent to a ProcessPoolExecutor worker).
+
+    Attributes:
+        path (str): Store directory.
+        features (DataFrame): Feature table indexed by feature name, one row per column.
+        samples (DataFrame): Sample table indexed by sample name, one row per row.
+        chunk_features (int): Number of features per chunk file.
+    """
+
+    def __init__(self, path):
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"Matrix store not found at the specified path: {path}")
+        with open(manifest_path, 'r', encoding='utf-8') as handle:
+            manifest = json.load(handle)
+        self.path = path
+        self.chunk_features = manifest['chunk_features']
+        self.features = pd.read_parquet(os.path.join(path, FEATURES_FILE))
+        self.samples = pd.read_parquet(os.path.join(path, SAMPLES_FILE))
+        self._chunks = [np.load(os.path.join(path, _chunk_file(index)), mmap_mode='r')
+                        for index in range(manifest['n_chunks'])]
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __repr__(self):
+        return f'MatrixStore({self.path!r}, {self.shape[0]} samples x {self.shape[1]} features)'
+
+    @property
+    def shape(self):
+        return len(self.samples), len(self.features)
+
+    @property
+    def n_chunks(self):
+        return len(self._chunks)
+
+    @classmethod
+    def from_dataframe(cls, path, data, feature_columns=None, chunk_features=DEFAULT_CHUNK_FEATURES):
+        """
+        Write a samples x features DataFrame (as used by the tools.py filters) as a store.
+
+        Parameters:
+            path (str): Store directory.
+            data (DataFrame): Samples x (features + metadata) DataFrame.
+            feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+            chunk_features (int, optional): Number of features per chunk file. Defaults to DEFAULT_CHUNK_FEATURES.
+
+        Returns:
+            MatrixStore: The opened store (other columns go to the sample table).
+        """
+        if feature_columns is None:
+            feature_columns = numeric_metabolite_columns(data)
+        feature_set = set(feature_columns)
+        samples = data[[col for col in data.columns if col not in feature_set]]
+        features = pd.DataFrame(index=pd.Index(feature_columns, name='metabolite'))
+        blocks = (data[feature_columns[start:start + chunk_features]].to_numpy(dtype=np.float32)
+                  for start in range(0, len(feature_columns), chunk_features))
+        return write_store(path, blocks, features, samples, chunk_features)
+
+    @classmethod
+    def from_feature_matrix(cls, path, matrix, chunk_features=DEFAULT_CHUNK_FEATURES):
+        """
+        Write a FeatureMatrix as a store.
+
+        Parameters:
+            path (str): Store directory.
+            matrix (FeatureMatrix): Matrix to write.
+            chunk_features (int, optional): Number of features per chunk file. Defaults to DEFAULT_CHUNK_FEATURES.
+
+        Returns:
+            MatrixStore: The opened store.
+        """
+        blocks = (matrix.values[:, start:start + chunk_features]
+                  for start in range(0, matrix.shape[1], chunk_features))
+        return write_store(path, blocks, matrix.features, matrix.samples, chunk_features)
+
+    @classmethod
+    def from_alignment_file(cls, path, file_path, sep=';', encoding='utf-8', metadata=None, exclude_samples=None,
+                            chunk_features=DEFAULT_CHUNK_FEATURES):
+        """
+        Convert an MS-DIAL alignment export (features x samples) into a store, chunk_features rows at a time.
+
+        The feature names are built as in add_metabolite_column; Rt(min), Mz and the other descriptor columns
+        go to the feature table.
+
+        Parameters:
+            path (str): Store directory.
+            file_path (str): Alignment CSV file.
+            sep (str, optional): Separator of the file. Defaults to ';'.
+            encoding (str, optional): Encoding of the file. Defaults to 'utf-8'.
+            metadata (DataFrame, optional): Sample metadata indexed by sample_name, added to the sample table.
+                Default is None.
+            exclude_samples (str, RowPredicate or list, optional): Samples not stored, as accepted by
+                filter_rows 'exclude' (evaluated on the sample table, e.g. "sample_name == 'blc'").
+                Default is None.
+            chunk_features (int, optional): Number of features per chunk file. Defaults to DEFAULT_CHUNK_FEATURES.
+
+        Returns:
+            MatrixStore: The opened store.
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found at the specified path: {file_path}")
+        sample_columns = infer_sample_columns(file_path, sep=sep, encoding=encoding)
+
+        samples = pd.DataFrame(index=pd.Index(sample_columns, name='sample_name'))
+        if metadata is not None:
+            samples = samples.join(metadata)
+        if exclude_samples is not None:
+            samples = samples[row_mask(samples, exclude=exclude_samples)]
+        kept_columns = samples.index.tolist()
+
+        feature_tables = []
+
+        def blocks():
+            reader = pd.read_csv(file_path, sep=sep, encoding=encoding, chunksize=chunk_features,
+                                 dtype={col: np.float32 for col in sample_columns})
+            for chunk in reader:
+                names = metabolite_names(chunk['Mz'], chunk['Rt(min)'])
+                descriptors = [col for col in chunk.columns if col not in set(sample_columns)]
+                feature_tables.append(chunk[descriptors].set_axis(pd.Index(names, name='metabolite')))
+                yield chunk[kept_columns].to_numpy(dtype=np.float32).T
+
+        # The feature table is complete once all the blocks are written
+        return write_store(path, blocks(), lambda: pd.concat(feature_tables), samples, chunk_features)
+
+    def _positions(self, selection, index):
+        positions = FeatureMatrix._indexer(selection, index)
+        if isinstance(positions, slice):
+            return np.arange(len(index))[positions]
+        return np.asarray(positions)
+
+    def chunk(self, chunk_index, samples=None):
+        """
+        One chunk of features as a FeatureMatrix.
+
+        Parameters:
+            chunk_index (int): Chunk number.
+            samples (slice, list or ndarray, optional): Samples to keep. Default is None (all: the values are a
+                read-only memory-mapped view, nothing is loaded until used).
+
+        Returns:
+            FeatureMatrix: Block of chunk_features features (fewer for the last chunk).
+        """
+        start = chunk_index * self.chunk_features
+        values = self._chunks[chunk_index]
+        features = self.features.iloc[start:start + values.shape[1]]
+        if samples is None:
+            return FeatureMatrix(values, features, self.samples)
+        rows = FeatureMatrix._indexer(samples, self.samples.index)
+        return FeatureMatrix(np.asarray(values[rows]), features, self.samples.iloc[rows])
+
+    def read(self, samples=None, features=None):
+        """
+        Read a block of the matrix: only the chunk files of the selected features are touched.
+
+        Parameters:
+            samples (slice, list or ndarray, optional): Samples (labels, positions, slice or boolean mask).
+                Default is None (all).
+            features (slice, list or ndarray, optional): Features (labels, positions, slice or boolean mask).
+                Default is None (all).
+
+        Returns:
+            FeatureMatrix: In-memory copy of the selected block.
+        """
+        rows = self._positions(samples, self.samples.index)
+        cols = self._positions(features, self.features.index)
+        values = np.empty((len(rows), len(cols)), dtype=self._chunks[0].dtype if self._chunks else np.float32)
+
+        chunk_ids = cols // self.chunk_features
+        all_rows = len(rows) == self.shape[0] and (np.diff(rows) == 1).all()
+        for chunk_index in np.unique(chunk_ids):
+            selected = np.flatnonzero(chunk_ids == chunk_index)
+            local = cols[selected] - chunk_index * self.chunk_features
+            chunk = self._chunks[chunk_index]
+            values[:, selected] = chunk[:, local] if all_rows else chunk[np.ix_(rows, local)]
+        return FeatureMatrix(values, self.features.iloc[cols], self.samples.iloc[rows])
+
+    def to_dataframe(self, samples=None, features=None, include_samples=True):
+        """
+        Read a block as the wide DataFrame of the tools.py functions (see FeatureMatrix.to_dataframe).
+
+        Parameters:
+            samples, features: See read.
+            include_samples (bool, optional): Add the sample table columns. Defaults to True.
+
+        Returns:
+            DataFrame: Samples x features DataFrame.
+        """
+        return self.read(samples, features).to_dataframe(include_samples=include_samples)
+
+    def iter_blocks(self, samples=None):
+        """
+        Iterate over the feature chunks (column blocks).
+
+        Parameters:
+            samples (slice, list or ndarray, optional): Samples to keep. Default is None (all).
+
+        Returns:
+            iterator: FeatureMatrix of each chunk (see chunk).
+        """
+        for chunk_index in range(self.n_chunks):
+            yield self.chunk(chunk_index, samples)
+
+    def iter_row_blocks(self, block_size=256, features=None):
+        """
+        Iterate over blocks of samples (row blocks), e.g. for per-sample normalization or export.
+
+        Parameters:
+            block_size (int, optional): Number of samples per block. Defaults to 256.
+            features (slice, list or ndarray, optional): Features to read. Default is None (all).
+
+        Returns:
+            iterator: In-memory FeatureMatrix of each block of samples.
+        """
+        for start in range(0, self.shape[0], block_size):
+            yield self.read(slice(start, start + block_size), features)
+
+    def map_blocks(self, function, samples=None, workers=None, **kwargs):
+        """
+        Apply a function to every feature chunk, in worker processes sharing the store read-only.
+
+        Workers receive the store path and chunk number only; each one opens the store once and reads its
+        chunks from the memory-mapped files.
+
+        Parameters:
+            function (callable): Module-level function called as function(block, **kwargs), block being the
+                FeatureMatrix of a chunk (see chunk).
+            samples (list or ndarray, optional): Samples of the blocks. Default is None (all).
+            workers (int, optional): Number of worker processes. Default is None (one per CPU core). With 1
+                worker the chunks are processed in this process.
+            **kwargs: Passed to function.
+
+        Returns:
+            list: Results of every chunk, in feature order.
+        """
+        workers = workers or os.cpu_count()
+        if workers <= 1 or self.n_chunks <= 1:
+            return [function(block, **kwargs) for block in self.iter_blocks(samples)]
+        with ProcessPoolExecutor(max_workers=min(workers, self.n_chunks)) as executor:
+            futures = [executor.submit(_map_block, self.path, chunk_index, samples, function, kwargs)
+                       for chunk_index in range(self.n_chunks)]
+            return [future.result() for future in futures]
+
+    def feature_report(self, cv_rows=None, condition_column='SampleType', blank_values=['blank'], workers=None,
+                       **rules):
+        """
+        Blank, zero and CV statistics of every feature (see tools.qc_feature_report), chunk by chunk.
+
+        Parameters:
+            cv_rows (list, str or RowPredicate, optional): Rows of the QC dilutions, evaluated on the sample
+                table. Default is None (no CV rule).
+            condition_column, blank_values: Blank injections (see tools.qc_filter).
+            workers (int, optional): Number of worker processes (see map_blocks). Default is None.
+            **rules: blank_operation, blank_threshold, zero_threshold, cv_threshold and cv_operation.
+
+        Returns:
+            DataFrame: Report of qc_feature_report for all the features.
+        """
+        blank_rows = self.samples[condition_column].isin(blank_values).to_numpy()
+        if cv_rows is not None:
+            cv_rows = row_mask(self.samples, include=cv_rows)
+        reports = self.map_blocks(_block_feature_report, workers=workers, blank_rows=blank_rows, cv_rows=cv_rows,
+                                  rules=rules)
+        return pd.concat(reports)
+
+    def subset(self, path, samples=None, features=None, chunk_features=None):
+        """
+        Write a selection of the store (e.g. the features kept by feature_report) as a new store, chunk by chunk.
+
+        Parameters:
+            path (str): New store directory.
+            samples, features: See read.
+            chunk_features (int, optional): Features per chunk file. Default is None (same as this store).
+
+        Returns:
+            MatrixStore: The new store.
+        """
+        chunk_features = chunk_features or self.chunk_features
+        cols = self._positions(features, self.features.index)
+        rows = self._positions(samples, self.samples.index)
+        blocks = (self.read(rows, cols[start:start + chunk_features]).values
+                  for start in range(0, len(cols), chunk_features))
+        return write_store(path, blocks, self.features.iloc[cols], self.samples.iloc[rows], chunk_features)
+
+    def export(self, output_dir, output_file, file_format='csv', block_size=256, features=None,
+               include_samples=True):
+        """
+        Export the store as a wide samples x features file with save_data, block_size samples at a time.
+
+        Parameters:
+            output_dir (str): Output directory.
+            output_file (str): File name (without extension).
+            file_format (str, optional): See save_data. Defaults to 'csv'.
+            block_size (int, optional): Number of samples per block. Defaults to 256.
+            features (slice, list or ndarray, optional): Features to export. Default is None (all).
+            include_samples (bool, optional): Add the sample table columns. Defaults to True.
+
+        Returns:
+            str: Path to the saved file.
+        """
+        output_path = None
+        for index, block in enumerate(self.iter_row_blocks(block_size, features)):
+            output_path = save_data(block.to_dataframe(include_samples=include_samples), output_dir, output_file,
+                                    file_conflict='replace' if index == 0 else 'append', file_format=file_format)
+        return output_path
+
@@ -0,0 +1,231 @@
+import argparse
+import os
+import warnings
+import numpy as np
+import pandas as pd
+from instrument import traced
+from matrix_store import MatrixStore, write_store
+from predicates import row_mask
+from tools import read_file, numeric_metabolite_columns, save_data
+
+NORMALIZATION_METHODS = ('tic', 'median', 'pqn', 'istd')
+
+# Reference injections of the probabilistic quotient normalization (as accepted by filter_rows 'include')
+DEFAULT_REFERENCE_ROWS = "SampleType == 'QC'"
+
+
+def _positive(values):
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isfinite(values) & (values > 0), values, np.nan)
+
+
+def _nanmedian(values, axis):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(values, axis=axis)
+
+
+def reference_spectrum(values):
+    """
+    Reference spectrum of the probabilistic quotient normalization: median intensity of every feature over
+    the reference injections (zeros and NaN ignored).
+
+    Parameters:
+        values (ndarray): Intensities of the reference injections (injections x features).
+
+    Returns:
+        ndarray: One value per feature (NaN where never observed).
+    """
+    return _nanmedian(_positive(values), axis=0)
+
+
+def normalization_factors(values, method, reference=None):
+    """
+    Dilution factor of every sample of a block of rows, in one vectorized pass (zeros and NaN ignored).
+
+    Methods:
+        'tic': sum of the intensities (total ion count of the features).
+        'median': median intensity.
+        'pqn': median of the quotients of the intensities by the reference spectrum.
+        'istd': geometric mean of the internal standard intensities (values holds the internal standard
+            features only).
+
+    Parameters:
+        values (ndarray): Intensities (samples x features).
+        method (str): 'tic', 'median', 'pqn' or 'istd'.
+        reference (ndarray, optional): reference_spectrum of 'pqn' (one value per column of values).
+
+    Returns:
+        ndarray: One factor per sample (NaN when it cannot be computed).
+    """
+    if method not in NORMALIZATION_METHODS:
+        raise ValueError(f"Unsupported method. Supported methods: {', '.join(NORMALIZATION_METHODS)}.")
+    values = _positive(values)
+    if method == 'tic':
+        totals = np.nansum(values, axis=1)
+        return np.where(totals > 0, totals, np.nan)
+    if method == 'median':
+        return _nanmedian(values, axis=1)
+    if method == 'pqn':
+        if reference is None:
+            raise ValueError("The 'pqn' method needs a reference spectrum.")
+        return _nanmedian(values / _positive(reference)[None, :], axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.exp(np.nanmean(np.log(values), axis=1))
+
+
+def _scaled_factors(factors):
+    # Factors relative to their median, so that the normalized intensities keep their magnitude
+    factors = factors / _nanmedian(factors, axis=0)
+    return np.where(np.isfinite(factors) & (factors > 0), factors, 1.0)
+
+
+def internal_standard_features(data, istd_features=None, istd_rows="sample_name == 'istd_ode'", feature_columns=None,
+                               n_features=5):
+    """
+    Features of the internal standards of the 'istd' normalization.
+
+    The internal standard features should be given (istd_features, e.g. from the configuration): they are
+    checked against the data. Without them, the most intense features of the internal standard injection(s) are
+    used as a fallback, with a warning: the most intense features of that injection are not necessarily the
+    spiked standards (a contaminant or an abundant endogenous compound can rank first).
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame, before the internal standard injection is excluded.
+        istd_features (list, optional): Known internal standard features. Default is None (most intense
+            features of the internal standard injection(s)).
+        istd_rows (list, str or RowPredicate, optional): Internal standard injection(s) of the fallback, as
+            accepted by filter_rows 'include'. Defaults to "sample_name == 'istd_ode'".
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        n_features (int, optional): Number of features of the fallback. Defaults to 5.
+
+    Returns:
+        list: Feature names (fallback: most intense first).
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    if istd_features is not None:
+        missing = [feature for feature in istd_features if feature not in set(feature_columns)]
+        if missing:
+            raise ValueError(f"Internal standard features not found: {missing}")
+        return list(istd_features)
+
+    rows = row_mask(data, include=istd_rows)
+    if not rows.any():
+        raise ValueError("No internal standard injection found.")
+    intensity = np.nan_to_num(_positive(data[feature_columns].to_numpy()[rows])).mean(axis=0)
+    order = np.argsort(-intensity, kind='stable')[:n_features]
+    features = [feature_columns[position] for position in order if intensity[position] > 0]
+    print(f"Warning: no internal standard features given, the {len(features)} most intense features of the "
+          f"internal standard injection are used: {features}")
+    return features
+
+
+@traced
+def normalize(data, method='pqn', feature_columns=None, reference_rows=DEFAULT_REFERENCE_ROWS, istd_columns=None):
+    """
+    Per-sample normalization of the intensities (injection volume and sensitivity differences).
+
+    Every sample is divided by its dilution factor (normalization_factors), relative to the median factor
+    of all the samples. Metadata columns are kept unchanged.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame (e.g. the output of qc_filter).
+        method (str, optional): 'tic', 'median', 'pqn' or 'istd'. Defaults to 'pqn'.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        reference_rows (list, str or RowPredicate, optional): Injections of the 'pqn' reference spectrum,
+            as accepted by filter_rows 'include'. Defaults to DEFAULT_REFERENCE_ROWS.
+        istd_columns (list, optional): Internal standard features of 'istd' (see internal_standard_features).
+
+    Returns:
+        tuple: (normalized DataFrame, Series of the dilution factor of every sample)
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    values = data[feature_columns].to_numpy()
+    dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+
+    reference = None
+    if method == 'pqn':
+        rows = row_mask(data, include=reference_rows)
+        if not rows.any():
+            raise ValueError("No reference injection found for the 'pqn' method.")
+        reference = reference_spectrum(values[rows])
+    if method == 'istd':
+        if not istd_columns:
+            raise ValueError("The 'istd' method needs istd_columns.")
+        factors = normalization_factors(data[istd_columns].to_numpy(), method)
+    else:
+        factors = normalization_factors(values, method, reference)
+    factors = _scaled_factors(factors)
+
+    normalized = (values / factors[:, None]).astype(dtype, copy=False)
+    other_columns = [col for col in data.columns if col not in set(feature_columns)]
+    result = pd.concat([pd.DataFrame(normalized, index=data.index, columns=feature_columns, copy=False),
+                        data[other_columns]], axis=1)
+    return result[data.columns], pd.Series(factors, index=data.index, name='normalization_factor')
+
+
+def normalize_store(store, path, method='pqn', reference_rows=DEFAULT_REFERENCE_ROWS, istd_columns=None,
+                    block_size=256):
+    """
+    Normalize a MatrixStore larger than memory into a new store.
+
+    A first pass reads block_size samples at a time to compute the dilution factors (the 'pqn' reference
+    spectrum is read first from the reference injections, 'istd' reads the internal standard features only);
+    a second pass writes every feature chunk divided by the factors. Only one block is in memory at a time.
+
+    Parameters:
+        store (MatrixStore or str): Input store (or its path).
+        path (str): Output store directory.
+        method, reference_rows, istd_columns: See normalize.
+        block_size (int, optional): Number of samples per block of the first pass. Defaults to 256.
+
+    Returns:
+        MatrixStore: Normalized store; its sample table has a 'normalization_factor' column.
+    """
+    if not isinstance(store, MatrixStore):
+        store = MatrixStore(store)
+
+    reference = None
+    features = None
+    if method == 'pqn':
+        rows = np.flatnonzero(row_mask(store.samples.reset_index(), include=reference_rows))
+        if len(rows) == 0:
+            raise ValueError("No reference injection found for the 'pqn' method.")
+        reference = reference_spectrum(store.read(samples=rows).values)
+    elif method == 'istd':
+        if not istd_columns:
+            raise ValueError("The 'istd' method needs istd_columns.")
+        features = istd_columns
+
+    factors = np.concatenate([normalization_factors(block.values, method, reference)
+                              for block in store.iter_row_blocks(block_size, features)])
+    factors = _scaled_factors(factors)
+
+    samples = store.samples.assign(normalization_factor=factors)
+    blocks = (chunk.values / factors[:, None] for chunk in store.iter_blocks())
+    return write_store(path, blocks, store.features, samples, store.chunk_features)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-sample normalization of a filtered data file.")
+    parser.add_argument('input', help="Filtered data file (e.g. POS-manipulated.csv) or matrix store directory.")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--output-file', default='normalized', help="Output file (or store) name.")
+    parser.add_argument('--sep', default=';', help="Separator of the input file.")
+    parser.add_argument('--method', default='pqn', choices=NORMALIZATION_METHODS, help="Normalization method.")
+    parser.add_argument('--istd', nargs='+', help="Internal standard features of the istd method.")
+    parser.add_argument('--file-format', default='csv', help="Output format (csv, parquet, feather, hdf5).")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        normalize_store(args.input, os.path.join(args.output_dir, args.output_file), args.method,
+                        istd_columns=args.istd)
+    else:
+        input_data = read_file(args.input, sep=args.sep)
+        normalized_data, sample_factors = normalize(input_data, args.method, istd_columns=args.istd)
+        print(sample_factors.describe())
+        save_data(normalized_data, args.output_dir, args.output_file, file_conflict='replace',
+                  file_format=args.file_format)
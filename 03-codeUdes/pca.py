@@ -0,0 +1,207 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import IncrementalPCA
+from sklearn.utils.extmath import randomized_svd
+from tools import read_file, numeric_metabolite_columns, save_data
+
+try:
+    import pyarrow.dataset as ds
+except ImportError:
+    ds = None
+
+# Sample metadata joined to the scores (as in the PCA plots of statistics.R)
+PCA_METADATA_COLUMNS = ['SampleType', 'batch', 'Condition']
+
+
+def _scale(values, mean, std):
+    # Missing values are set to the feature mean (0 after centering)
+    scaled = (values - mean) / std
+    return np.nan_to_num(scaled, nan=0.0, posinf=0.0, neginf=0.0).astype(np.float32)
+
+
+def _column_std(values, mean, scale):
+    if not scale:
+        return np.ones(values.shape[1])
+    std = np.nanstd(values, axis=0, ddof=1)
+    std[~(std > 0)] = 1.0
+    return std
+
+
+def _pca_tables(scores, components, explained_ratio, features, samples, metadata):
+    names = [f'PC{index + 1}' for index in range(components.shape[0])]
+    scores = pd.DataFrame(scores, index=samples, columns=names)
+    if metadata is not None:
+        scores = scores.join(metadata)
+    loadings = pd.DataFrame(components.T, index=pd.Index(features, name='metabolite'), columns=names)
+    return scores, loadings, pd.Series(explained_ratio, index=names, name='explained_variance_ratio')
+
+
+def pca(data, n_components=5, feature_columns=None, metadata_columns=PCA_METADATA_COLUMNS, scale=True,
+        method='randomized', seed=0):
+    """
+    PCA of a samples x features DataFrame (as prcomp(scale = TRUE) in statistics.R), top components only.
+
+    With method='randomized' only the top components are computed (randomized SVD of the float32
+    standardized matrix), which is much faster than the full SVD when n_components is small.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame (e.g. POS-manipulated.csv indexed by sample_name).
+        n_components (int, optional): Number of components. Defaults to 5.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        metadata_columns (list, optional): Columns joined to the scores (missing ones are ignored).
+            Defaults to PCA_METADATA_COLUMNS.
+        scale (bool, optional): Scale the features to unit variance. Defaults to True.
+        method (str, optional): 'randomized' or 'full' (exact SVD). Defaults to 'randomized'.
+        seed (int, optional): Random seed of the randomized SVD. Defaults to 0.
+
+    Returns:
+        tuple: (scores DataFrame (samples x PCs + metadata), loadings DataFrame (features x PCs),
+        explained variance ratio Series)
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    values = data[feature_columns].to_numpy(dtype=np.float64)
+    mean = np.nanmean(values, axis=0)
+    scaled = _scale(values, mean, _column_std(values, mean, scale))
+
+    if method == 'randomized':
+        left, singular, components = randomized_svd(scaled, n_components, random_state=seed)
+    elif method == 'full':
+        left, singular, components = np.linalg.svd(scaled, full_matrices=False)
+        # Same sign convention as randomized_svd (largest loading of each component positive)
+        signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+        left, singular, components = (left * signs)[:, :n_components], singular[:n_components], \
+            (components * signs[:, None])[:n_components]
+    else:
+        raise ValueError("Unsupported method. Supported methods: 'randomized', 'full'.")
+
+    total_variance = (scaled.astype(np.float64) ** 2).sum()
+    explained_ratio = singular ** 2 / total_variance
+    metadata = data[[col for col in metadata_columns if col in data.columns]] if metadata_columns else None
+    return _pca_tables(left * singular, components, explained_ratio, feature_columns, data.index, metadata)
+
+
+def iter_sample_batches(file_path, batch_size=256, sep=';', encoding='utf-8'):
+    """
+    Read a samples x features file (saved by save_data) in batches of samples.
+
+    Parameters:
+        file_path (str): CSV file, or Parquet file or directory (needs pyarrow).
+        batch_size (int, optional): Number of samples per batch. Defaults to 256.
+        sep (str, optional): Separator of CSV files. Defaults to ';'.
+        encoding (str, optional): Encoding of CSV files. Defaults to 'utf-8'.
+
+    Returns:
+        iterator: DataFrames indexed by sample_name (when the file has this column).
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found at the specified path: {file_path}")
+
+    if file_path.lower().endswith('.parquet'):
+        if ds is None:
+            raise ImportError("pyarrow is required to read Parquet files (pip install pyarrow).")
+        batches = (batch.to_pandas() for batch in ds.dataset(file_path, format='parquet').to_batches(batch_size=batch_size))
+    elif file_path.lower().endswith('.csv'):
+        batches = pd.read_csv(file_path, sep=sep, encoding=encoding, chunksize=batch_size)
+    else:
+        raise ValueError("Unsupported file format. Only CSV and Parquet files are supported.")
+
+    for batch in batches:
+        if 'sample_name' in batch.columns:
+            batch = batch.set_index('sample_name')
+        yield batch
+
+
+def incremental_pca(file_path, n_components=5, batch_size=256, metadata_columns=PCA_METADATA_COLUMNS, scale=True,
+                    sep=';', encoding='utf-8'):
+    """
+    Out-of-core PCA of a samples x features file: the samples are streamed in batches (IncrementalPCA).
+
+    The file is read three times: feature means and variances, incremental fit, then scores. Only one batch
+    of samples is in memory at a time.
+
+    Parameters:
+        file_path (str): Samples x features file (see iter_sample_batches).
+        n_components (int, optional): Number of components. Defaults to 5.
+        batch_size (int, optional): Number of samples per batch (at least n_components). Defaults to 256.
+        metadata_columns (list, optional): Columns joined to the scores. Defaults to PCA_METADATA_COLUMNS.
+        scale (bool, optional): Scale the features to unit variance. Defaults to True.
+        sep (str, optional): Separator of CSV files. Defaults to ';'.
+        encoding (str, optional): Encoding of CSV files. Defaults to 'utf-8'.
+
+    Returns:
+        tuple: Same as pca.
+    """
+    if batch_size < n_components:
+        raise ValueError("batch_size must be at least n_components.")
+
+    # Pass 1: feature means and variances
+    feature_columns = None
+    count = total = total_squares = None
+    for batch in iter_sample_batches(file_path, batch_size, sep, encoding):
+        if feature_columns is None:
+            feature_columns = numeric_metabolite_columns(batch)
+            count = np.zeros(len(feature_columns))
+            total = np.zeros(len(feature_columns))
+            total_squares = np.zeros(len(feature_columns))
+        values = batch[feature_columns].to_numpy(dtype=np.float64)
+        count += (~np.isnan(values)).sum(axis=0)
+        total += np.nansum(values, axis=0)
+        total_squares += np.nansum(values ** 2, axis=0)
+    if feature_columns is None:
+        raise ValueError(f"No samples in {file_path}")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        std = np.sqrt((total_squares - count * mean ** 2) / (count - 1)) if scale else np.ones(len(mean))
+    std[~(std > 0)] = 1.0
+
+    # Pass 2: incremental fit; batches smaller than n_components are merged with the previous one
+    model = IncrementalPCA(n_components=n_components)
+    pending = None
+    for batch in iter_sample_batches(file_path, batch_size, sep, encoding):
+        scaled = _scale(batch[feature_columns].to_numpy(dtype=np.float64), mean, std)
+        if pending is None or len(pending) < n_components or len(scaled) < n_components:
+            pending = scaled if pending is None else np.vstack([pending, scaled])
+            continue
+        model.partial_fit(pending)
+        pending = scaled
+    model.partial_fit(pending)
+
+    # Pass 3: scores
+    scores = []
+    metadata = []
+    for batch in iter_sample_batches(file_path, batch_size, sep, encoding):
+        scaled = _scale(batch[feature_columns].to_numpy(dtype=np.float64), mean, std)
+        scores.append(pd.DataFrame(model.transform(scaled), index=batch.index))
+        if metadata_columns:
+            metadata.append(batch[[col for col in metadata_columns if col in batch.columns]])
+    scores = pd.concat(scores)
+
+    return _pca_tables(scores.to_numpy(), model.components_, model.explained_variance_ratio_, feature_columns,
+                       scores.index, pd.concat(metadata) if metadata else None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PCA overview (scores joined to SampleType, batch, Condition).")
+    parser.add_argument('input', help="Samples x features file (e.g. POS-manipulated.csv).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--components', type=int, default=5, help="Number of components.")
+    parser.add_argument('--incremental', action='store_true', help="Stream the samples in batches (out-of-core).")
+    parser.add_argument('--batch-size', type=int, default=256, help="Samples per batch of the incremental mode.")
+    parser.add_argument('--sep', default=';', help="Separator of CSV files.")
+    args = parser.parse_args()
+
+    if args.incremental:
+        pca_scores, pca_loadings, ratio = incremental_pca(args.input, args.components, args.batch_size, sep=args.sep)
+    else:
+        input_data = read_file(args.input, sep=args.sep)
+        if 'sample_name' in input_data.columns:
+            input_data = input_data.set_index('sample_name')
+        pca_scores, pca_loadings, ratio = pca(input_data, args.components)
+    print(ratio)
+
+    name = os.path.splitext(os.path.basename(args.input.rstrip('/\\')))[0]
+    save_data(pca_scores, args.output_dir, f'{name}-pca-scores', file_conflict='replace')
+    save_data(pca_loadings, args.output_dir, f'{name}-pca-loadings', file_conflict='replace')
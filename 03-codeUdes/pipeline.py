@@ -0,0 +1,406 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from graphlib import TopologicalSorter
+from string import Template
+import pandas as pd
+from cache import DEFAULT_CACHE_MAX_BYTES, cache_key, load_cached_frame, store_cached_frame
+from tools import (read_file, add_metabolite_column, filter_column, select_columns_with_metabolites_columns,
+                   filter_rows, transpose_data, merge_data, attach_metadata, blank_filter, cv_filter,
+                   QC_filter_with_zeros, qc_filter, save_data, save_as_csv)
+from drift_correction import drift_correction
+from imputation import impute
+from normalization import normalize
+from feature_grouping import feature_table, collapse_feature_groups
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def set_index(data, keys):
+    """
+    Set the DataFrame index (pipeline version of DataFrame.set_index, without 'inplace').
+
+    Parameters:
+        data (DataFrame): Input DataFrame.
+        keys (str or list): Column(s) to use as index.
+
+    Returns:
+        DataFrame: DataFrame indexed by keys.
+    """
+    return data.set_index(keys)
+
+
+# Functions a pipeline step can call, by name
+STEP_FUNCTIONS = {
+    'read_file': read_file,
+    'add_metabolite_column': add_metabolite_column,
+    'filter_column': filter_column,
+    'select_columns_with_metabolites_columns': select_columns_with_metabolites_columns,
+    'filter_rows': filter_rows,
+    'transpose_data': transpose_data,
+    'merge_data': merge_data,
+    'attach_metadata': attach_metadata,
+    'blank_filter': blank_filter,
+    'cv_filter': cv_filter,
+    'QC_filter_with_zeros': QC_filter_with_zeros,
+    'qc_filter': qc_filter,
+    'save_data': save_data,
+    'save_as_csv': save_as_csv,
+    'set_index': set_index,
+    'drift_correction': drift_correction,
+    'impute': impute,
+    'normalize': normalize,
+    'feature_table': feature_table,
+    'collapse_feature_groups': collapse_feature_groups,
+}
+
+# Steps with side effects: always run, never memoized
+SIDE_EFFECT_STEPS = {'save_data', 'save_as_csv'}
+
+# Steps reading their 'file_path': keyed by the content of the file
+FILE_STEPS = {'read_file', 'feature_table'}
+
+# Column of a memoized Series result
+SERIES_COLUMN = '__series__'
+
+
+def load_config(config_path):
+    """
+    Load a pipeline configuration file.
+
+    Parameters:
+        config_path (str): Path to a JSON or YAML (.yml/.yaml, needs PyYAML) file.
+
+    Returns:
+        dict: Pipeline configuration.
+    """
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"File not found at the specified path: {config_path}")
+
+    file_ext = os.path.splitext(config_path)[1].lower()
+    with open(config_path, 'r', encoding='utf-8') as handle:
+        if file_ext == '.json':
+            return json.load(handle)
+        if file_ext in ('.yml', '.yaml'):
+            if yaml is None:
+                raise ImportError("PyYAML is required to read YAML pipeline files (pip install pyyaml).")
+            return yaml.safe_load(handle)
+    raise ValueError("Unsupported file format. Only JSON and YAML pipeline files are supported.")
+
+
+def _substitute(value, variables):
+    # "${name}" alone keeps the type of the variable (lists, numbers), inside a string it is formatted
+    if isinstance(value, str):
+        if value.startswith('${') and value.endswith('}') and value[2:-1] in variables:
+            return variables[value[2:-1]]
+        return Template(value).safe_substitute(variables)
+    if isinstance(value, list):
+        return [_substitute(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: _substitute(item, variables) for key, item in value.items()}
+    return value
+
+
+def dataset_steps(config, dataset_name):
+    """
+    Resolve the steps of a dataset: template expansion and '${variable}' substitution.
+
+    A dataset either lists its own 'steps' or names a 'template' (a step list under the top-level
+    'templates'); its 'vars' are substituted in the step parameters.
+
+    Parameters:
+        config (dict): Pipeline configuration.
+        dataset_name (str): Dataset name.
+
+    Returns:
+        list: Step dictionaries with 'name', 'function', 'inputs', 'params' and optional 'outputs'.
+    """
+    dataset = config['datasets'][dataset_name]
+    if 'steps' in dataset:
+        steps = dataset['steps']
+    elif 'template' in dataset:
+        steps = config.get('templates', {})[dataset['template']]
+    else:
+        raise ValueError(f"Dataset '{dataset_name}' needs 'steps' or a 'template'.")
+
+    variables = dict(config.get('vars', {}), dataset=dataset_name, **dataset.get('vars', {}))
+    return [_substitute(step, variables) for step in steps]
+
+
+def step_graph(steps):
+    """
+    Build the dependency graph of the steps and check it.
+
+    Parameters:
+        steps (list): Resolved steps (see dataset_steps).
+
+    Returns:
+        tuple: (dict step name -> step, list of step names in execution order)
+    """
+    by_name = {}
+    producers = {}
+    for step in steps:
+        name = step['name']
+        if name in by_name:
+            raise ValueError(f"Duplicated step name: {name}")
+        if step['function'] not in STEP_FUNCTIONS:
+            raise ValueError(f"Unknown step function '{step['function']}' in step '{name}'.")
+        by_name[name] = step
+        for output in step.get('outputs', [name]):
+            producers[output] = name
+
+    graph = {}
+    for name, step in by_name.items():
+        missing = [item for item in step.get('inputs', []) if item not in producers]
+        if missing:
+            raise ValueError(f"Step '{name}' uses unknown inputs: {missing}")
+        graph[name] = {producers[item] for item in step.get('inputs', [])}
+
+    order = list(TopologicalSorter(graph).static_order())
+    return by_name, order
+
+
+def run_step(step, results):
+    """
+    Run one step on the results of its inputs.
+
+    Parameters:
+        step (dict): Resolved step.
+        results (dict): Available results by name.
+
+    Returns:
+        dict: New results by name (one per entry of 'outputs', or the step name).
+    """
+    function = STEP_FUNCTIONS[step['function']]
+    inputs = [results[item] for item in step.get('inputs', [])]
+    result = function(*inputs, **step.get('params', {}))
+
+    outputs = step.get('outputs')
+    if outputs is None:
+        return {step['name']: result}
+    if len(outputs) != len(result):
+        raise ValueError(f"Step '{step['name']}' returned {len(result)} values for outputs {outputs}.")
+    return dict(zip(outputs, result))
+
+
+def _step_outputs(step):
+    return step.get('outputs', [step['name']])
+
+
+@lru_cache(maxsize=1)
+def code_version():
+    """
+    Hash of the source of the processing modules (the .py files next to pipeline.py, main.py excluded).
+
+    A step function calls helpers of other modules (e.g. qc_filter uses predicates.row_mask), so the memoized
+    results are keyed by the source of all the modules rather than by the source of the step function only.
+
+    Returns:
+        str: Hex digest.
+    """
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(code_dir)):
+        if name.endswith('.py') and name != 'main.py':
+            with open(os.path.join(code_dir, name), 'rb') as handle:
+                digest.update(name.encode() + b'\0' + handle.read())
+    return digest.hexdigest()
+
+
+def step_key(step, input_keys, memo_dir):
+    """
+    Content-addressed key of a step: function name, source of the processing modules (see code_version),
+    parameters and keys of its inputs.
+
+    read_file (and feature_table) steps are keyed by the content fingerprint of the file they read (see cache.cache_key),
+    so the keys of every downstream step change when an input file changes.
+
+    Parameters:
+        step (dict): Resolved step.
+        input_keys (list): Keys of the step inputs.
+        memo_dir (str): Memoization directory.
+
+    Returns:
+        str: Step key.
+    """
+    params = step.get('params', {})
+    payload = {'function': step['function'], 'code': code_version(), 'params': params, 'inputs': input_keys}
+    if step['function'] in FILE_STEPS:
+        payload['file'] = cache_key(memo_dir, params['file_path'])
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def _plan_dataset(by_name, order, memo_dir):
+    # Keys of every output, in dependency order
+    output_keys = {}
+    for name in order:
+        step = by_name[name]
+        key = step_key(step, [output_keys[item] for item in step.get('inputs', [])], memo_dir)
+        for output in _step_outputs(step):
+            output_keys[output] = key + '-' + output
+
+    # Walk back from the final results: a step runs only when one of its needed outputs is not memoized
+    consumed = {item for step in by_name.values() for item in step.get('inputs', [])}
+    demand = {output for step in by_name.values() for output in _step_outputs(step) if output not in consumed}
+    to_run, to_load = set(), set()
+    for name in reversed(order):
+        step = by_name[name]
+        if step['function'] not in SIDE_EFFECT_STEPS:
+            needed = [output for output in _step_outputs(step) if output in demand]
+            if not needed:
+                continue
+            if all(os.path.exists(os.path.join(memo_dir, output_keys[output] + '.parquet')) for output in needed):
+                to_load.update(needed)
+                continue
+        to_run.add(name)
+        demand.update(step.get('inputs', []))
+    return output_keys, to_run, to_load
+
+
+def _memo_frame(result):
+    # Series are memoized as one-column DataFrames (name kept in the Parquet metadata)
+    if isinstance(result, pd.Series):
+        frame = result.to_frame(SERIES_COLUMN)
+        frame.attrs['series_name'] = result.name
+        return frame
+    return result
+
+
+def _memo_result(frame):
+    if list(frame.columns) == [SERIES_COLUMN]:
+        return frame[SERIES_COLUMN].rename(frame.attrs.get('series_name'))
+    return frame
+
+
+def run_dataset(config, dataset_name, memo_dir=None, memo_max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """
+    Run all the steps of a dataset in dependency order.
+
+    Intermediate DataFrames are released as soon as no remaining step uses them. With a memoization
+    directory, the DataFrame and Series results of every step are stored as Parquet under their step key (see
+    step_key) and a step whose results are stored is not run again: after a parameter change only the changed
+    step and the steps downstream of it are recomputed. A memoized result evicted before it is loaded is recomputed
+    with the step producing it.
+
+    Parameters:
+        config (dict): Pipeline configuration.
+        dataset_name (str): Dataset name.
+        memo_dir (str, optional): Memoization directory. Default is None (no memoization).
+        memo_max_bytes (int, optional): Size bound of the memoization directory (least recently used results
+            are evicted). Defaults to DEFAULT_CACHE_MAX_BYTES.
+
+    Returns:
+        dict: Results that are not DataFrames or Series (saved file paths, ...), by name.
+    """
+    by_name, order = step_graph(dataset_steps(config, dataset_name))
+    if memo_dir is not None:
+        output_keys, to_run, to_load = _plan_dataset(by_name, order, memo_dir)
+    else:
+        output_keys, to_run, to_load = {}, set(order), set()
+
+    # Number of steps still needing each result
+    remaining_uses = {}
+    for name in to_run:
+        for item in by_name[name].get('inputs', []):
+            remaining_uses[item] = remaining_uses.get(item, 0) + 1
+
+    producers = {output: name for name in order for output in _step_outputs(by_name[name])}
+    results = {}
+    summary = {}
+
+    def _run(step):
+        print(f"[{dataset_name}] {step['name']} ({step['function']})")
+        outputs = run_step(step, results)
+        for output, result in outputs.items():
+            if not isinstance(result, (pd.DataFrame, pd.Series)):
+                summary[output] = result
+            elif memo_dir is not None and step['function'] not in SIDE_EFFECT_STEPS:
+                store_cached_frame(memo_dir, output_keys[output], _memo_frame(result), max_bytes=memo_max_bytes)
+        return outputs
+
+    def _provide(item):
+        # Memoized result, recomputed with its producer step when it was evicted after the planning
+        frame = load_cached_frame(memo_dir, output_keys[item])
+        if frame is not None:
+            print(f"[{dataset_name}] {item} (memoized)")
+            results[item] = _memo_result(frame)
+            return
+        print(f"[{dataset_name}] {item} evicted from the memo: recomputed")
+        producer = by_name[producers[item]]
+        provided = [source for source in producer.get('inputs', []) if source not in results]
+        for source in provided:
+            _provide(source)
+        results[item] = _run(producer)[item]
+        for source in provided:
+            if remaining_uses.get(source, 0) == 0:
+                del results[source]
+
+    for name in order:
+        if name not in to_run:
+            continue
+        step = by_name[name]
+        for item in step.get('inputs', []):
+            if item not in results and item in to_load:
+                _provide(item)
+
+        results.update(_run(step))
+        for item in step.get('inputs', []):
+            remaining_uses[item] -= 1
+            if remaining_uses[item] == 0:
+                del results[item]
+    return summary
+
+
+def run_pipeline(config, datasets=None, workers=None, memo_dir=None):
+    """
+    Run the datasets of a pipeline, in parallel worker processes.
+
+    Parameters:
+        config (dict or str): Pipeline configuration or path to the configuration file.
+        datasets (list, optional): Names of the datasets to run. Default is None (all).
+        workers (int, optional): Number of worker processes. Default is None ('workers' of the configuration,
+            or one per CPU core). With 1 worker the datasets run one after the other in this process.
+        memo_dir (str, optional): Step memoization directory (see run_dataset). Default is None ('memo_dir' of
+            the configuration, if any).
+
+    Returns:
+        dict: Non-DataFrame results of each dataset (see run_dataset), by dataset name.
+    """
+    if isinstance(config, str):
+        config = load_config(config)
+    if datasets is None:
+        datasets = list(config['datasets'])
+
+    # Check every dataset before starting any work
+    for dataset_name in datasets:
+        step_graph(dataset_steps(config, dataset_name))
+
+    memo_dir = memo_dir or config.get('memo_dir')
+    memo_max_bytes = config.get('memo_max_bytes', DEFAULT_CACHE_MAX_BYTES)
+    workers = workers or config.get('workers') or os.cpu_count()
+    workers = min(workers, len(datasets))
+    if workers <= 1:
+        return {name: run_dataset(config, name, memo_dir, memo_max_bytes) for name in datasets}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(run_dataset, config, name, memo_dir, memo_max_bytes) for name in datasets}
+        return {name: future.result() for name, future in futures.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a declarative LC-MS processing pipeline.")
+    parser.add_argument('config', help="Pipeline configuration file (JSON or YAML).")
+    parser.add_argument('--datasets', nargs='+', help="Datasets to run (default: all).")
+    parser.add_argument('--workers', type=int, help="Number of worker processes (default: one per core).")
+    parser.add_argument('--memo-dir', help="Step memoization directory (default: 'memo_dir' of the configuration).")
+    args = parser.parse_args()
+
+    outputs_by_dataset = run_pipeline(args.config, datasets=args.datasets, workers=args.workers, memo_dir=args.memo_dir)
+    for name, outputs in outputs_by_dataset.items():
+        print(name, outputs)
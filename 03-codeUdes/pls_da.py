@@ -0,0 +1,256 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.cross_decomposition import PLSRegression
+from sklearn.model_selection import StratifiedKFold
+from tools import read_file, numeric_metabolite_columns, save_data
+
+# Standardized matrix of the worker processes, set once per process by _init_pls_worker
+_PLS_DATA = {}
+
+
+def standardize(values):
+    """
+    Autoscale a samples x features matrix (zero mean, unit variance per feature, as StandardScaler).
+
+    Missing values are replaced by 0 (the feature mean) and constant features are left at 0.
+
+    Parameters:
+        values (ndarray): Samples x features matrix.
+
+    Returns:
+        ndarray: Standardized float64 matrix.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mean = np.nanmean(values, axis=0)
+    std = np.nanstd(values, axis=0)
+    std[~(std > 0)] = 1.0
+    scaled = (values - mean) / std
+    return np.nan_to_num(scaled, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _init_pls_worker(scaled):
+    _PLS_DATA.clear()
+    _PLS_DATA['scaled'] = scaled
+
+
+def _fit_predict(train, test, codes, n_classes, max_components):
+    # One fit with max_components: the models with fewer components are its first columns (NIPALS deflation)
+    scaled = _PLS_DATA['scaled']
+    x_train = scaled[train]
+    y_train = np.eye(n_classes)[codes[train]]
+    model = PLSRegression(n_components=max_components, scale=False).fit(x_train, y_train)
+
+    x_centered = scaled[test] - x_train.mean(axis=0)
+    y_mean = y_train.mean(axis=0)
+    y_test = np.eye(n_classes)[codes[test]]
+    correct = np.zeros(max_components)
+    press = np.zeros(max_components)
+    for n_components in range(1, max_components + 1):
+        weights = model.x_weights_[:, :n_components]
+        rotations = weights @ np.linalg.pinv(model.x_loadings_[:, :n_components].T @ weights)
+        predicted = x_centered @ rotations @ model.y_loadings_[:, :n_components].T + y_mean
+        correct[n_components - 1] = (predicted.argmax(axis=1) == codes[test]).sum()
+        press[n_components - 1] = ((predicted - y_test) ** 2).sum()
+    return correct, press
+
+
+def _cross_validation_task(codes, n_classes, splits, max_components):
+    # Summed over the folds of one k-fold split: correct predictions, PRESS and total sum of squares
+    correct = np.zeros(max_components)
+    press = np.zeros(max_components)
+    total = 0.0
+    for train, test in splits:
+        fold_correct, fold_press = _fit_predict(train, test, codes, n_classes, max_components)
+        correct += fold_correct
+        press += fold_press
+        y_test = np.eye(n_classes)[codes[test]]
+        total += ((y_test - np.eye(n_classes)[codes[train]].mean(axis=0)) ** 2).sum()
+    return correct, press, total
+
+
+def _run_tasks(scaled, tasks, workers):
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        _init_pls_worker(scaled)
+        results = [_cross_validation_task(*task) for task in tasks]
+        _PLS_DATA.clear()
+        return results
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_pls_worker, initargs=(scaled,)) as executor:
+        futures = [executor.submit(_cross_validation_task, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def _prepare(data, target_column, feature_columns):
+    if target_column not in data.columns:
+        raise KeyError(f"Column not found: {target_column}")
+    data = data[data[target_column].notna()]
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+    classes, codes = np.unique(data[target_column].astype(str).to_numpy(), return_inverse=True)
+    if len(classes) < 2:
+        raise ValueError(f"Column '{target_column}' needs at least two classes for a PLS-DA.")
+    return standardize(data[feature_columns].to_numpy()), codes, classes, list(feature_columns)
+
+
+def _kfold_splits(codes, n_splits, seed):
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    return list(folds.split(np.zeros(len(codes)), codes))
+
+
+def cross_validate(data, target_column, feature_columns=None, max_components=5, n_splits=5, n_repeats=10,
+                   workers=None, seed=0):
+    """
+    Repeated stratified k-fold cross-validation of PLS-DA models with 1 to max_components components.
+
+    The features are standardized once (the scaling does not use the class labels) and the standardized
+    matrix is sent once to every worker process. Each fold fits a single model with max_components
+    components, from which the models with fewer components are evaluated. Each repeat of the k-fold split
+    is a task of the process pool.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the target column.
+        target_column (str): Class column (e.g. 'Duration', 'Condition').
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        max_components (int, optional): Largest number of components tested. Defaults to 5.
+        n_splits (int, optional): Number of folds. Defaults to 5.
+        n_repeats (int, optional): Number of repeats of the k-fold split. Defaults to 10.
+        workers (int, optional): Number of worker processes. Default is None (one per CPU core).
+        seed (int, optional): Random seed of the splits. Defaults to 0.
+
+    Returns:
+        DataFrame: One row per number of components: n_components, accuracy, accuracy_std (over the repeats)
+        and Q2.
+    """
+    scaled, codes, classes, _ = _prepare(data, target_column, feature_columns)
+    seeds = np.random.SeedSequence(seed).generate_state(n_repeats)
+    tasks = [(codes, len(classes), _kfold_splits(codes, n_splits, int(repeat_seed)), max_components)
+             for repeat_seed in seeds]
+    results = _run_tasks(scaled, tasks, workers)
+
+    accuracy = np.array([correct / len(codes) for correct, _, _ in results])
+    q2 = np.array([1 - press / total for _, press, total in results])
+    return pd.DataFrame({
+        'n_components': np.arange(1, max_components + 1),
+        'accuracy': accuracy.mean(axis=0),
+        'accuracy_std': accuracy.std(axis=0),
+        'Q2': q2.mean(axis=0),
+    })
+
+
+def permutation_test(data, target_column, n_components, feature_columns=None, n_permutations=100, n_splits=5,
+                     workers=None, seed=0):
+    """
+    Label permutation test of the cross-validated accuracy of a PLS-DA model.
+
+    Every permutation shuffles the class labels and runs one stratified k-fold cross-validation; permutations
+    are tasks of the process pool, seeded from 'seed' so the results do not depend on the number of workers.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the target column.
+        target_column (str): Class column.
+        n_components (int): Number of components of the model.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+        n_permutations (int, optional): Number of permutations. Defaults to 100.
+        n_splits (int, optional): Number of folds. Defaults to 5.
+        workers (int, optional): Number of worker processes. Default is None (one per CPU core).
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: 'accuracy' (observed), 'Q2' (observed), 'null_accuracy' (array) and 'p_value'
+        ((count + 1) / (n_permutations + 1)).
+    """
+    scaled, codes, classes, _ = _prepare(data, target_column, feature_columns)
+    seeds = np.random.SeedSequence(seed).spawn(n_permutations + 1)
+
+    tasks = [(codes, len(classes), _kfold_splits(codes, n_splits, int(seeds[0].generate_state(1)[0])), n_components)]
+    for permutation_seed in seeds[1:]:
+        rng = np.random.default_rng(permutation_seed)
+        permuted = rng.permutation(codes)
+        tasks.append((permuted, len(classes), _kfold_splits(permuted, n_splits, int(rng.integers(2 ** 31))),
+                      n_components))
+    results = _run_tasks(scaled, tasks, workers)
+
+    accuracy = np.array([correct[-1] / len(codes) for correct, _, _ in results])
+    _, press, total = results[0]
+    return {
+        'accuracy': accuracy[0],
+        'Q2': 1 - press[-1] / total,
+        'null_accuracy': accuracy[1:],
+        'p_value': ((accuracy[1:] >= accuracy[0]).sum() + 1) / (n_permutations + 1),
+    }
+
+
+def vip_scores(model):
+    """
+    Variable Importance in Projection of a fitted PLS model.
+
+    Parameters:
+        model (PLSRegression): Fitted model.
+
+    Returns:
+        ndarray: VIP score of every feature (features with VIP > 1 are usually considered important).
+    """
+    scores = model.x_scores_
+    weights = model.x_weights_
+    y_loadings = model.y_loadings_
+    # Y variance explained by each component
+    explained = (scores ** 2).sum(axis=0) * (y_loadings ** 2).sum(axis=0)
+    normalized_weights = weights / np.linalg.norm(weights, axis=0)
+    return np.sqrt(weights.shape[0] * (normalized_weights ** 2) @ explained / explained.sum())
+
+
+def fit_pls_da(data, target_column, n_components=2, feature_columns=None):
+    """
+    Fit a PLS-DA model on all the samples and rank the features by VIP score.
+
+    Parameters:
+        data (DataFrame): Samples x features DataFrame with the target column.
+        target_column (str): Class column.
+        n_components (int, optional): Number of components. Defaults to 2.
+        feature_columns (list, optional): Feature columns. Default is None (numeric columns starting with "M").
+
+    Returns:
+        tuple: (fitted PLSRegression, DataFrame with Metabolite, VIP and the X loadings of each component,
+        sorted by decreasing VIP)
+    """
+    scaled, codes, classes, feature_columns = _prepare(data, target_column, feature_columns)
+    model = PLSRegression(n_components=n_components, scale=False).fit(scaled, np.eye(len(classes))[codes])
+
+    features = pd.DataFrame({'Metabolite': feature_columns, 'VIP': vip_scores(model)})
+    for component in range(n_components):
+        features[f'loading_{component + 1}'] = model.x_loadings_[:, component]
+    return model, features.sort_values('VIP', ascending=False, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PLS-DA cross-validation, permutation test and VIP scores.")
+    parser.add_argument('input', help="Filtered data file (e.g. POS-manipulated.csv).")
+    parser.add_argument('target', help="Class column (e.g. Duration).")
+    parser.add_argument('--output-dir', required=True, help="Output directory.")
+    parser.add_argument('--max-components', type=int, default=5, help="Largest number of components tested.")
+    parser.add_argument('--splits', type=int, default=5, help="Number of folds.")
+    parser.add_argument('--repeats', type=int, default=10, help="Number of repeats of the k-fold split.")
+    parser.add_argument('--permutations', type=int, default=100, help="Number of label permutations.")
+    parser.add_argument('--workers', type=int, help="Number of worker processes.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    input_data = read_file(args.input, sep=';')
+    name = os.path.splitext(os.path.basename(args.input))[0]
+
+    validation = cross_validate(input_data, args.target, max_components=args.max_components, n_splits=args.splits,
+                                n_repeats=args.repeats, workers=args.workers, seed=args.seed)
+    print(validation)
+    best_components = int(validation.loc[validation['accuracy'].idxmax(), 'n_components'])
+
+    significance = permutation_test(input_data, args.target, best_components, n_permutations=args.permutations,
+                                    n_splits=args.splits, workers=args.workers, seed=args.seed)
+    print(f"{best_components} components: accuracy {significance['accuracy']:.3f}, "
+          f"Q2 {significance['Q2']:.3f}, permutation p-value {significance['p_value']:.4f}")
+
+    _, vip = fit_pls_da(input_data, args.target, best_components)
+    save_data(validation, args.output_dir, f'{name}-plsda-cv', file_conflict='replace')
+    save_data(vip, args.output_dir, f'{name}-plsda-vip', file_conflict='replace')
@@ -0,0 +1,279 @@
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# "column == 'value'" / "column != 'value'" conditions, as written in the filter_rows lists (the value cannot
+# contain a quote, so "a == 'x' or a == 'y'" is not read as one equality)
+_EQUALITY_PATTERN = re.compile(r"""^\s*`?(\w+)`?\s*(==|!=)\s*(['"])([^'"]*)\3\s*$""")
+# "column < 10" style numeric conditions
+_COMPARISON_PATTERN = re.compile(r"""^\s*`?(\w+)`?\s*(<=|>=|<|>)\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*$""")
+
+
+class RowPredicate:
+    """
+    Compiled row condition, evaluated as a boolean mask with hashed lookups or vectorized comparisons.
+
+    Predicates are immutable and hashable, so compiled predicates can be cached and reused across calls.
+    Combine them with '|', '&' and '~'. Build them with values_in, matches, starts_with, in_range or
+    compile_condition.
+
+    Attributes:
+        kind (str): 'values_in', 'matches', 'starts_with', 'in_range', 'expression', 'or', 'and' or 'not'.
+        column (str): Column (or index level, e.g. 'sample_name') the condition applies to.
+        argument: Values (frozenset), pattern, prefixes (tuple), bounds (tuple) or expression string.
+        operands (tuple): Sub-predicates of 'or', 'and' and 'not'.
+    """
+
+    def __init__(self, kind, column=None, argument=None, operands=()):
+        self.kind = kind
+        self.column = column
+        self.argument = argument
+        self.operands = tuple(operands)
+
+    def _key(self):
+        return (self.kind, self.column, self.argument, self.operands)
+
+    def __eq__(self, other):
+        return isinstance(other, RowPredicate) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        if self.kind in ('or', 'and'):
+            return '(' + f' {self.kind} '.join(repr(op) for op in self.operands) + ')'
+        if self.kind == 'not':
+            return f'not {self.operands[0]!r}'
+        if self.kind == 'expression':
+            return self.argument
+        return f'{self.kind}({self.column!r}, {self.argument!r})'
+
+    def __or__(self, other):
+        return any_of([self, other])
+
+    def __and__(self, other):
+        return RowPredicate('and', operands=(self, other))
+
+    def __invert__(self):
+        if self.kind == 'not':
+            return self.operands[0]
+        return RowPredicate('not', operands=(self,))
+
+    def mask(self, data):
+        """
+        Evaluate the predicate.
+
+        Parameters:
+            data (DataFrame): Input DataFrame.
+
+        Returns:
+            ndarray: Boolean mask, one value per row.
+        """
+        if self.kind == 'or':
+            result = np.zeros(len(data), dtype=bool)
+            for operand in self.operands:
+                result |= operand.mask(data)
+            return result
+        if self.kind == 'and':
+            result = np.ones(len(data), dtype=bool)
+            for operand in self.operands:
+                result &= operand.mask(data)
+            return result
+        if self.kind == 'not':
+            return ~self.operands[0].mask(data)
+        if self.kind == 'expression':
+            return np.asarray(data.eval(self.argument), dtype=bool)
+
+        values = _column_values(data, self.column)
+        if self.kind == 'values_in':
+            # Hashed lookup of the whole value set
+            result = values.isin(self.argument)
+        elif self.kind == 'matches':
+            result = values.str.contains(self.argument, regex=True, na=False)
+        elif self.kind == 'starts_with':
+            result = values.str.startswith(self.argument, na=False)
+        elif self.kind == 'in_range':
+            low, high, inclusive = self.argument
+            numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+            result = np.ones(len(numbers), dtype=bool)
+            if low is not None:
+                result &= numbers >= low if inclusive else numbers > low
+            if high is not None:
+                result &= numbers <= high if inclusive else numbers < high
+        else:
+            raise ValueError(f"Unknown predicate kind: {self.kind}")
+        return np.asarray(result, dtype=bool)
+
+
+def _column_values(data, column):
+    # A condition can target a column or an index level such as 'sample_name'
+    if column in data.columns:
+        return data[column]
+    if column in data.index.names:
+        return data.index.get_level_values(column)
+    raise KeyError(f"Column or index level not found: {column}")
+
+
+def values_in(column, values):
+    """
+    Rows whose column value is one of the given values (hashed lookup).
+
+    Parameters:
+        column (str): Column or index level name.
+        values (list): Accepted values.
+
+    Returns:
+        RowPredicate: Compiled predicate.
+    """
+    if isinstance(values, str):
+        values = [values]
+    return RowPredicate('values_in', column, frozenset(values))
+
+
+def matches(column, pattern):
+    """
+    Rows whose column value contains a match of the regular expression.
+
+    Parameters:
+        column (str): Column or index level name.
+        pattern (str): Regular expression (re.search semantics).
+
+    Returns:
+        RowPredicate: Compiled predicate.
+    """
+    re.compile(pattern)
+    return RowPredicate('matches', column, pattern)
+
+
+def starts_with(column, prefix):
+    """
+    Rows whose column value starts with the prefix (or one of the prefixes).
+
+    Parameters:
+        column (str): Column or index level name.
+        prefix (str or list): Prefix(es).
+
+    Returns:
+        RowPredicate: Compiled predicate.
+    """
+    prefixes = (prefix,) if isinstance(prefix, str) else tuple(prefix)
+    return RowPredicate('starts_with', column, prefixes)
+
+
+def in_range(column, low=None, high=None, inclusive=True):
+    """
+    Rows whose numeric column value is within [low, high].
+
+    Parameters:
+        column (str): Column or index level name.
+        low (float, optional): Lower bound. Default is None (no bound).
+        high (float, optional): Upper bound. Default is None (no bound).
+        inclusive (bool, optional): Include the bounds. Defaults to True.
+
+    Returns:
+        RowPredicate: Compiled predicate.
+    """
+    return RowPredicate('in_range', column, (low, high, inclusive))
+
+
+def any_of(predicates):
+    """
+    Combine predicates with 'or'; values_in predicates on the same column are merged into one value set.
+
+    Parameters:
+        predicates (list): RowPredicate objects.
+
+    Returns:
+        RowPredicate: Combined predicate.
+    """
+    value_sets = {}
+    others = []
+    for predicate in predicates:
+        operands = predicate.operands if predicate.kind == 'or' else (predicate,)
+        for operand in operands:
+            if operand.kind == 'values_in':
+                value_sets.setdefault(operand.column, set()).update(operand.argument)
+            elif operand not in others:
+                others.append(operand)
+
+    merged = [values_in(column, values) for column, values in value_sets.items()] + others
+    if len(merged) == 1:
+        return merged[0]
+    return RowPredicate('or', operands=merged)
+
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition):
+    """
+    Compile a filter_rows condition string into a RowPredicate.
+
+    "column == 'value'" and "column != 'value'" become value set lookups and "column < 10" style
+    comparisons become numeric ranges; any other expression (e.g. conditions joined with 'or' / 'and') is
+    evaluated with DataFrame.eval.
+    Compiled conditions are cached.
+
+    Parameters:
+        condition (str): Condition, e.g. "sample_name == 'blc'".
+
+    Returns:
+        RowPredicate: Compiled predicate.
+    """
+    equality = _EQUALITY_PATTERN.match(condition)
+    if equality is not None:
+        column, operation, _, value = equality.groups()
+        predicate = values_in(column, [value])
+        return predicate if operation == '==' else ~predicate
+
+    comparison = _COMPARISON_PATTERN.match(condition)
+    if comparison is not None:
+        column, operation, value = comparison.groups()
+        if operation in ('<', '<='):
+            return in_range(column, high=float(value), inclusive=operation == '<=')
+        return in_range(column, low=float(value), inclusive=operation == '>=')
+
+    return RowPredicate('expression', argument=condition)
+
+
+@lru_cache(maxsize=1024)
+def _compile_conditions(conditions):
+    return any_of([compile_condition(cond) if isinstance(cond, str) else cond for cond in conditions])
+
+
+def compile_conditions(conditions, name='Include'):
+    """
+    Compile a condition, a predicate or a list of them into one predicate matching any of them.
+
+    Parameters:
+        conditions (str, RowPredicate or list): Conditions.
+        name (str, optional): Parameter name used in the error message. Defaults to 'Include'.
+
+    Returns:
+        RowPredicate: Combined predicate.
+    """
+    if isinstance(conditions, (str, RowPredicate)):
+        conditions = [conditions]
+    if not isinstance(conditions, (list, tuple)) or \
+            not all(isinstance(cond, (str, RowPredicate)) for cond in conditions):
+        raise ValueError(f"{name} parameter must be a string, a RowPredicate or a list of them.")
+    return _compile_conditions(tuple(conditions))
+
+
+def row_mask(data, include=None, exclude=None):
+    """
+    Boolean mask of the rows kept by filter_rows.
+
+    Parameters:
+        data (DataFrame): Input DataFrame.
+        include (str, RowPredicate or list, optional): Rows matching any of the conditions are kept.
+        exclude (str, RowPredicate or list, optional): Rows matching any of the conditions are removed.
+
+    Returns:
+        ndarray: Boolean mask, one value per row.
+    """
+    mask = np.ones(len(data), dtype=bool)
+    if include is not None:
+        mask &= compile_conditions(include, 'Include').mask(data)
+    if exclude is not None:
+        mask &= ~compile_conditions(exclude, 'Exclude').mask(data)
+    return mask
@@ -1,8 +1,29 @@
 import os
+import operator
+import shutil
+import tempfile
+import warnings
 import pandas as pd
 import numpy as np
+from feature_matrix import FeatureMatrix
+from predicates import RowPredicate, values_in, matches, starts_with, in_range, row_mask
+from cache import DEFAULT_CACHE_MAX_BYTES, cache_key, load_cached_frame, store_cached_frame
+from instrument import traced
 
-def read_file(file_path, sep=';', encoding='utf-8'):
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Feature descriptor columns of an MS-DIAL alignment export (kept at full precision)
+ALIGNMENT_FEATURE_COLUMNS = ['Rt(min)', 'Mz']
+
+
+@traced
+def read_file(file_path, sep=';', encoding='utf-8', streaming=False, exclude=None, add_metabolite=False,
+              chunksize=50000, engine=None, intensity_dtype='float32', cache_dir=None,
+              cache_max_bytes=DEFAULT_CACHE_MAX_BYTES, lazy=False):
     """
     Read a file from the specified path.
 
@@ -10,41 +31,181 @@ def read_file(file_path, sep=';', encoding='utf-8'):
         file_path (str): Path to the file.
         sep (str, optional): Separator to use when reading CSV files. Defaults to ','.
         encoding (str, optional): Encoding to use when reading the file. Defaults to 'utf-8'.
+        streaming (bool, optional): Read a CSV alignment export with read_alignment_file (chunked, float32
+            intensities, column projection). Defaults to False.
+        exclude, add_metabolite, chunksize, engine, intensity_dtype: Passed to read_alignment_file when streaming.
+        cache_dir (str, optional): Directory of the parsed-file cache (see cache.py). When given, the parsed
+            DataFrame is stored as Parquet and later reads of the same unchanged file load it back. Default is None.
+        cache_max_bytes (int, optional): Size bound of the cache directory. Defaults to DEFAULT_CACHE_MAX_BYTES.
+        lazy (bool, optional): Return a LazyFrame (see lazy.py): the steps chained on it are optimized and only
+            run by collect(), save_data() or save_as_csv(). Defaults to False.
 
     Returns:
-        DataFrame: DataFrame containing the data from the file, or None if the file doesn't exist.
+        DataFrame: DataFrame containing the data from the file (LazyFrame when lazy=True).
     """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found at the specified path: {file_path}")
 
+    if lazy:
+        # Imported here: lazy.py builds on the tools.py functions
+        from lazy import LazyFrame
+        return LazyFrame(file_path, sep=sep, encoding=encoding, streaming=streaming, exclude=exclude,
+                         add_metabolite=add_metabolite, chunksize=chunksize, engine=engine,
+                         intensity_dtype=intensity_dtype, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)
+
     # Determine file type based on extension
     file_ext = os.path.splitext(file_path)[1].lower()
 
+    if cache_dir is not None and not os.path.isdir(file_path):
+        # Parameters that change the parsed DataFrame are part of the key
+        key = cache_key(cache_dir, file_path, sep=sep, encoding=encoding, streaming=streaming, exclude=exclude,
+                        add_metabolite=add_metabolite, intensity_dtype=intensity_dtype)
+        data = load_cached_frame(cache_dir, key)
+        if data is not None:
+            return data
+
     if file_ext == ".csv":
-        # Read CSV file
-        data = pd.read_csv(file_path, sep=sep, encoding=encoding)
+        if streaming:
+            # Read the alignment in chunks with typed intensities
+            data = read_alignment_file(file_path, sep=sep, encoding=encoding, exclude=exclude,
+                                       add_metabolite=add_metabolite, chunksize=chunksize, engine=engine,
+                                       intensity_dtype=intensity_dtype)
+        else:
+            # Read CSV file
+            data = pd.read_csv(file_path, sep=sep, encoding=encoding)
     elif file_ext in [".xls", ".xlsx"]:
         # Read Excel file
         data = pd.read_excel(file_path)
+    elif file_ext == ".parquet":
+        # Parquet file or directory of part files written by save_data (temporary files left by a failed
+        # append are not read)
+        if os.path.isdir(file_path):
+            parts = [os.path.join(file_path, part) for part in _part_names(file_path, 'parquet')]
+            data = pd.read_parquet(parts) if parts else pd.read_parquet(file_path)
+        else:
+            data = pd.read_parquet(file_path)
+    elif file_ext == ".feather":
+        if os.path.isdir(file_path):
+            parts = _part_names(file_path, 'feather')
+            data = pd.concat([pd.read_feather(os.path.join(file_path, part)) for part in parts])
+        else:
+            data = pd.read_feather(file_path)
+    elif file_ext in [".h5", ".hdf5"]:
+        data = pd.read_hdf(file_path, key='data')
     else:
-        raise ValueError("Unsupported file format. Only CSV and Excel files are supported.")
+        raise ValueError("Unsupported file format. Only CSV, Excel, Parquet, Feather and HDF5 files are supported.")
+
+    if cache_dir is not None and not os.path.isdir(file_path):
+        store_cached_frame(cache_dir, key, data, max_bytes=cache_max_bytes)
     
     return data
 
-def add_metabolite_column(data):
+def infer_sample_columns(file_path, sep=';', encoding='utf-8', nrows=1000):
+    """
+    Infer the sample (intensity) columns of an MS-DIAL alignment export from its first rows.
+
+    Parameters:
+        file_path (str): Path to the alignment CSV file.
+        sep (str, optional): Separator of the file. Defaults to ';'.
+        encoding (str, optional): Encoding of the file. Defaults to 'utf-8'.
+        nrows (int, optional): Number of rows sniffed to detect numeric columns. Defaults to 1000.
+
+    Returns:
+        list: Names of the numeric columns that are not feature descriptors (ALIGNMENT_FEATURE_COLUMNS).
+    """
+    head = pd.read_csv(file_path, sep=sep, encoding=encoding, nrows=nrows)
+    numeric_columns = head.select_dtypes(include='number').columns
+    return [col for col in numeric_columns if col not in ALIGNMENT_FEATURE_COLUMNS]
+
+@traced
+def read_alignment_file(file_path, sep=';', encoding='utf-8', exclude=None, add_metabolite=False,
+                        chunksize=50000, engine=None, intensity_dtype='float32'):
+    """
+    Read an MS-DIAL alignment export with low memory use.
+
+    Sample columns are inferred from the first rows and read as intensity_dtype, the 'exclude' list is pushed
+    into the read (excluded columns are never parsed) and the file is parsed in row chunks. With
+    add_metabolite=True the 'metabolite' column is built chunk by chunk before the exclusion, so 'Mz' and
+    'Rt(min)' can be excluded directly: the result is then the same as
+    filter_column(add_metabolite_column(read_file(...)), exclude=exclude) with float32 intensities.
+
+    Parameters:
+        file_path (str): Path to the alignment CSV file.
+        sep (str, optional): Separator of the file. Defaults to ';'.
+        encoding (str, optional): Encoding of the file. Defaults to 'utf-8'.
+        exclude (list, optional): Column names not to keep. Default is None.
+        add_metabolite (bool, optional): Add the 'metabolite' column while reading. Defaults to False.
+        chunksize (int, optional): Number of rows parsed per chunk. Defaults to 50000.
+        engine (str, optional): Parser engine ('c', 'python' or 'pyarrow'). The pyarrow engine parses the
+            whole projected file at once with multiple threads and ignores chunksize. Default is None (pandas default).
+        intensity_dtype (str, optional): dtype of the sample columns. Defaults to 'float32'.
+
+    Returns:
+        DataFrame: DataFrame containing the projected alignment.
+    """
+    exclude = set(exclude or [])
+    columns = pd.read_csv(file_path, sep=sep, encoding=encoding, nrows=0).columns.tolist()
+    sample_columns = infer_sample_columns(file_path, sep=sep, encoding=encoding)
+
+    # Project the columns: the feature descriptors are still needed to build the metabolite names
+    needed = ALIGNMENT_FEATURE_COLUMNS if add_metabolite else []
+    usecols = [col for col in columns if col not in exclude or col in needed]
+    dtype = {col: intensity_dtype for col in sample_columns if col in usecols}
+    dropped_after_read = [col for col in usecols if col in exclude]
+
+    def _project(chunk):
+        if add_metabolite:
+            chunk['metabolite'] = metabolite_names(chunk['Mz'], chunk['Rt(min)'])
+        return chunk.drop(columns=dropped_after_read)
+
+    if engine == 'pyarrow':
+        # The pyarrow parser is multithreaded but does not support chunked reading
+        data = pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype, engine=engine)
+        return _project(data)
+
+    reader = pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype,
+                         engine=engine, chunksize=chunksize)
+    data = pd.concat([_project(chunk) for chunk in reader], ignore_index=True)
+    return data
+
+def metabolite_names(mz, rt, mz_decimals=None):
+    """
+    Build the 'M<integer m/z>T<retention time>' feature names.
+
+    Parameters:
+        mz (Series): m/z values.
+        rt (Series): Retention times in minutes.
+        mz_decimals (int, optional): Keep this number of m/z decimals ('M<m/z>T<retention time>'), so that
+            features with the same integer m/z and retention time get distinct names. Default is None
+            (integer part only).
+
+    Returns:
+        Series: Feature names.
+    """
+    if mz_decimals is not None:
+        mz_text = mz.round(mz_decimals).map(f'{{:.{mz_decimals}f}}'.format)
+        return 'M' + mz_text + 'T' + rt.astype(str)
+    return 'M' + mz.astype(str).str.split('.').str[0] + 'T' + rt.astype(str)
+
+@traced
+def add_metabolite_column(data, mz_decimals=None):
     """
     Add a column called 'metabolite' to the DataFrame based on the values in the 'RT(min)' and 'MZ' columns.
 
     Parameters:
         data (DataFrame): Input DataFrame containing 'RT(min)' and 'MZ' columns.
+        mz_decimals (int, optional): m/z decimals kept in the names (see metabolite_names). Default is None.
 
     Returns:
-        DataFrame: DataFrame with the 'metabolite' column added.
+        DataFrame: Shallow copy of data with the 'metabolite' column added (data is not modified).
     """
-    data['metabolite'] = 'M' + data['Mz'].astype(str).str.split('.').str[0] + 'T' + data['Rt(min)'].astype(str)
+    # The new column goes to a shallow copy: the input DataFrame and its intensity blocks are left as they are
+    data = data.copy(deep=False)
+    data['metabolite'] = metabolite_names(data['Mz'], data['Rt(min)'], mz_decimals)
     return data
 
 
+@traced
 def filter_column(data, include=None, exclude=None):
     """
     Filter columns from a DataFrame based on included and excluded columns.
@@ -71,6 +232,7 @@ def filter_column(data, include=None, exclude=None):
     selected_data = data[selected_columns]
     return selected_data
 
+@traced
 def select_columns_with_metabolites_columns(data, list_columns=None):
     """
     Selects columns from a DataFrame that start with "M" and includes additional columns specified in the list.
@@ -98,66 +260,68 @@ def select_columns_with_metabolites_columns(data, list_columns=None):
     # Return the subset of the DataFrame with selected columns
     return data[selected_columns]
 
-def filter_rows(data, include=None, exclude=None):
+def numeric_metabolite_columns(data):
     """
-    Select and/or exclude rows based on specific conditions.
+    List the feature columns of a samples x features DataFrame: numeric columns starting with "M".
 
     Parameters:
         data (DataFrame): Input DataFrame.
-        include (str or list): Condition(s) to include rows (optional) ex: list =["column1 == 'value'", "column2 <10"].
-        exclude (str or list): Condition(s) to exclude rows (optional) ex: list =["column1 == 'value'", "column2 <10"].
 
     Returns:
-        DataFrame: Filtered DataFrame.
+        list: Feature column names.
     """
-    if include is not None:
-        if isinstance(include, str):
-            include_condition = include
-        elif isinstance(include, list):
-            include_condition = ' or '.join(include)
-        else:
-            raise ValueError("Include parameter must be a string or a list of strings.")
-    else:
-        include_condition = None
+    numeric_columns = data.select_dtypes(include='number').columns
+    return [col for col in numeric_columns if str(col).startswith("M")]
 
-    if exclude is not None:
-        if isinstance(exclude, str):
-            exclude_condition = exclude
-        elif isinstance(exclude, list):
-            exclude_condition = ' and '.join(['not (' + cond + ')' for cond in exclude])
-        else:
-            raise ValueError("Exclude parameter must be a string or a list of strings.")
-    else:
-        exclude_condition = None
+@traced
+def filter_rows(data, include=None, exclude=None):
+    """
+    Select and/or exclude rows based on specific conditions.
 
-    if include_condition is not None:
-        selected_data = data.query(include_condition)
-    else:
-        selected_data = data
+    Conditions are compiled once (see predicates.py) and cached: "column == 'value'" conditions become a single
+    hashed lookup of the whole value list, "column < 10" comparisons become vectorized ranges and other
+    strings fall back to DataFrame.eval. Predicates built with values_in, matches, starts_with and in_range
+    can be mixed with the strings. A string exclude removes the matching rows, as every condition of an exclude
+    list (it used to be passed un-negated to DataFrame.query, i.e. kept the matching rows).
 
-    if exclude_condition is not None:
-        excluded_data = selected_data.query(exclude_condition)
-    else:
-        excluded_data = selected_data
+    Parameters:
+        data (DataFrame): Input DataFrame.
+        include (str, RowPredicate or list): Condition(s) to include rows (optional) ex: list =["column1 == 'value'", "column2 <10"].
+        exclude (str, RowPredicate or list): Condition(s) to exclude rows (optional) ex: list =["column1 == 'value'", starts_with('sample_name', 'blc')].
 
-    return excluded_data
+    Returns:
+        DataFrame: Filtered DataFrame.
+    """
+    mask = row_mask(data, include=include, exclude=exclude)
+    if mask.all():
+        return data
+    return data[mask]
 
 
-def transpose_data(data, metabolite_column):
+@traced
+def transpose_data(data, metabolite_column, dtype=None):
     """
     Transpose the data with specified column values as column names.
 
     Parameters:
         data (DataFrame): Input DataFrame.
         metabolite_column (str): Name of the column to use as column names.
+        dtype (str, optional): When given ('float32' or 'float64'), only the numeric sample columns are
+            transposed, through a FeatureMatrix, into a typed matrix of this dtype; the other columns go to
+            the feature table instead of producing an object-dtype transpose. Default is None.
 
     Returns:
         DataFrame: Transposed DataFrame with specified column values as column names.
     """
+    if dtype is not None:
+        matrix = FeatureMatrix.from_alignment(data, metabolite_column=metabolite_column, dtype=dtype)
+        return matrix.to_dataframe(include_samples=False)
+
     transposed_data = data.set_index(metabolite_column).T
     transposed_data.index.name ='sample_name'
     return transposed_data
 
+@traced
 def merge_data(df1, df2):
     """
     Merge two datasets based on their indices.
@@ -174,6 +338,71 @@ def merge_data(df1, df2):
     return merged_data
 
 
+def align_metadata(samples, metadata, strict=False):
+    """
+    Align a sample metadata table on a list of sample names and report the mismatches.
+
+    Parameters:
+        samples (Index or list): Sample names, in the order of the intensity rows.
+        metadata (DataFrame): Metadata indexed by sample name.
+        strict (bool, optional): Raise a ValueError when samples have no metadata. Defaults to False.
+
+    Returns:
+        tuple: (DataFrame metadata with one row per sample, in the same order (NaN for missing samples),
+                dict with the 'missing' samples (no metadata) and the 'extra' metadata rows (no intensities))
+    """
+    samples = pd.Index(samples)
+    if metadata.index.has_duplicates:
+        duplicated = metadata.index[metadata.index.duplicated()].unique().tolist()
+        raise ValueError(f"Duplicated sample names in the metadata: {duplicated}")
+
+    # Hashed lookup of the sample names, checked before anything is joined
+    report = {'missing': samples.difference(metadata.index, sort=False).tolist(),
+              'extra': metadata.index.difference(samples, sort=False).tolist()}
+    if report['missing']:
+        if strict:
+            raise ValueError(f"Samples without metadata: {report['missing']}")
+        print(f"Samples without metadata: {report['missing']}")
+    if report['extra']:
+        print(f"Metadata rows without intensities (ignored): {report['extra']}")
+
+    if metadata.index.equals(samples):
+        aligned = metadata
+    else:
+        aligned = metadata.reindex(samples)
+    return aligned, report
+
+@traced
+def attach_metadata(data, metadata, strict=False):
+    """
+    Add the sample metadata columns to an intensity DataFrame without copying the intensities.
+
+    Unlike merge_data (outer merge), the metadata is aligned on the rows of data by sample name, metadata rows
+    without intensities are reported and ignored instead of becoming all-NaN rows, and the intensity block is
+    shared with data: the cost depends on the number of samples and metadata columns only.
+
+    Parameters:
+        data (DataFrame): Intensity DataFrame indexed by sample name (e.g. the output of filter_rows).
+        metadata (DataFrame): Metadata indexed by sample name.
+        strict (bool, optional): Raise a ValueError when samples have no metadata. Defaults to False.
+
+    Returns:
+        DataFrame: data with the metadata columns added after the features.
+    """
+    overlapping = data.columns.intersection(metadata.columns).tolist()
+    if overlapping:
+        raise ValueError(f"Metadata columns already in the data: {overlapping}")
+
+    aligned, _ = align_metadata(data.index, metadata, strict=strict)
+
+    # Shallow copy: the new columns are added as new blocks, the intensity block is not copied
+    joined = data.copy(deep=False)
+    for col in aligned.columns:
+        joined[col] = aligned[col].to_numpy()
+    return joined
+
+
+@traced
 def blank_filter(data, condition_column='SampleType', condition_values=['blank'], operation='!=', threshold=0):
     """
     Filter columns from a DataFrame based on a condition applied to specific rows.
@@ -218,6 +447,7 @@ def blank_filter(data, condition_column='SampleType', condition_values=['blank']
 
     return data_filtered
 
+@traced
 def cv_filter(data, raw_list, threshold =20, operation = "<=" ):
     """
     Calculate the coefficient of variation (CV) for each column between given rows and filter based on threshold.
@@ -228,8 +458,8 @@ def cv_filter(data, raw_list, threshold =20, operation = "<=" ):
     Parameters:
     - data: DataFrame
         The input DataFrame from which columns will be selected.
-    - raw_list: list
-        liste of rows to compare (ex: raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]).
+    - raw_list: list or RowPredicate
+        liste of rows to compare, as accepted by filter_rows 'include' (ex: raw_list = ["sample_name == '240326NCE_Globale_neg_QC3-DIL8'", "sample_name == '240326NCE_Globale_neg_QC3'" , "sample_name == '240326NCE_Globale_neg_QC3-DIL2'"]).
     - threshold: int 
         cv threasholf of filtering (defolt = 20)
     - operation: "<=", ">="
@@ -240,7 +470,7 @@ def cv_filter(data, raw_list, threshold =20, operation = "<=" ):
         A DataFrame data filtered based on the threshold given.
     """
     #filter QCDil2, QCDil8 and QC3 raws
-    CV_data = filter_rows(data, include = raw_list)
+    CV_data = data[row_mask(data, include = raw_list)]
     
     # Calculate the mean and standard deviation for each column
     mean_values = CV_data.mean()
@@ -260,6 +490,7 @@ def cv_filter(data, raw_list, threshold =20, operation = "<=" ):
     
     return filtered_data
 
+@traced
 def QC_filter_with_zeros(data, threshold=0.75):
     """
     Drop columns from a DataFrame where the value is 0 in at least 3/4 of the QCs.
@@ -286,28 +517,235 @@ def QC_filter_with_zeros(data, threshold=0.75):
     return data_filtered
 
 
-def save_as_csv(data, output_dir, output_file, file_conflict="skip"):
+# Comparison operations supported by the filter functions
+FILTER_OPERATIONS = {'!=': operator.ne, '<=': operator.le, '>=': operator.ge, '=': operator.eq}
+
+@traced
+def qc_feature_report(values, features, blank_rows, cv_rows=None, blank_operation='!=', blank_threshold=0,
+                      zero_threshold=0.75, cv_threshold=20, cv_operation='<='):
+    """
+    Compute the blank, zero and CV statistics of every feature in one vectorized pass and flag the removed features.
+
+    The rules are the ones of blank_filter, QC_filter_with_zeros and cv_filter. A removed feature is reported
+    with the first rule that removes it, in that order.
+
+    Parameters:
+    - values: ndarray
+        Intensity matrix (samples x features).
+    - features: list or Index
+        Feature names (one per column of values).
+    - blank_rows: ndarray of bool
+        Rows of the blank injections.
+    - cv_rows: ndarray of bool or None
+        Rows used for the CV (QC dilutions). None skips the CV rule (default parameter = None).
+    - blank_operation, blank_threshold: see blank_filter (default parameters = '!=', 0).
+    - zero_threshold: float
+        Proportion of zeros over all rows that removes a feature (default parameter = 0.75).
+    - cv_threshold, cv_operation: see cv_filter (default parameters = 20, '<=').
+
+    Returns:
+    - DataFrame
+        One row per feature: blank_hit, zero_fraction, qc_mean, qc_std, qc_cv and removed_by
+        ('blank', 'zeros', 'cv' or 'kept').
+    """
+    if blank_operation not in FILTER_OPERATIONS:
+        raise ValueError("Unsupported operation. Supported operations are '!=', '<=', '>=', and '='")
+    if cv_operation not in ('<=', '>='):
+        raise ValueError("Unsupported operation. Supported operations are '<=' and '>='")
+
+    # Blank rule: any blank injection matching the condition
+    blank_hit = FILTER_OPERATIONS[blank_operation](values[blank_rows], blank_threshold).any(axis=0)
+
+    # Zero rule: proportion of zeros over all the rows
+    zero_fraction = (values == 0).sum(axis=0) / values.shape[0]
+
+    # CV rule on the QC dilution rows (NaN skipped, sample standard deviation)
+    if cv_rows is not None:
+        qc_values = values[cv_rows].astype(np.float64)
+        with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            qc_mean = np.nanmean(qc_values, axis=0)
+            qc_std = np.nanstd(qc_values, axis=0, ddof=1)
+            qc_cv = qc_std / qc_mean * 100
+        cv_hit = FILTER_OPERATIONS[cv_operation](qc_cv, cv_threshold)
+    else:
+        qc_mean = qc_std = qc_cv = np.full(values.shape[1], np.nan)
+        cv_hit = np.zeros(values.shape[1], dtype=bool)
+
+    zero_hit = zero_fraction >= zero_threshold
+    removed_by = np.select([blank_hit, zero_hit, cv_hit], ['blank', 'zeros', 'cv'], default='kept')
+
+    return pd.DataFrame({'blank_hit': blank_hit, 'zero_fraction': zero_fraction, 'qc_mean': qc_mean,
+                         'qc_std': qc_std, 'qc_cv': qc_cv, 'removed_by': removed_by},
+                        index=pd.Index(features, name='metabolite'))
+
+@traced
+def qc_filter(data, cv_rows=None, feature_columns=None, condition_column='SampleType', blank_values=['blank'],
+              blank_operation='!=', blank_threshold=0, zero_threshold=0.75, cv_threshold=20, cv_operation='<='):
     """
-    Save DataFrame as a CSV file in the given directory.
+    Filter features with the blank, zero and CV rules in a single pass.
+
+    Gives the same features as blank_filter -> QC_filter_with_zeros -> cv_filter, but the statistics are
+    computed on the numeric feature matrix only and the columns are dropped once. Metadata columns are kept,
+    so the filtered data does not need to be merged with the metadata again.
+
+    Parameters:
+    - data: DataFrame
+        Merged DataFrame (samples x features + metadata columns).
+    - cv_rows: list, str or RowPredicate
+        Rows of the QC dilutions, as accepted by filter_rows 'include' (default parameter = None: no CV rule).
+    - feature_columns: list
+        Feature columns (default parameter = None: numeric columns starting with "M").
+    - condition_column, blank_values: str, list
+        Column and values of the blank injections (default parameters = 'SampleType', ['blank']).
+    - blank_operation, blank_threshold, zero_threshold, cv_threshold, cv_operation:
+        see qc_feature_report.
+
+    Returns:
+    - tuple
+        (filtered DataFrame, per-feature report DataFrame from qc_feature_report)
+    """
+    if feature_columns is None:
+        feature_columns = numeric_metabolite_columns(data)
+
+    # Row masks of the blank injections and of the QC dilutions
+    blank_rows = data[condition_column].isin(blank_values).to_numpy()
+    if cv_rows is not None:
+        cv_rows = row_mask(data, include=cv_rows)
+
+    report = qc_feature_report(data[feature_columns].to_numpy(), feature_columns, blank_rows, cv_rows=cv_rows,
+                               blank_operation=blank_operation, blank_threshold=blank_threshold,
+                               zero_threshold=zero_threshold, cv_threshold=cv_threshold, cv_operation=cv_operation)
+
+    # Drop all the removed features at once
+    columns_to_drop = report.index[report['removed_by'] != 'kept'].tolist()
+    data_filtered = data.drop(columns_to_drop, axis=1)
+
+    return data_filtered, report
+
+
+# File extension of each output format (parquet and feather outputs are directories of part files)
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'hdf5': '.h5'}
+# Width reserved for the text columns of HDF5 tables, so that longer values can be appended later
+HDF5_MIN_ITEMSIZE = {'values': 128}
+
+def _part_names(output_path, file_format):
+    # Complete part files of a parquet/feather output directory (temporary files of failed appends ignored)
+    return sorted(name for name in os.listdir(output_path)
+                  if name.startswith('part-') and name.endswith(f'.{file_format}'))
+
+def _part_path(output_path, file_format):
+    # Next part file of a parquet/feather output directory
+    return os.path.join(output_path, f"part-{len(_part_names(output_path, file_format)):05d}.{file_format}")
+
+def _write_arrow(data, path, file_format, chunksize):
+    if pa is None:
+        raise ImportError("pyarrow is required to write parquet and feather files (pip install pyarrow).")
+    schema = pa.Schema.from_pandas(data.iloc[:0], preserve_index=True)
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    with writer:
+        # One row group / record batch per chunk of rows
+        for start in range(0, max(len(data), 1), chunksize):
+            chunk = pa.Table.from_pandas(data.iloc[start:start + chunksize], schema=schema, preserve_index=True)
+            writer.write_table(chunk)
+
+def _umask_mode(mode):
+    # Permissions of a file (0o666) or directory (0o777) created normally, i.e. with the process umask
+    umask = os.umask(0)
+    os.umask(umask)
+    return mode & ~umask
+
+def _write_new(data, output_path, file_format, chunksize):
+    # Write next to the target and rename it into place, so a failed write never leaves a partial output.
+    # mkdtemp/mkstemp create owner-only entries: the usual permissions are restored before the rename
+    output_dir = os.path.dirname(output_path)
+    if file_format in ('parquet', 'feather'):
+        tmp_path = tempfile.mkdtemp(dir=output_dir, suffix='.tmp')
+        os.chmod(tmp_path, _umask_mode(0o777))
+        _write_arrow(data, _part_path(tmp_path, file_format), file_format, chunksize)
+        if os.path.exists(output_path):
+            old_path = tempfile.mkdtemp(dir=output_dir, suffix='.old')
+            os.replace(output_path, os.path.join(old_path, 'data'))
+            os.replace(tmp_path, output_path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(tmp_path, output_path)
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        if file_format == 'csv':
+            data.to_csv(tmp_path, index=True, sep=';', chunksize=chunksize)
+        else:
+            with pd.HDFStore(tmp_path, mode='w') as store:
+                store.append('data', data, chunksize=chunksize, min_itemsize=HDF5_MIN_ITEMSIZE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.chmod(tmp_path, _umask_mode(0o666))
+    os.replace(tmp_path, output_path)
+
+def _append(data, output_path, file_format, chunksize):
+    # New rows are added after the existing ones; the existing data is never read back or rewritten
+    if file_format in ('parquet', 'feather'):
+        part_path = _part_path(output_path, file_format)
+        # Hidden temporary name: skipped by the part count, read_file and arrow datasets
+        tmp_path = os.path.join(output_path, '.' + os.path.basename(part_path) + '.tmp')
+        _write_arrow(data, tmp_path, file_format, chunksize)
+        os.replace(tmp_path, part_path)
+    elif file_format == 'csv':
+        existing_columns = pd.read_csv(output_path, sep=';', nrows=0, index_col=0).columns
+        if set(existing_columns) != set(map(str, data.columns)):
+            raise ValueError("Columns of the data do not match the columns of the existing file.")
+        size = os.path.getsize(output_path)
+        try:
+            data[existing_columns].to_csv(output_path, mode='a', header=False, index=True, sep=';', chunksize=chunksize)
+        except BaseException:
+            # Drop the partially appended rows
+            with open(output_path, 'r+b') as handle:
+                handle.truncate(size)
+            raise
+    else:
+        with pd.HDFStore(output_path, mode='a') as store:
+            store.append('data', data, chunksize=chunksize, min_itemsize=HDF5_MIN_ITEMSIZE)
+
+@traced
+def save_data(data, output_dir, output_file, file_conflict="skip", file_format="csv", chunksize=100000):
+    """
+    Save DataFrame in the given directory as CSV, Parquet, Feather (Arrow IPC) or HDF5.
+
+    New files and replacements are written to a temporary file and renamed into place. Appends add rows after
+    the existing data without reading it back: a new part file for parquet/feather (the output is a directory
+    of part files, read with read_file, pandas.read_parquet or arrow::open_dataset), new rows for CSV and
+    HDF5 (table format). Rows are written in chunks of chunksize rows.
 
     Parameters:
         data (DataFrame): DataFrame to be saved.
-        output_dir (str): Directory where the CSV file will be saved.
-        output_file (str): Name of the CSV file (without the extension).
+        output_dir (str): Directory where the file will be saved.
+        output_file (str): Name of the file (without the extension).
         file_conflict (str): Behavior in case of a file conflict.
             - "skip": Skip saving the file (default).
             - "replace": Replace the existing file.
             - "append": Append to the existing file.
+        file_format (str): 'csv' (';' separated), 'parquet', 'feather' or 'hdf5' (needs PyTables). Defaults to 'csv'.
+        chunksize (int): Number of rows written at a time. Defaults to 100000.
 
     Returns:
-        str: Path to the saved CSV file, or None if saving is skipped.
+        str: Path to the saved file, or None if saving is skipped.
     """
+    if file_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported file format. Supported formats are {list(OUTPUT_FORMATS)}.")
+
     # Create the output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
-    
+
     # Construct the full path to the output file
-    output_path = os.path.join(output_dir, output_file + ".csv")
-    
+    output_path = os.path.join(output_dir, output_file + OUTPUT_FORMATS[file_format])
+
     # Check if a file with the same name already exists
     if os.path.exists(output_path):
         if file_conflict == "skip":
@@ -315,20 +753,37 @@ def save_as_csv(data, output_dir, output_file, file_conflict="skip"):
             return None
         elif file_conflict == "replace":
             # Replace the existing file
-            data.to_csv(output_path, index=True, sep = ';')
+            _write_new(data, output_path, file_format, chunksize)
             print("Existing file replaced.")
         elif file_conflict == "append":
             # Append to the existing file
-            existing_data = pd.read_csv(output_path)
-            combined_data = pd.concat([existing_data, data], ignore_index=True)
-            combined_data.to_csv(output_path, index=True, sep = ';')
+            _append(data, output_path, file_format, chunksize)
             print("Data appended to the existing file.")
         else:
             print("Invalid value for 'file_conflict'. Skipping saving.")
             return None
     else:
-        # Save the DataFrame as a new CSV file
-        data.to_csv(output_path, index=True)
-        print("CSV file saved.")
-    
-    return output_path
\ No newline at end of file
+        # Save the DataFrame as a new file
+        _write_new(data, output_path, file_format, chunksize)
+        print(f"{file_format.upper()} file saved.")
+
+    return output_path
+
+@traced
+def save_as_csv(data, output_dir, output_file, file_conflict="skip"):
+    """
+    Save DataFrame as a CSV file (';' separated) in the given directory.
+
+    Parameters:
+        data (DataFrame): DataFrame to be saved.
+        output_dir (str): Directory where the CSV file will be saved.
+        output_file (str): Name of the CSV file (without the extension).
+        file_conflict (str): Behavior in case of a file conflict.
+            - "skip": Skip saving the file (default).
+            - "replace": Replace the existing file.
+            - "append": Append to the existing file.
+
+    Returns:
+        str: Path to the saved CSV file, or None if saving is skipped.
+    """
+    return save_data(data, output_dir, output_file, file_conflict=file_conflict, file_format="csv")